@@ -10,6 +10,10 @@ const store = new Store();
 let mainWindow;
 let cachedFonts = null;
 let cachedPythonExecutable = null;
+let currentPythonProcess = null;
+// Tải trước link trong hàng chờ: chạy lần lượt từng item bằng 1 tiến trình Python nền
+let prefetchQueue = [];
+let prefetchProcess = null;
 
 function sendUpdateMessage(channel, ...args) {
   if (mainWindow) {
@@ -190,6 +194,10 @@ app.whenReady().then(() => {
 });
 
 app.on('window-all-closed', () => { if (process.platform !== 'darwin') app.quit(); });
+app.on('before-quit', () => {
+  prefetchQueue = [];
+  if (prefetchProcess) prefetchProcess.kill();
+});
 app.on('activate', () => { if (BrowserWindow.getAllWindows().length === 0) createWindow(); });
 
 // --- CÁC HÀM XỬ LÝ IPC ---
@@ -278,7 +286,7 @@ ipcMain.handle('cookies:update', async () => {
 });
 
 
-ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpeed, parts, partDuration, savePath, layout, encoder }) => {
+ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpeed, parts, partDuration, savePath, layout, encoder, outputFormat, publishDir }) => {
     const resourcesPath = app.isPackaged ? process.resourcesPath : __dirname;
     
     // Khi build, editor.py nằm trong process.resourcesPath (thư mục resources)
@@ -302,6 +310,13 @@ ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpee
       '--parts', String(parts), '--save-path', savePath, '--part-duration', String(partDuration), 
       '--layout-file', layoutFilePath, '--encoder', encoder || 'h264_nvenc'
     ];
+    // Xuất fmp4/hls: fragment được báo qua 'process:fragment' (và chép vào publishDir nếu có) trong lúc render
+    if (outputFormat) {
+      args.push('--output-format', outputFormat);
+    }
+    if (publishDir) {
+      args.push('--publish-dir', publishDir);
+    }
 
     // Tìm Python executable và kiểm tra version
     const pythonInfo = findPythonExecutable();
@@ -400,8 +415,9 @@ ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpee
     
     const pythonProcess = spawn(commandToRun, args, { 
       env: pythonEnv,
-      stdio: ['ignore', 'pipe', 'pipe'] // Đảm bảo stdout và stderr được pipe
+      stdio: ['pipe', 'pipe', 'pipe'] // stdin dùng để gửi lệnh PAUSE/RESUME/CANCEL cho Python
     });
+    currentPythonProcess = pythonProcess;
     
     let hasLinkSuccess = false;
     let hasLinkError = false;
@@ -419,6 +435,17 @@ ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpee
             if (!logLine) continue;
             if (logLine.startsWith('PROGRESS:')) {
                 sendUpdateMessage('process:progress', { type: line.split(':')[1], value: parseFloat(line.split(':')[2]) });
+            } else if (logLine.startsWith('FRAGMENT:')) {
+                // FRAGMENT:<json> - 1 fragment của phần đang render đã ghi xong (xuất fmp4/hls)
+                try {
+                    sendUpdateMessage('process:fragment', JSON.parse(logLine.slice('FRAGMENT:'.length)));
+                } catch (e) {
+                    sendUpdateMessage('process:log', logLine);
+                }
+            } else if (logLine.startsWith('ETA:')) {
+                // ETA:<số giây còn lại>:<thời điểm dự kiến xong (unix)>
+                const [, remaining, finishAt] = logLine.split(':');
+                sendUpdateMessage('process:eta', { remaining: parseFloat(remaining), finishAt: parseFloat(finishAt) });
             } else {
                 sendUpdateMessage('process:log', logLine);
                 // Theo dõi LINK_SUCCESS và LINK_ERROR
@@ -460,6 +487,7 @@ ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpee
         hasLinkError = true;
     });
     pythonProcess.on('close', (code) => {
+        if (currentPythonProcess === pythonProcess) currentPythonProcess = null;
         // Đợi một chút để đảm bảo tất cả output đã được đọc
         setTimeout(() => {
             if (code === 403) {
@@ -516,6 +544,70 @@ ipcMain.on('video:runProcessWithLayout', (event, { audioUrl, videoUrl, videoSpee
     });
 });
 
+// Tải trước input (metadata, audio, thumbnail, video) của item vừa thêm vào hàng chờ.
+// Python chạy với ưu tiên thấp, giới hạn băng thông và tự nhường khi có job đang render
+function runNextPrefetch() {
+    if (prefetchProcess || prefetchQueue.length === 0) return;
+    const { audioUrl, videoUrl } = prefetchQueue.shift();
+    const pythonInfo = findPythonExecutable();
+    if (!pythonInfo) {
+      // Không có Python: báo lỗi cho mọi item đang chờ để hàng chờ không hiện "đang tải trước" mãi
+      [{ audioUrl, videoUrl }, ...prefetchQueue].forEach(item => sendUpdateMessage('queue:prefetched', { ...item, ok: false }));
+      prefetchQueue = [];
+      return;
+    }
+    const pythonScriptPath = app.isPackaged
+      ? path.join(process.resourcesPath, 'editor.py')
+      : path.join(__dirname, 'scripts', 'editor.py');
+    const resourcesPathForPython = app.isPackaged
+      ? process.resourcesPath
+      : path.join(__dirname, 'resources');
+    const args = [
+      pythonScriptPath, '--prefetch', '--resources-path', resourcesPathForPython,
+      '--user-data-path', app.getPath('userData'), '--audio-url', audioUrl, '--video-url', videoUrl
+    ];
+    const child = spawn(pythonInfo.command, args, {
+      env: {
+        ...process.env,
+        PYTHONIOENCODING: 'utf-8',
+        PYTHONUTF8: '1',
+        PYTHONPATH: path.dirname(pythonScriptPath) + (process.env.PYTHONPATH ? path.delimiter + process.env.PYTHONPATH : '')
+      },
+      stdio: ['ignore', 'ignore', 'pipe'],
+      windowsHide: true
+    });
+    prefetchProcess = child;
+    let stderrTail = '';
+    child.stderr.on('data', (data) => { stderrTail = (stderrTail + data.toString('utf8')).slice(-2000); });
+    const finish = (code) => {
+      if (prefetchProcess !== child) return;
+      prefetchProcess = null;
+      // Tải trước lỗi không ảnh hưởng hàng chờ: job sẽ tự tải lại khi tới lượt
+      if (code !== 0) console.log(`Prefetch ${videoUrl} lỗi (mã ${code}): ${stderrTail.trim()}`);
+      sendUpdateMessage('queue:prefetched', { audioUrl, videoUrl, ok: code === 0 });
+      runNextPrefetch();
+    };
+    child.on('error', () => finish(-1));
+    child.on('close', finish);
+}
+
+ipcMain.on('queue:prefetch', (event, { audioUrl, videoUrl }) => {
+    if (!audioUrl || !videoUrl) return;
+    if (prefetchQueue.some(item => item.audioUrl === audioUrl && item.videoUrl === videoUrl)) return;
+    prefetchQueue.push({ audioUrl, videoUrl });
+    runNextPrefetch();
+});
+
+// Gửi lệnh điều khiển (PAUSE/RESUME/CANCEL) tới tiến trình Python đang chạy
+// Trả về false nếu không có tiến trình nào để nhận lệnh
+ipcMain.handle('process:control', (event, command) => {
+    if (!currentPythonProcess || !currentPythonProcess.stdin || !currentPythonProcess.stdin.writable) {
+        return false;
+    }
+    currentPythonProcess.stdin.write(`${command}\n`);
+    return true;
+});
+
 
 // --- Xử lý Auto-Update thủ công ---
 autoUpdater.on('update-available', (info) => {
@@ -8,6 +8,13 @@ contextBridge.exposeInMainWorld('electronAPI', {
   saveTemplate: (template) => ipcRenderer.invoke('templates:save', template),
   deleteTemplate: (templateId) => ipcRenderer.invoke('templates:delete', templateId),
   runProcessWithLayout: (args) => ipcRenderer.send('video:runProcessWithLayout', args),
+  controlProcess: (command) => ipcRenderer.invoke('process:control', command),
+  prefetchQueueItem: (item) => ipcRenderer.send('queue:prefetch', item),
+  onQueuePrefetched: (callback) => {
+    const listener = (_event, value) => callback(value);
+    ipcRenderer.on('queue:prefetched', listener);
+    return () => ipcRenderer.removeListener('queue:prefetched', listener);
+  },
   onProcessLog: (callback) => {
     const listener = (_event, value) => callback(value);
     ipcRenderer.on('process:log', listener);
@@ -18,6 +25,16 @@ contextBridge.exposeInMainWorld('electronAPI', {
     ipcRenderer.on('process:progress', listener);
     return () => ipcRenderer.removeListener('process:progress', listener);
   },
+  onProcessEta: (callback) => {
+    const listener = (_event, value) => callback(value);
+    ipcRenderer.on('process:eta', listener);
+    return () => ipcRenderer.removeListener('process:eta', listener);
+  },
+  onProcessFragment: (callback) => {
+    const listener = (_event, value) => callback(value);
+    ipcRenderer.on('process:fragment', listener);
+    return () => ipcRenderer.removeListener('process:fragment', listener);
+  },
   showContextMenu: (elementId, elementType) => ipcRenderer.send('show-context-menu', { elementId, elementType }),
   onContextMenuCommand: (callback) => {
     const listener = (_event, value) => callback(value);
@@ -68,18 +68,42 @@ function App() {
   const [isCookieRequired, setIsCookieRequired] = useState(false);
   const [statusText, setStatusText] = useState('Sẵn sàng');
   const [progress, setProgress] = useState(0);
+  const [eta, setEta] = useState(null); // { remaining: giây còn lại, finishAt: thời điểm xong (unix) } từ dòng ETA:
   const [splitMode, setSplitMode] = useState('duration');
+  const [outputFormat, setOutputFormat] = useState('mp4'); // mp4 / fmp4 / hls (--output-format)
+  const [publishDir, setPublishDir] = useState(''); // fmp4/hls: chép từng fragment đã xong vào đây (--publish-dir)
+  const [fragmentInfo, setFragmentInfo] = useState(null); // { part, count, done } của phần đang xuất fragment
   const [showPartText, setShowPartText] = useState(true); // Bật/tắt hiển thị chữ "Part..."
   
   const [urlQueue, setUrlQueue] = useState([]); // Mỗi item: { audioUrl, videoUrl }
   const [isPaused, setIsPaused] = useState(false);
+  // Trạng thái tải trước theo item (khóa "audioUrl|videoUrl"): 'pending' / 'done' / 'failed'
+  const [prefetchStatus, setPrefetchStatus] = useState({});
   
   const handleQueueChange = (newQueue) => {
+    // Item mới thêm được tải trước ở nền để tới lượt render không phải chờ tải
+    const knownItems = new Set(urlQueue.map(item => `${item.audioUrl}|${item.videoUrl}`));
+    const newItems = newQueue
+      .filter(item => item.audioUrl && item.videoUrl && !knownItems.has(`${item.audioUrl}|${item.videoUrl}`));
+    newItems.forEach(item => window.electronAPI.prefetchQueueItem({ audioUrl: item.audioUrl, videoUrl: item.videoUrl }));
+    if (newItems.length > 0) {
+      setPrefetchStatus(prev => {
+        const next = { ...prev };
+        newItems.forEach(item => {
+          const key = `${item.audioUrl}|${item.videoUrl}`;
+          if (next[key] !== 'done') next[key] = 'pending';
+        });
+        return next;
+      });
+    }
     setUrlQueue(newQueue);
   };
   
   const handlePauseToggle = () => {
-    setIsPaused(prev => !prev);
+    const nextPaused = !isPaused;
+    setIsPaused(nextPaused);
+    // Tạm dừng/tiếp tục luôn ffmpeg đang chạy bên Python (nếu có)
+    window.electronAPI.controlProcess(nextPaused ? 'PAUSE' : 'RESUME');
   }; 
 
   const [updateInfo, setUpdateInfo] = useState(null); 
@@ -141,9 +165,9 @@ function App() {
 
   useEffect(() => {
     // <<< SỬA LỖI 2: Cập nhật ref mỗi khi state thay đổi >>> 
-    jobStateRef.current = { isRendering, urlQueue, isPaused, splitMode };
+    jobStateRef.current = { isRendering, urlQueue, isPaused, splitMode, outputFormat, publishDir };
     layoutRef.current = captureLayoutData();
-  }, [isRendering, urlQueue, isPaused, splitMode, elements]); // <<< Thêm `elements` vào dependency
+  }, [isRendering, urlQueue, isPaused, splitMode, outputFormat, publishDir, elements]); // <<< Thêm `elements` vào dependency
 
 
   useEffect(() => {
@@ -323,8 +347,22 @@ function App() {
       setProgress(value);
       if (type === 'DONE') {
         setProgress(100);
+        setEta(null);
       }
     });
+    const removeEtaListener = window.electronAPI.onProcessEta((value) => setEta(value));
+    const removePrefetchedListener = window.electronAPI.onQueuePrefetched(({ audioUrl, videoUrl, ok }) => {
+      setPrefetchStatus(prev => ({ ...prev, [`${audioUrl}|${videoUrl}`]: ok ? 'done' : 'failed' }));
+    });
+    // FRAGMENT: init / media (từng fragment đã ghi xong) / end (phần đã xong) của phần đang render
+    const removeFragmentListener = window.electronAPI.onProcessFragment(({ kind, part }) => {
+      setFragmentInfo(prev => {
+        const current = prev && prev.part === part ? prev : { part, count: 0, done: false };
+        if (kind === 'media') return { ...current, count: current.count + 1 };
+        if (kind === 'end') return { ...current, done: true };
+        return current;
+      });
+    });
     const removeContextMenuListener = window.electronAPI.onContextMenuCommand(({ action, elementId }) => { handleLayerAction(action, elementId); });
     const removeCookieListener = window.electronAPI.onCookieRequired(() => {
         const errorMsg = 'ERROR: Video này yêu cầu cookies để tải.\n';
@@ -382,6 +420,9 @@ function App() {
     return () => {
       removeLogListener();
       removeProgressListener();
+      removeEtaListener();
+      removePrefetchedListener();
+      removeFragmentListener();
       removeContextMenuListener();
       removeCookieListener();
       removeUpdateMessageListener();
@@ -420,8 +461,10 @@ function App() {
     fullLogRef.current = startLog;
     
     setProgress(0);
+    setEta(null);
+    setFragmentInfo(null);
     setIsCookieRequired(false);
-    const { splitMode: currentSplitMode } = jobStateRef.current;
+    const { splitMode: currentSplitMode, outputFormat: currentFormat, publishDir: currentPublishDir } = jobStateRef.current;
     const durationValue = (currentSplitMode === 'duration') 
                             ? (durationInputRef.current ? durationInputRef.current.value : 120) 
                             : 0; 
@@ -435,6 +478,9 @@ function App() {
       savePath: savePathInputRef.current.value,
       layout: layoutRef.current, // <<< SỬA LỖI 2: Đọc layout từ ref
       encoder: encoder || 'h264_nvenc',
+      outputFormat: currentFormat || 'mp4',
+      // Chỉ fmp4/hls mới có fragment để chép trong lúc render
+      publishDir: currentFormat && currentFormat !== 'mp4' ? currentPublishDir : '',
     });
   };
 
@@ -449,13 +495,14 @@ function App() {
     if (isPaused) {
       setIsPaused(false);
       setUpdateStatus('Đã tiếp tục render hàng chờ...');
-      // Tiếp tục với item đầu tiên trong queue
-      setTimeout(() => {
+      // Item hiện tại vẫn đang chạy (chỉ bị tạm dừng): tiếp tục nó thay vì chạy lại
+      window.electronAPI.controlProcess('RESUME').then((resumed) => {
+        if (resumed) return;
         const { urlQueue: q } = jobStateRef.current || {};
         if (q && q.length > 0) {
           runJob(q);
         }
-      }, 0);
+      });
       return;
     }
     
@@ -667,6 +714,10 @@ function App() {
     const path = await window.electronAPI.openDirectoryDialog();
     if (path) savePathInputRef.current.value = path;
   };
+  const handleBrowsePublishDir = async () => {
+    const path = await window.electronAPI.openDirectoryDialog();
+    if (path) setPublishDir(path);
+  };
   const handleReset = () => {
     if (isRendering) { 
         if (window.confirm("Bạn có chắc muốn hủy hàng đợi render? (Video hiện tại sẽ hoàn tất và dừng lại)")) {
@@ -823,6 +874,7 @@ function App() {
         isRendering={isRendering}
         statusText={statusText}
         progress={progress}
+        eta={eta}
         onRunRender={handleRunRender}
         onAddImage={handleAddImage}
         onAddText={handleAddText}
@@ -830,6 +882,12 @@ function App() {
         onReset={handleReset}
         encoder={encoder}
         onEncoderChange={(e) => setEncoder(e.target.value)}
+        outputFormat={outputFormat}
+        onOutputFormatChange={(e) => setOutputFormat(e.target.value)}
+        publishDir={publishDir}
+        onBrowsePublishDir={handleBrowsePublishDir}
+        onClearPublishDir={() => setPublishDir('')}
+        fragmentInfo={fragmentInfo}
         onOpenLogModal={() => setIsLogModalOpen(true)}
         
         updateStatus={updateStatus}
@@ -841,6 +899,7 @@ function App() {
         
         urlQueue={urlQueue}
         onQueueChange={handleQueueChange}
+        prefetchStatus={prefetchStatus}
         splitMode={splitMode}
         onSplitModeChange={(e) => setSplitMode(e.target.value)}
         isPaused={isPaused}
@@ -1,12 +1,25 @@
 import React from 'react';
 import QueueManager from './QueueManager';
 
+// Thời gian còn lại dạng "1 giờ 05 phút" / "3 phút 20 giây"
+const formatRemaining = (seconds) => {
+  const total = Math.max(0, Math.round(seconds));
+  const hours = Math.floor(total / 3600);
+  const minutes = Math.floor((total % 3600) / 60);
+  if (hours > 0) return `${hours} giờ ${String(minutes).padStart(2, '0')} phút`;
+  if (minutes > 0) return `${minutes} phút ${String(total % 60).padStart(2, '0')} giây`;
+  return `${total % 60} giây`;
+};
+
 function ControlsPane(props) {
   const { 
     refs,
     log, isRendering,
-    statusText, progress,
+    statusText, progress, eta,
     encoder, onEncoderChange,
+    outputFormat, onOutputFormatChange,
+    publishDir, onBrowsePublishDir, onClearPublishDir,
+    fragmentInfo,
     onRunRender, onAddImage, onAddText, onBrowse, onReset,
     onOpenLogModal,
     splitMode, onSplitModeChange,
@@ -20,6 +33,7 @@ function ControlsPane(props) {
     // <<< NHẬN PROPS CHO QUẢN LÝ HÀNG CHỜ >>> 
     urlQueue,
     onQueueChange,
+    prefetchStatus,
     isPaused,
     onPauseToggle,
     // <<< NHẬN PROPS CHO BẬT/TẮT CHỮ "Part..." >>> 
@@ -34,6 +48,7 @@ function ControlsPane(props) {
       <QueueManager
         queue={urlQueue || []}
         onQueueChange={onQueueChange || (() => {})}
+        prefetchStatus={prefetchStatus || {}}
         isRendering={isRendering}
         isPaused={isPaused}
         disabled={isDownloadingUpdate || isUpdateAvailable}
@@ -94,6 +109,28 @@ function ControlsPane(props) {
         </select>
       </div>
 
+      <div className="control-group">
+        <label htmlFor="output-format-select">Định dạng xuất:</label>
+        <select id="output-format-select" value={outputFormat} onChange={onOutputFormatChange} disabled={isRendering || isDownloadingUpdate}>
+          <option value="mp4">MP4 thường</option>
+          <option value="fmp4">MP4 phân mảnh (dùng được khi đang ghi)</option>
+          <option value="hls">HLS / CMAF (segment + playlist)</option>
+        </select>
+      </div>
+
+      {outputFormat !== 'mp4' && (
+        <div className="control-group">
+          <label htmlFor="publish-dir-input">Chép fragment vào thư mục (tùy chọn):</label>
+          <div className="input-group">
+            <input type="text" id="publish-dir-input" value={publishDir} placeholder="Không chép" readOnly />
+            <button onClick={onBrowsePublishDir} disabled={isRendering || isDownloadingUpdate}>Chọn</button>
+            {publishDir && (
+              <button onClick={onClearPublishDir} disabled={isRendering || isDownloadingUpdate} title="Bỏ chọn">✕</button>
+            )}
+          </div>
+        </div>
+      )}
+
       <div className="control-group">
         <label htmlFor="save-path-input">Lưu vào thư mục:</label>
         <div className="input-group">
@@ -107,6 +144,17 @@ function ControlsPane(props) {
       <div className="status-container">
         {/* <<< SỬA ĐỔI: Ưu tiên hiển thị thông báo update/render >>> */}
         <p className="status-text">{updateStatus || (isRendering ? statusText : 'Sẵn sàng')}</p>
+        {isRendering && eta && Number.isFinite(eta.remaining) && (
+          <p className="status-text" style={{ fontSize: '12px', opacity: 0.8 }}>
+            Còn khoảng {formatRemaining(eta.remaining)}
+            {Number.isFinite(eta.finishAt) && ` (xong lúc ${new Date(eta.finishAt * 1000).toLocaleTimeString()})`}
+          </p>
+        )}
+        {isRendering && fragmentInfo && (
+          <p className="status-text" style={{ fontSize: '12px', opacity: 0.8 }}>
+            Part {fragmentInfo.part}: {fragmentInfo.count} fragment đã ghi{fragmentInfo.done ? ' (xong)' : ''}
+          </p>
+        )}
         <div className="progress-bar-container">
             <div className="progress-bar" style={{ width: `${progress}%` }}></div>
         </div>
@@ -1,6 +1,27 @@
 import React, { useState } from 'react';
 
-function QueueManager({ queue = [], onQueueChange, isRendering, isPaused, disabled }) {
+// Link http(s), file local (đường dẫn tuyệt đối / file://) hoặc tham chiếu media đã cache (cache:<id>)
+const isValidInput = (value) =>
+  /^(https?:\/\/|file:\/\/|cache:)/i.test(value) || /^([a-zA-Z]:[\\/]|\\\\|\/)/.test(value);
+
+// Nhãn trạng thái tải trước của item (main.js báo qua 'queue:prefetched')
+const PREFETCH_LABELS = {
+  pending: { text: '⏳ Đang tải trước', color: '#ffaa00', title: 'Đang tải trước input ở nền' },
+  done: { text: '✔ Đã tải trước', color: '#00ff88', title: 'Input đã có trong cache, tới lượt sẽ render ngay' },
+  failed: { text: '⚠ Tải trước lỗi', color: '#ff4444', title: 'Tải trước lỗi, job sẽ tự tải lại khi tới lượt' },
+};
+
+function PrefetchBadge({ status }) {
+  const label = PREFETCH_LABELS[status];
+  if (!label) return null;
+  return (
+    <div className="queue-item-url" style={{ fontSize: '11px', color: label.color }} title={label.title}>
+      {label.text}
+    </div>
+  );
+}
+
+function QueueManager({ queue = [], onQueueChange, isRendering, isPaused, disabled, prefetchStatus = {} }) {
   const [newAudioUrl, setNewAudioUrl] = useState('');
   const [newVideoUrl, setNewVideoUrl] = useState('');
   const [newVideoSpeed, setNewVideoSpeed] = useState('1.0');
@@ -15,8 +36,8 @@ function QueueManager({ queue = [], onQueueChange, isRendering, isPaused, disabl
       return;
     }
     
-    if (!audioInput.startsWith('http') || !videoInput.startsWith('http')) {
-      alert('Vui lòng nhập link YouTube hợp lệ (bắt đầu bằng http)');
+    if (!isValidInput(audioInput) || !isValidInput(videoInput)) {
+      alert('Vui lòng nhập link YouTube (bắt đầu bằng http), đường dẫn file local hoặc cache:<id>');
       return;
     }
     
@@ -83,7 +104,7 @@ function QueueManager({ queue = [], onQueueChange, isRendering, isPaused, disabl
           <input
             type="text"
             className="queue-input-single"
-            placeholder="Nhập link YouTube để tải Audio + Thumbnail..."
+            placeholder="Link YouTube hoặc file audio local để lấy Audio + Thumbnail..."
             value={newAudioUrl}
             onChange={(e) => setNewAudioUrl(e.target.value)}
             disabled={disabled}
@@ -95,7 +116,7 @@ function QueueManager({ queue = [], onQueueChange, isRendering, isPaused, disabl
             <input
               type="text"
               className="queue-input-single"
-              placeholder="Nhập link YouTube để tải Video..."
+              placeholder="Link YouTube hoặc file video local..."
               value={newVideoUrl}
               onChange={(e) => setNewVideoUrl(e.target.value)}
               disabled={disabled}
@@ -145,6 +166,7 @@ function QueueManager({ queue = [], onQueueChange, isRendering, isPaused, disabl
                   <strong>Link 2:</strong> {item.videoUrl.length > 50 ? `${item.videoUrl.substring(0, 50)}...` : item.videoUrl}
                   {item.videoSpeed && item.videoSpeed !== 1.0 && <span style={{ marginLeft: '10px', color: '#00ff88' }}>(x{item.videoSpeed})</span>}
                 </div>
+                <PrefetchBadge status={prefetchStatus[`${item.audioUrl}|${item.videoUrl}`]} />
               </div>
               <div className="queue-item-actions">
                 <button
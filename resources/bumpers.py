@@ -0,0 +1,81 @@
+"""
+Module intro/outro (bumper) - clip mở đầu / kết thúc của kênh được encode 1 lần theo đúng tham số encode của phần
+(lưu trong cache dẫn xuất), rồi ghép vào mỗi phần bằng concat -c copy: chỉ đoạn giữa của phần phải encode
+"""
+import os
+import subprocess
+
+from utils import get_executable_path
+from cache import fingerprint_file
+from process_runner import run_process
+from video_processor import run_command_with_live_output, write_concat_list, OUTPUT_WIDTH, OUTPUT_HEIGHT
+from publisher import keyframe_args, muxer_args
+
+BUMPER_KINDS = ('intro', 'outro')
+BUMPER_VERSION = 1
+# Audio của phần có bumper được encode cùng định dạng với bumper (nguồn audio mono / 44.1 kHz cũng vậy)
+AUDIO_FORMAT_ARGS = ['-ar', '48000', '-ac', '2']
+AUDIO_LAYOUT = 'stereo'
+
+def pinned_video_args(encoder):
+    """Profile (và level với libx264) cố định cho cả bumper lẫn phần: tham số rate control riêng của từng phần
+    không làm lệch SPS giữa các đoạn được ghép"""
+    if any(family in encoder for family in ('nvenc', 'amf', 'qsv')):
+        return ['-profile:v', 'high']
+    return ['-profile:v', 'high', '-level:v', '4.1']
+
+def resolve_bumper(path):
+    """Đường dẫn tuyệt đối của clip bumper (file trên máy)"""
+    resolved = os.path.abspath(os.path.expanduser(path))
+    if not os.path.isfile(resolved):
+        raise Exception(f"Không tìm thấy file bumper: {resolved}")
+    return resolved
+
+def bumper_params(source_path, encoder, fps, output_format):
+    """Khóa cache của 1 bumper đã encode: nguồn + mọi thứ quyết định định dạng stream của phần"""
+    return {
+        'source': fingerprint_file(source_path)[:16], 'encoder': encoder, 'fps': fps,
+        'size': [OUTPUT_WIDTH, OUTPUT_HEIGHT], 'audio': ' '.join(AUDIO_FORMAT_ARGS),
+        'keyframes': ' '.join(keyframe_args(output_format)), 'profile': ' '.join(pinned_video_args(encoder)),
+        'version': BUMPER_VERSION,
+    }
+
+def _has_audio(path, ffmpeg_path):
+    try:
+        ffprobe_path = get_executable_path("ffprobe", os.path.dirname(ffmpeg_path))
+        cmd = [ffprobe_path, '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_type',
+               '-of', 'csv=p=0', path]
+        returncode, _, _, lines = run_process(cmd, stall_timeout=30, echo_stdout=False, capture_stdout=True)
+        return returncode == 0 and any(line.strip() == 'audio' for line in lines)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+def encode_bumper(ffmpeg_path, source_path, output_path, fps, encoder, video_args, output_format):
+    """Encode bumper về khung / fps / profile / định dạng audio của phần (letterbox nếu khác tỉ lệ).
+    Clip không có audio được thêm khoảng lặng để mọi đoạn ghép đều có đủ stream"""
+    cmd = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error', '-stats', '-i', source_path]
+    has_audio = _has_audio(source_path, ffmpeg_path)
+    if not has_audio:
+        cmd += ['-f', 'lavfi', '-i', f"anullsrc=r={AUDIO_FORMAT_ARGS[1]}:cl={AUDIO_LAYOUT}"]
+    cmd += [
+        '-vf', (f"scale={OUTPUT_WIDTH}:{OUTPUT_HEIGHT}:force_original_aspect_ratio=decrease,"
+                f"pad={OUTPUT_WIDTH}:{OUTPUT_HEIGHT}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p"),
+        '-map', '0:v:0', '-map', '0:a:0' if has_audio else '1:a:0',
+    ]
+    cmd += video_args + pinned_video_args(encoder) + keyframe_args(output_format)
+    cmd += ['-c:a', 'aac', '-b:a', '192k'] + AUDIO_FORMAT_ARGS + ['-r', str(fps), '-shortest', output_path]
+    run_command_with_live_output(cmd)
+
+def join_bumpers(ffmpeg_path, body_path, intro_path, outro_path, output_path, output_format, list_path):
+    """Ghép intro + đoạn giữa + outro bằng concat demuxer, không encode lại"""
+    write_concat_list([path for path in (intro_path, body_path, outro_path) if path], list_path)
+    cmd = [
+        ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error', '-stats',
+        '-f', 'concat', '-safe', '0', '-i', list_path, '-map', '0', '-c', 'copy'
+    ] + muxer_args(output_format, output_path)
+    try:
+        run_command_with_live_output(cmd)
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
+    return output_path
@@ -0,0 +1,380 @@
+"""
+Module điều phối tài nguyên toàn hệ thống - cấp CPU, RAM, băng thông đĩa/mạng và phiên encoder phần cứng
+cho các bước chạy đồng thời theo tải thực tế của máy; số thread mỗi bước co giãn theo phần còn trống
+"""
+import os
+import sys
+import time
+import atexit
+import threading
+
+from metrics import record_admission
+
+# Giữ lại chừng này core cho hệ thống / giao diện
+CPU_RESERVE = 1
+# Số thread tối đa cho 1 tiến trình libx264 (nhiều hơn không nhanh thêm, chỉ tranh core của bước khác)
+MAX_THREADS_PER_STAGE = 6
+# Phần RAM vật lý pipeline được giữ chỗ
+RAM_BUDGET_RATIO = 0.75
+# RAM tối thiểu phải còn trống (đo thực tế) mới cho bước mới chạy
+RAM_FREE_MARGIN = 512 * 1024 ** 2
+# RAM ước lượng của từng loại bước
+STAGE_RAM = {
+    'render': 700 * 1024 ** 2,
+    'effects': 1536 * 1024 ** 2,
+    'transcode': 500 * 1024 ** 2,
+    'analysis': 300 * 1024 ** 2,
+    'download': 100 * 1024 ** 2,
+    'copy': 64 * 1024 ** 2,
+}
+# Băng thông đĩa (MB/s): ngân sách chung và mức ước lượng mỗi loại bước
+DISK_BUDGET_MBPS = 400
+STAGE_DISK_MBPS = {'render': 20, 'effects': 20, 'transcode': 40, 'download': 30, 'copy': 200}
+# Mạng: tổng số kết nối tải song song của mọi lượt tải
+NET_CONNECTION_BUDGET = 16
+# Số phiên encode đồng thời của mỗi loại encoder phần cứng (driver phổ thông)
+HW_SESSION_LIMITS = {'nvenc': 3, 'amf': 3, 'qsv': 3}
+# Chu kỳ đo lại tải CPU/RAM và làm mới file giữ phiên encoder
+SAMPLE_INTERVAL = 2.0
+# File giữ phiên encoder không được làm mới quá chừng này giây thì coi là của tiến trình đã chết
+SESSION_STALE_SECONDS = 30
+# Mức nice của tiến trình nền (tải trước) trên Unix
+BACKGROUND_NICE = 10
+
+def hw_family(encoder):
+    """Loại encoder phần cứng (nvenc/amf/qsv) hoặc None với encoder CPU"""
+    for family in HW_SESSION_LIMITS:
+        if encoder and family in encoder:
+            return family
+    return None
+
+class Grant:
+    """Phần tài nguyên đã cấp cho 1 bước; dùng như context manager để trả lại khi bước kết thúc"""
+
+    def __init__(self, governor, stage, needs, threads, connections):
+        self.governor = governor
+        self.stage = stage
+        self.needs = needs
+        self.threads = threads
+        self.connections = connections
+        self.session_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.governor.release(self)
+        return False
+
+class _CpuSampler:
+    """Số core đang bận trên toàn máy: psutil nếu có, /proc/stat trên Linux, loadavg trên Unix khác"""
+
+    def __init__(self):
+        self._last = None
+        try:
+            import psutil
+            psutil.cpu_percent(interval=None)
+            self._psutil = psutil
+        except ImportError:
+            self._psutil = None
+
+    def busy_cores(self, total):
+        if self._psutil:
+            return self._psutil.cpu_percent(interval=None) * total / 100
+        try:
+            with open('/proc/stat', 'r') as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+            idle = values[3] + (values[4] if len(values) > 4 else 0)
+            sample = (sum(values), idle)
+            last, self._last = self._last, sample
+            if last is None or sample[0] <= last[0]:
+                return None
+            return (1 - (sample[1] - last[1]) / (sample[0] - last[0])) * total
+        except (OSError, ValueError, IndexError):
+            pass
+        if hasattr(os, 'getloadavg'):
+            return min(float(total), os.getloadavg()[0])
+        return None
+
+def _memory_info():
+    """(tổng, còn trống) RAM vật lý tính bằng byte, None nếu không đo được"""
+    try:
+        import psutil
+        memory = psutil.virtual_memory()
+        return memory.total, memory.available
+    except ImportError:
+        pass
+    try:
+        info = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) * 1024
+        return info['MemTotal'], info.get('MemAvailable', info['MemFree'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+class ResourceGovernor:
+    """Cấp tài nguyên cho các bước (render, encode trung gian, tải, phân tích) của mọi job trong process.
+    Bước chỉ được chạy khi vừa mọi ngân sách: CPU còn trống (đã trừ tải của tiến trình khác đo thực tế),
+    RAM, băng thông đĩa, số kết nối mạng và phiên encoder phần cứng (giới hạn cả giữa các process qua file khóa).
+    Bước chờ được xét theo thứ tự đến; luôn cho chạy nếu chưa có bước nào giữ tài nguyên để không kẹt"""
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._granted = {}
+        self._active = []
+        self._waiting = []
+        self._ticket = 0
+        self._sampler = _CpuSampler()
+        self._external_cores = 0.0
+        self._free_ram = None
+        self._last_sample = 0.0
+        self._sessions_held = set()
+        self._heartbeat = None
+        self.configure()
+
+    def configure(self, max_cpu=None, ram_bytes=None, disk_mbps=None, net_connections=None, hw_sessions=None,
+                  lock_dir=None):
+        """Đặt ngân sách; giá trị None dùng mặc định theo máy. lock_dir: thư mục file khóa phiên encoder dùng chung"""
+        total_cores = os.cpu_count() or 4
+        memory = _memory_info()
+        with self._lock:
+            self.total_cores = total_cores
+            self.cpu_budget = float(max_cpu or max(1, total_cores - CPU_RESERVE))
+            self.ram_budget = ram_bytes or (memory[0] * RAM_BUDGET_RATIO if memory else None)
+            self.disk_budget = float(disk_mbps or DISK_BUDGET_MBPS)
+            self.net_budget = int(net_connections or NET_CONNECTION_BUDGET)
+            self.hw_limits = {family: int(hw_sessions or limit) for family, limit in HW_SESSION_LIMITS.items()}
+            self.lock_dir = lock_dir
+            self._lock.notify_all()
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    # --- ĐO TẢI ---
+    def _refresh(self):
+        """Đo lại tải CPU của tiến trình khác và RAM trống (gọi khi đang giữ _lock)"""
+        now = time.monotonic()
+        if now - self._last_sample < SAMPLE_INTERVAL:
+            return
+        self._last_sample = now
+        busy = self._sampler.busy_cores(self.total_cores)
+        if busy is not None:
+            # Phần bận không do các bước đang được cấp gây ra là tải bên ngoài
+            self._external_cores = max(0.0, busy - self._granted.get('cpu', 0))
+        memory = _memory_info()
+        self._free_ram = memory[1] if memory else None
+
+    def cpu_available(self):
+        """Số core còn trống cho bước mới (ít nhất 1)"""
+        with self._lock:
+            self._refresh()
+            return max(1, int(self._cpu_free()))
+
+    def _cpu_free(self):
+        return min(self.cpu_budget, self.total_cores - self._external_cores) - self._granted.get('cpu', 0)
+
+    # --- CẤP / TRẢ ---
+    def acquire(self, stage, cpu=0, ram=None, disk=None, net=0, encoder=None):
+        """Chờ tới khi đủ tài nguyên rồi trả về Grant. cpu/net: số nguyên hoặc (tối thiểu, tối đa);
+        Grant.threads / Grant.connections là phần thực cấp trong khoảng đó, theo mức còn trống lúc được cho chạy"""
+        cpu_min, cpu_max = cpu if isinstance(cpu, tuple) else (cpu, cpu)
+        net_min, net_max = net if isinstance(net, tuple) else (net, net)
+        needs = {
+            'cpu': cpu_min,
+            'ram': STAGE_RAM.get(stage, 0) if ram is None else ram,
+            'disk': STAGE_DISK_MBPS.get(stage, 0) if disk is None else disk,
+            'net': net_min,
+        }
+        family = hw_family(encoder)
+        if family:
+            needs['hw:' + family] = 1
+        started = time.monotonic()
+        with self._lock:
+            self._ticket += 1
+            ticket = (self._ticket, needs)
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    self._refresh()
+                    if self._admissible(ticket):
+                        session_path = self._take_session(family) if family else None
+                        if not family or session_path is not False:
+                            break
+                    self._lock.wait(SAMPLE_INTERVAL)
+            finally:
+                self._waiting.remove(ticket)
+            # Còn bước khác đang chờ CPU thì chỉ lấy phần chia đều, để nhiều bước chạy song song thay vì nối đuôi
+            cpu_waiters = sum(1 for _, other in self._waiting if other['cpu'])
+            threads = max(cpu_min, min(cpu_max, int(self._cpu_free() / (1 + cpu_waiters))))
+            connections = max(net_min, min(net_max, (self.net_budget - self._granted.get('net', 0)) // (1 + sum(
+                1 for _, other in self._waiting if other['net']))))
+            needs = dict(needs, cpu=threads, net=connections)
+            for key, value in needs.items():
+                self._granted[key] = self._granted.get(key, 0) + value
+            grant = Grant(self, stage, needs, threads, connections)
+            grant.session_path = session_path
+            self._active.append(grant)
+        record_admission(stage, time.monotonic() - started)
+        return grant
+
+    def release(self, grant):
+        with self._lock:
+            if grant not in self._active:
+                return
+            self._active.remove(grant)
+            for key, value in grant.needs.items():
+                self._granted[key] = self._granted.get(key, 0) - value
+            if grant.session_path:
+                self._sessions_held.discard(grant.session_path)
+                try:
+                    os.remove(grant.session_path)
+                except OSError:
+                    pass
+            self._lock.notify_all()
+
+    def _admissible(self, ticket):
+        number, needs = ticket
+        # Bước đến trước đang thiếu loại tài nguyên nào thì bước sau cần loại đó phải chờ sau nó;
+        # bước chỉ cần tài nguyên khác (ví dụ tải khi CPU đang kín) vẫn được chạy
+        for other_number, other in self._waiting:
+            if other_number < number and any(needs.get(key) for key in self._shortfalls(other)):
+                return False
+        return not self._active or not self._shortfalls(needs)
+
+    def _shortfalls(self, needs):
+        """Các loại tài nguyên hiện không đủ cho needs"""
+        short = set()
+        if needs['cpu'] and self._cpu_free() < needs['cpu']:
+            short.add('cpu')
+        if needs['ram'] and self.ram_budget:
+            if self._granted.get('ram', 0) + needs['ram'] > self.ram_budget:
+                short.add('ram')
+            elif self._free_ram is not None and self._free_ram - needs['ram'] < RAM_FREE_MARGIN:
+                short.add('ram')
+        if needs['disk'] and self._granted.get('disk', 0) + needs['disk'] > self.disk_budget:
+            short.add('disk')
+        if needs['net'] and self._granted.get('net', 0) + needs['net'] > self.net_budget:
+            short.add('net')
+        for key in needs:
+            if key.startswith('hw:') and self._granted.get(key, 0) >= self.hw_limits[key[3:]]:
+                short.add(key)
+        return short
+
+    def _take_session(self, family):
+        """Giữ 1 slot phiên encoder bằng file tạo độc quyền trong lock_dir (dùng chung mọi process trên máy).
+        Trả về đường dẫn file, None khi không dùng file khóa, False khi mọi slot đều bận"""
+        if not self.lock_dir:
+            return None
+        for slot in range(self.hw_limits[family]):
+            path = os.path.join(self.lock_dir, f"{family}.{slot}.lock")
+            try:
+                if time.time() - os.path.getmtime(path) > SESSION_STALE_SECONDS:
+                    os.remove(path)
+            except OSError:
+                pass
+            try:
+                with open(path, 'x') as f:
+                    f.write(str(os.getpid()))
+            except OSError:
+                continue
+            self._sessions_held.add(path)
+            self._start_heartbeat()
+            return path
+        return False
+
+    # --- JOB CHẠY NỀN / CHÍNH ---
+    def hold_foreground(self):
+        """Đánh dấu process này đang chạy job (file trong lock_dir, làm mới bằng heartbeat) để tiến trình nền
+        (tải trước hàng chờ) nhường tài nguyên cho tới khi process thoát"""
+        if not self.lock_dir:
+            return
+        path = os.path.join(self.lock_dir, f"foreground.{os.getpid()}.lock")
+        with open(path, 'w') as f:
+            f.write(str(os.getpid()))
+        with self._lock:
+            self._sessions_held.add(path)
+        self._start_heartbeat()
+
+        def remove():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        atexit.register(remove)
+
+    def foreground_active(self):
+        """Có process khác đang chạy job không (bỏ qua file của tiến trình đã chết)"""
+        if not self.lock_dir:
+            return False
+        own = f"foreground.{os.getpid()}.lock"
+        try:
+            names = os.listdir(self.lock_dir)
+        except OSError:
+            return False
+        for name in names:
+            if not name.startswith('foreground.') or name == own:
+                continue
+            try:
+                if time.time() - os.path.getmtime(os.path.join(self.lock_dir, name)) <= SESSION_STALE_SECONDS:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def _start_heartbeat(self):
+        """Làm mới định kỳ các file phiên encoder / đánh dấu job đang giữ để process khác không coi là bỏ quên"""
+        if self._heartbeat:
+            return
+
+        def loop():
+            while True:
+                time.sleep(SAMPLE_INTERVAL)
+                with self._lock:
+                    held = list(self._sessions_held)
+                for path in held:
+                    try:
+                        os.utime(path, None)
+                    except OSError:
+                        pass
+
+        self._heartbeat = threading.Thread(target=loop, name="governor-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def snapshot(self):
+        """Tài nguyên đang cấp / ngân sách, dùng cho log và metrics"""
+        with self._lock:
+            return {
+                'active': len(self._active), 'waiting': len(self._waiting),
+                'cpu': self._granted.get('cpu', 0), 'cpu_budget': self.cpu_budget,
+                'external_cpu': round(self._external_cores, 2),
+                'net': self._granted.get('net', 0), 'net_budget': self.net_budget,
+            }
+
+def lower_process_priority():
+    """Hạ ưu tiên CPU (và I/O nếu có psutil) của process hiện tại cho việc chạy nền"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil:
+        process = psutil.Process()
+        try:
+            if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+                process.ionice(psutil.IOPRIO_CLASS_IDLE)
+            elif hasattr(psutil, 'IOPRIO_VERYLOW'):
+                process.ionice(psutil.IOPRIO_VERYLOW)
+        except (psutil.Error, OSError):
+            pass
+        try:
+            process.nice(psutil.IDLE_PRIORITY_CLASS if sys.platform == 'win32' else BACKGROUND_NICE)
+            return
+        except (psutil.Error, OSError):
+            pass
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(BACKGROUND_NICE)
+        except OSError:
+            pass
+
+governor = ResourceGovernor()
@@ -0,0 +1,236 @@
+"""
+Module HTTP client dùng chung - giữ kết nối keep-alive, timeout, retry và cache có điều kiện (ETag/Last-Modified)
+"""
+import os
+import json
+import time
+import hashlib
+import shutil
+import threading
+import http.client
+import urllib.request
+from urllib.parse import urlsplit, urljoin
+from metrics import record_download, record_cache
+
+DEFAULT_TIMEOUT = 15
+DEFAULT_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+MAX_REDIRECTS = 5
+MAX_IDLE_PER_HOST = 4
+READ_CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) TrashVideoTool"
+
+class HttpError(Exception):
+    """Lỗi HTTP không thể retry (hoặc đã hết số lần retry)"""
+    def __init__(self, url, status, reason=""):
+        detail = f" ({reason})" if reason else ""
+        super().__init__(f"HTTP {status}{detail} khi tải {url}")
+        self.url = url
+        self.status = status
+
+class HttpSession:
+    """Session HTTP giữ pool kết nối theo host, an toàn khi dùng từ nhiều thread"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, cache_dir=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_dir = cache_dir
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._proxies = urllib.request.getproxies()
+
+    # --- POOL KẾT NỐI ---
+    def _pool_key(self, parts):
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return (parts.scheme, parts.hostname, port)
+
+    def _proxy_for(self, scheme, host):
+        """Proxy (đã tách host/port) cho scheme, None nếu không dùng proxy với host này"""
+        proxy = self._proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None
+        return urlsplit(proxy if '://' in proxy else f"http://{proxy}")
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        proxy = self._proxy_for(scheme, host)
+        if proxy and scheme == 'https':
+            # https qua proxy: mở tunnel bằng CONNECT
+            conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 8080, timeout=self.timeout)
+            conn.set_tunnel(host, port)
+            return conn
+        if proxy:
+            # http thường qua proxy: gửi request dạng absolute-URI tới proxy (đa số proxy chặn CONNECT tới cổng 80)
+            return http.client.HTTPConnection(proxy.hostname, proxy.port or 8080, timeout=self.timeout)
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_class(host, port, timeout=self.timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE_PER_HOST:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+    # --- REQUEST ---
+    def _request_once(self, url, headers, sink):
+        """Gửi 1 request GET, body được ghi vào sink (file-like) nếu status 200.
+        Trả về (status, headers, location)"""
+        parts = urlsplit(url)
+        key = self._pool_key(parts)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if parts.scheme == 'http' and self._proxy_for('http', parts.hostname):
+            path = f"http://{parts.netloc}{path}"
+        request_headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'identity'}
+        request_headers.update(headers)
+
+        conn, reused = self._acquire(key)
+        try:
+            try:
+                conn.request('GET', path, headers=request_headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # Kết nối keep-alive đã bị server đóng: mở kết nối mới, không tính là 1 lần retry
+                conn.close()
+                conn = self._new_connection(key)
+                conn.request('GET', path, headers=request_headers)
+                response = conn.getresponse()
+
+            if response.status == 200 and sink is not None:
+                while True:
+                    chunk = response.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+            else:
+                response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        return response.status, response.headers, response.headers.get('Location')
+
+    def _request(self, url, headers, sink_factory):
+        """GET có redirect và retry với backoff mũ cho lỗi mạng/timeout/5xx/429"""
+        attempt = 0
+        redirects = 0
+        while True:
+            sink = sink_factory()
+            try:
+                status, response_headers, location = self._request_once(url, headers, sink)
+            except (OSError, http.client.HTTPException) as e:
+                if sink is not None:
+                    sink.close()
+                if attempt >= self.retries:
+                    raise
+                print(f"WARNING: Lỗi kết nối khi tải {url} ({e}), thử lại...", flush=True)
+            else:
+                if status in (301, 302, 303, 307, 308) and location:
+                    if sink is not None:
+                        sink.close()
+                    redirects += 1
+                    if redirects > MAX_REDIRECTS:
+                        raise HttpError(url, status, "quá nhiều redirect")
+                    url = urljoin(url, location)
+                    continue
+                if status in RETRY_STATUSES and attempt < self.retries:
+                    if sink is not None:
+                        sink.close()
+                    print(f"WARNING: HTTP {status} khi tải {url}, thử lại...", flush=True)
+                else:
+                    return status, response_headers, sink
+            time.sleep(min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+            attempt += 1
+
+    # --- CACHE CÓ ĐIỀU KIỆN ---
+    def _cache_paths(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json"), os.path.join(self.cache_dir, f"{digest}.body")
+
+    def download(self, url, dest_path):
+        """Tải url về dest_path; nếu đã có trong cache thì chỉ hỏi lại server (304 = dùng bản cache)"""
+        meta, meta_path, body_path = None, None, None
+        headers = {}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            meta_path, body_path = self._cache_paths(url)
+            if os.path.exists(meta_path) and os.path.exists(body_path):
+                try:
+                    with open(meta_path, 'r', encoding='utf-8') as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    meta = None
+            if meta:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+        temp_path = dest_path + '.part'
+        started = time.monotonic()
+        try:
+            status, response_headers, sink = self._request(url, headers, lambda: open(temp_path, 'wb'))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        sink.close()
+
+        if meta:
+            record_cache('http', status == 304)
+        if status == 304 and meta:
+            os.remove(temp_path)
+            shutil.copyfile(body_path, dest_path)
+            return dest_path
+        if status != 200:
+            os.remove(temp_path)
+            raise HttpError(url, status)
+
+        os.replace(temp_path, dest_path)
+        record_download(urlsplit(url).netloc, 'http', os.path.getsize(dest_path), time.monotonic() - started)
+        etag, last_modified = response_headers.get('ETag'), response_headers.get('Last-Modified')
+        if self.cache_dir and (etag or last_modified):
+            shutil.copyfile(dest_path, body_path + '.tmp')
+            os.replace(body_path + '.tmp', body_path)
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'url': url, 'etag': etag, 'last_modified': last_modified}, f)
+            os.replace(meta_path + '.tmp', meta_path)
+        return dest_path
+
+_shared_session = None
+_shared_lock = threading.Lock()
+
+def get_session(cache_dir=None):
+    """Lấy session dùng chung trong process (tạo lần đầu với cache_dir đã cho)"""
+    global _shared_session
+    with _shared_lock:
+        if _shared_session is None:
+            _shared_session = HttpSession(cache_dir=cache_dir)
+        elif cache_dir and not _shared_session.cache_dir:
+            _shared_session.cache_dir = cache_dir
+        return _shared_session
@@ -0,0 +1,376 @@
+"""
+Module lưu job bền vững bằng SQLite - job/stage/part, claim nguyên tử cho nhiều tiến trình, retry và thống kê thời gian
+"""
+import os
+import json
+import time
+import threading
+
+DB_FILENAME = "jobs.sqlite3"
+DEFAULT_MAX_ATTEMPTS = 3
+# Job/phần đã claim mà không được gia hạn trong chừng này giây thì trả lại hàng chờ
+DEFAULT_LEASE_SECONDS = 120
+
+JOB_STATUSES = ('pending', 'running', 'done', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    external_id TEXT UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending',
+    priority INTEGER NOT NULL DEFAULT 0,
+    source TEXT,
+    options TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    claimed_by TEXT,
+    lease_until REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, priority DESC, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs (updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_jobs_source ON jobs (source);
+
+CREATE TABLE IF NOT EXISTS stages (
+    job_id INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    PRIMARY KEY (job_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS parts (
+    job_id INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    part_index INTEGER NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    output_path TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    PRIMARY KEY (job_id, part_index)
+);
+CREATE INDEX IF NOT EXISTS idx_parts_status ON parts (status);
+
+-- Thời gian thực tế của từng bước (units = số giây media / số byte đã xử lý), dùng để ước lượng thời gian cho job sau
+CREATE TABLE IF NOT EXISTS timings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    units REAL,
+    encoder TEXT,
+    recorded_at REAL NOT NULL,
+    resolution TEXT,
+    cpu_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS idx_timings_stage ON timings (stage, encoder, recorded_at DESC);
+"""
+
+def default_db_path(user_data_path):
+    return os.path.join(user_data_path, DB_FILENAME)
+
+class JobStore:
+    """Kho job dùng chung giữa các thread (1 kết nối + lock) và giữa các tiến trình (WAL + BEGIN IMMEDIATE)"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        # sqlite3 chỉ được nạp khi thực sự mở kho job, không tính vào thời gian khởi động của editor
+        import sqlite3
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Thêm cột mới vào kho tạo từ phiên bản cũ"""
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(timings)")}
+        for column, column_type in (('resolution', 'TEXT'), ('cpu_seconds', 'REAL')):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE timings ADD COLUMN {column} {column_type}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self):
+        return _Transaction(self)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    # --- JOB ---
+    def add_job(self, options, priority=0, source=None, external_id=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Thêm job vào hàng chờ, trả về id. external_id trùng thì trả về id của job đã có"""
+        now = time.time()
+        with self._transaction() as conn:
+            if external_id:
+                row = conn.execute("SELECT id FROM jobs WHERE external_id = ?", (external_id,)).fetchone()
+                if row:
+                    return row['id']
+            cursor = conn.execute(
+                "INSERT INTO jobs (external_id, priority, source, options, max_attempts, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (external_id, int(priority), source, json.dumps(options, ensure_ascii=False), int(max_attempts), now, now)
+            )
+            return cursor.lastrowid
+
+    def _requeue_expired(self, conn, now):
+        conn.execute(
+            "UPDATE jobs SET status = 'pending', claimed_by = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE status = 'running' AND lease_until < ?", (now, now)
+        )
+        conn.execute(
+            "UPDATE parts SET status = 'pending' WHERE status = 'running' AND job_id IN "
+            "(SELECT id FROM jobs WHERE status = 'pending')"
+        )
+
+    def claim_job(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Claim nguyên tử job pending có priority cao nhất (FIFO trong cùng priority). Trả về dict job hoặc None"""
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_expired(conn, now)
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'pending' ORDER BY priority DESC, id LIMIT 1"
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', claimed_by = ?, lease_until = ?, attempts = attempts + 1, "
+                "started_at = COALESCE(started_at, ?), updated_at = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, now, now, row['id'])
+            )
+            return self._job_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone())
+
+    def renew_lease(self, job_ids, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        if not job_ids:
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND claimed_by = ? AND status = 'running'",
+                [(now + lease_seconds, job_id, worker_id) for job_id in job_ids]
+            )
+
+    def complete_job(self, job_id):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = 'done', error = NULL, lease_until = NULL, finished_at = ?, updated_at = ? "
+            "WHERE id = ?", (now, now, job_id)
+        )
+
+    def fail_job(self, job_id, error):
+        """Ghi lỗi; còn lượt retry thì trả job về pending. Trả về True nếu job sẽ được chạy lại"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row:
+                return False
+            retry = row['attempts'] < row['max_attempts']
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, claimed_by = NULL, lease_until = NULL, updated_at = ?, "
+                "finished_at = ? WHERE id = ?",
+                ('pending' if retry else 'failed', str(error), now, None if retry else now, job_id)
+            )
+            conn.execute("UPDATE parts SET status = 'pending' WHERE job_id = ? AND status = 'running'", (job_id,))
+            return retry
+
+    def release_job(self, job_id):
+        """Trả job về hàng chờ mà không tính là 1 lần thử (ví dụ khi người dùng hủy giữa chừng)"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'pending', claimed_by = NULL, lease_until = NULL, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? WHERE id = ? AND status = 'running'",
+                (time.time(), job_id)
+            )
+            conn.execute("UPDATE parts SET status = 'pending' WHERE job_id = ? AND status = 'running'", (job_id,))
+
+    def cancel_job(self, job_id):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = 'cancelled', lease_until = NULL, updated_at = ?, finished_at = ? "
+            "WHERE id = ? AND status IN ('pending', 'running')", (now, now, job_id)
+        )
+
+    def get_job(self, job_id):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_dict(row) if row else None
+
+    def list_jobs(self, status=None, limit=100, offset=0):
+        """Danh sách job cho UI, mới cập nhật trước"""
+        if status:
+            rows = self._execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?", (status, limit, offset)
+            ).fetchall()
+        else:
+            rows = self._execute(
+                "SELECT * FROM jobs ORDER BY updated_at DESC LIMIT ? OFFSET ?", (limit, offset)
+            ).fetchall()
+        return [self._job_dict(row) for row in rows]
+
+    def count_by_status(self):
+        rows = self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    @staticmethod
+    def _job_dict(row):
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        return job
+
+    # --- STAGE ---
+    def start_stage(self, job_id, name):
+        self._execute(
+            "INSERT INTO stages (job_id, name, status, started_at) VALUES (?, ?, 'running', ?) "
+            "ON CONFLICT (job_id, name) DO UPDATE SET status = 'running', started_at = excluded.started_at, "
+            "finished_at = NULL, error = NULL", (job_id, name, time.time())
+        )
+
+    def finish_stage(self, job_id, name, error=None, units=None, encoder=None):
+        """Kết thúc stage; stage thành công được ghi thêm vào bảng timings"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT started_at FROM stages WHERE job_id = ? AND name = ?", (job_id, name)).fetchone()
+            conn.execute(
+                "UPDATE stages SET status = ?, finished_at = ?, error = ? WHERE job_id = ? AND name = ?",
+                ('failed' if error else 'done', now, str(error) if error else None, job_id, name)
+            )
+            if row and row['started_at'] and not error:
+                self._record_timing(conn, job_id, name, now - row['started_at'], units, encoder)
+
+    # --- PART ---
+    def set_parts(self, job_id, segments):
+        """Ghi kế hoạch cắt của job; phần đã xong từ lần chạy trước được giữ nguyên"""
+        with self._transaction() as conn:
+            existing = {
+                row['part_index']: row for row in
+                conn.execute("SELECT part_index, start, duration FROM parts WHERE job_id = ?", (job_id,))
+            }
+            for index, (start, duration) in enumerate(segments):
+                row = existing.get(index)
+                if row and abs(row['start'] - start) < 1e-6 and abs(row['duration'] - duration) < 1e-6:
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO parts (job_id, part_index, start, duration) VALUES (?, ?, ?, ?)",
+                    (job_id, index, start, duration)
+                )
+            conn.execute("DELETE FROM parts WHERE job_id = ? AND part_index >= ?", (job_id, len(segments)))
+
+    def finished_part_output(self, job_id, part_index):
+        """Đường dẫn kết quả nếu phần đã render xong ở lần chạy trước (và file còn tồn tại)"""
+        row = self._execute(
+            "SELECT output_path FROM parts WHERE job_id = ? AND part_index = ? AND status = 'done'", (job_id, part_index)
+        ).fetchone()
+        if row and row['output_path'] and os.path.exists(row['output_path']):
+            return row['output_path']
+        return None
+
+    def start_part(self, job_id, part_index):
+        self._execute(
+            "UPDATE parts SET status = 'running', attempts = attempts + 1, started_at = ?, error = NULL "
+            "WHERE job_id = ? AND part_index = ?", (time.time(), job_id, part_index)
+        )
+
+    def finish_part(self, job_id, part_index, output_path=None, error=None, encoder=None, resolution=None):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT started_at, duration FROM parts WHERE job_id = ? AND part_index = ?", (job_id, part_index)
+            ).fetchone()
+            conn.execute(
+                "UPDATE parts SET status = ?, output_path = ?, finished_at = ?, error = ? "
+                "WHERE job_id = ? AND part_index = ?",
+                ('failed' if error else 'done', output_path, now, str(error) if error else None, job_id, part_index)
+            )
+            if row and row['started_at'] and not error:
+                self._record_timing(conn, job_id, 'render_part', now - row['started_at'], row['duration'], encoder,
+                                    resolution=resolution)
+
+    def list_parts(self, job_id):
+        return [dict(row) for row in self._execute(
+            "SELECT * FROM parts WHERE job_id = ? ORDER BY part_index", (job_id,)
+        ).fetchall()]
+
+    # --- THỐNG KÊ ---
+    @staticmethod
+    def _record_timing(conn, job_id, stage, seconds, units, encoder, resolution=None, cpu_seconds=None):
+        conn.execute(
+            "INSERT INTO timings (job_id, stage, seconds, units, encoder, recorded_at, resolution, cpu_seconds) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, stage, seconds, units, encoder, time.time(), resolution, cpu_seconds)
+        )
+
+    def record_timing(self, stage, seconds, units=None, encoder=None, resolution=None, cpu_seconds=None, job_id=None):
+        """Ghi thời gian của 1 bước không gắn với stage/part trong kho (vd các bước con của prepare, job chạy lẻ)"""
+        with self._transaction() as conn:
+            self._record_timing(conn, job_id, stage, seconds, units, encoder, resolution, cpu_seconds)
+
+    def timing_stats(self, stage, encoder=None, limit=200):
+        """Thống kê các lần chạy gần nhất của stage: số mẫu, thời gian trung bình, giây xử lý trên mỗi giây media"""
+        sql = "SELECT seconds, units FROM timings WHERE stage = ?"
+        params = [stage]
+        if encoder:
+            sql += " AND encoder = ?"
+            params.append(encoder)
+        sql += " ORDER BY recorded_at DESC LIMIT ?"
+        params.append(limit)
+        rows = self._execute(sql, params).fetchall()
+        if not rows:
+            return None
+        seconds = [row['seconds'] for row in rows]
+        units = [row['units'] for row in rows if row['units']]
+        return {
+            'samples': len(rows),
+            'mean_seconds': sum(seconds) / len(seconds),
+            'seconds_per_unit': sum(seconds) / sum(units) if units else None,
+        }
+
+    def timing_samples(self, stage, encoder=None, resolution=None, limit=200):
+        """Các mẫu (units, seconds, cpu_seconds) gần nhất của stage"""
+        sql = "SELECT units, seconds, cpu_seconds FROM timings WHERE stage = ? AND units IS NOT NULL"
+        params = [stage]
+        if encoder:
+            sql += " AND encoder = ?"
+            params.append(encoder)
+        if resolution:
+            sql += " AND resolution = ?"
+            params.append(resolution)
+        sql += " ORDER BY recorded_at DESC LIMIT ?"
+        params.append(limit)
+        return [(row['units'], row['seconds'], row['cpu_seconds']) for row in self._execute(sql, params).fetchall()]
+
+class _Transaction:
+    """BEGIN IMMEDIATE giữ khóa ghi ngay từ đầu, nên claim giữa nhiều tiến trình không bị trùng"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        try:
+            self.store._conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.store._lock.release()
+            raise
+        return self.store._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.store._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.store._lock.release()
+        return False
@@ -0,0 +1,148 @@
+"""
+Module input local - file trên máy / NAS và tham chiếu media đã cache thay cho link: probe rồi link (hardlink,
+reflink hoặc symlink, không bao giờ copy) vào thư mục job, bỏ qua hoàn toàn yt-dlp và bước tải
+"""
+import os
+import sys
+import json
+import subprocess
+from urllib.parse import urlparse, unquote
+
+from utils import get_executable_path
+from cache import fingerprint_file
+from process_runner import run_process
+from video_processor import get_video_duration
+
+# cache:<id> trỏ tới media đã tải trước đó trong thư mục cache media (cùng cách đặt tên với prepare_job)
+CACHE_REF_PREFIX = 'cache:'
+MEDIA_SUFFIXES = {'audio': '_audio.mp3', 'video': '_video.mp4', 'thumbnail': '_thumb.jpg'}
+# Ảnh đi kèm file audio (cùng tên) dùng làm thumbnail
+THUMBNAIL_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# ioctl FICLONE của Linux (btrfs, xfs, ...): file mới dùng chung block với file gốc
+FICLONE = 0x40049409
+
+def is_local_input(ref):
+    """Input không phải link http(s): đường dẫn file, file:// hoặc cache:<id>"""
+    return bool(ref) and not ref.lower().startswith(('http://', 'https://'))
+
+def _resolve_path(ref, kind, media_dir):
+    if ref.startswith(CACHE_REF_PREFIX):
+        media_id = ref[len(CACHE_REF_PREFIX):].strip()
+        path = os.path.join(media_dir, f"{media_id}{MEDIA_SUFFIXES[kind]}")
+        if not os.path.exists(path):
+            raise Exception(f"Không có {kind} '{media_id}' trong cache media")
+        return media_id, path
+    if ref.lower().startswith('file://'):
+        # urllib.request kéo theo ssl / http.client: chỉ nạp khi thật sự gặp file:// URL
+        from urllib.request import url2pathname
+        parsed = urlparse(ref)
+        path = url2pathname(unquote((f"//{parsed.netloc}" if parsed.netloc else '') + parsed.path))
+    else:
+        path = os.path.expanduser(ref)
+    path = os.path.abspath(path)
+    if not os.path.isfile(path):
+        raise Exception(f"Không tìm thấy file: {path}")
+    return None, path
+
+def _probe_height(path, ffmpeg_path):
+    """Chiều cao stream video đầu tiên (None nếu không có / không đọc được)"""
+    try:
+        ffprobe_path = get_executable_path("ffprobe", os.path.dirname(ffmpeg_path))
+        cmd = [ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=height',
+               '-of', 'json', path]
+        returncode, _, _, lines = run_process(cmd, stall_timeout=30, echo_stdout=False, capture_stdout=True)
+        if returncode != 0:
+            return None
+        streams = json.loads(''.join(lines) or '{}').get('streams') or []
+        return int(streams[0]['height']) if streams and streams[0].get('height') else None
+    except (OSError, ValueError, KeyError, subprocess.TimeoutExpired):
+        return None
+
+def local_input_info(ref, kind, media_dir, ffmpeg_path):
+    """Metadata của input local giống phần prepare_job dùng từ yt-dlp: id, title, duration, height, path.
+    id theo nội dung file nên cùng 1 file ở đường dẫn khác vẫn trúng cache phân tích / video dẫn xuất"""
+    media_id, path = _resolve_path(ref, kind, media_dir)
+    duration = get_video_duration(path, ffmpeg_path)
+    if duration <= 0:
+        raise Exception(f"Không đọc được file {kind}: {path}")
+    thumbnail = None
+    if kind == 'audio':
+        if media_id:
+            cached_thumbnail = os.path.join(media_dir, f"{media_id}{MEDIA_SUFFIXES['thumbnail']}")
+            thumbnail = cached_thumbnail if os.path.exists(cached_thumbnail) else None
+        else:
+            stem = os.path.splitext(path)[0]
+            thumbnail = next((stem + ext for ext in THUMBNAIL_EXTENSIONS if os.path.exists(stem + ext)), None)
+    return {
+        'id': media_id or f"local-{fingerprint_file(path)[:16]}",
+        'title': media_id or os.path.splitext(os.path.basename(path))[0],
+        'duration': duration,
+        'height': _probe_height(path, ffmpeg_path) if kind == 'video' else None,
+        'path': path,
+        'thumbnail_path': thumbnail,
+        'local': True,
+    }
+
+def _reflink(src, dest):
+    """Bản sao copy-on-write (không chép dữ liệu) nếu hệ thống file hỗ trợ"""
+    if sys.platform.startswith('linux'):
+        import fcntl
+        try:
+            with open(src, 'rb') as s, open(dest, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError:
+            pass
+    elif sys.platform == 'darwin':
+        import ctypes
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.clonefile(os.fsencode(src), os.fsencode(dest), 0) == 0:
+                return True
+        except (OSError, AttributeError):
+            pass
+    if os.path.exists(dest):
+        os.remove(dest)
+    return False
+
+def link_file(src, dest):
+    """Đưa src vào dest không copy: hardlink, reflink, rồi symlink. Trả về (đường dẫn dùng được, cách link);
+    không link được (khác ổ, không có quyền symlink) thì dùng thẳng file gốc"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return dest, 'hardlink'
+    except OSError:
+        pass
+    if _reflink(src, dest):
+        return dest, 'reflink'
+    try:
+        os.symlink(src, dest)
+        return dest, 'symlink'
+    except (OSError, NotImplementedError):
+        return src, 'direct'
+
+def link_local_input(info, kind, temp_dir):
+    """Link file của input local vào thư mục job (tên ổn định, không ký tự lạ cho ffmpeg)"""
+    ext = os.path.splitext(info['path'])[1] or ('.mp3' if kind == 'audio' else '.mp4')
+    path, method = link_file(info['path'], os.path.join(temp_dir, f"{info['id']}_{kind}{ext}"))
+    print(f"STATUS: Dùng {kind} local ({method}): {info['path']}", flush=True)
+    return path
+
+def local_thumbnail(info, temp_dir, ffmpeg_path, fallback_video=None):
+    """Thumbnail cho audio local: ảnh đi kèm (link nếu là jpg, đổi sang jpg nếu không), ảnh bìa nhúng trong file,
+    cuối cùng là frame đầu của video nền"""
+    dest = os.path.join(temp_dir, f"{info['id']}_thumb.jpg")
+    source = info.get('thumbnail_path')
+    if source and source.lower().endswith(('.jpg', '.jpeg')):
+        return link_file(source, dest)[0]
+    candidates = [source] if source else []
+    candidates += [info['path']] + ([fallback_video] if fallback_video else [])
+    for candidate in candidates:
+        cmd = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error', '-i', candidate, '-map', '0:v:0',
+               '-frames:v', '1', '-q:v', '2', dest]
+        returncode, _, _, _ = run_process(cmd, stall_timeout=60, echo_stdout=False)
+        if returncode == 0 and os.path.exists(dest) and os.path.getsize(dest) > 0:
+            return dest
+    raise Exception(f"Không tạo được thumbnail cho {info['path']}")
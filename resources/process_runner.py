@@ -0,0 +1,216 @@
+"""
+Module chạy tiến trình con (ffmpeg/ffprobe) bằng asyncio - log giới hạn, watchdog khi treo, tạm dừng/tiếp tục/hủy
+"""
+import sys
+import os
+import re
+import json
+import signal
+import threading
+import subprocess
+from collections import deque
+
+# Chỉ giữ phần cuối log để báo lỗi, bộ nhớ không tăng theo thời gian render
+LOG_TAIL_LINES = 200
+# Không có output trong chừng này giây (không tính lúc tạm dừng) thì coi là treo
+DEFAULT_STALL_TIMEOUT = 300
+CONTROL_POLL_INTERVAL = 0.2
+READ_CHUNK_SIZE = 4096
+FFMPEG_TIME_REGEX = re.compile(r"time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})")
+
+class ProcessCancelled(Exception):
+    """Tiến trình bị hủy theo lệnh CANCEL"""
+
+class ProcessControl:
+    """Trạng thái điều khiển dùng chung cho mọi tiến trình con đang chạy trong process này"""
+
+    def __init__(self):
+        self.paused = threading.Event()
+        self.cancelled = threading.Event()
+        # Hàm nhận job mới qua lệnh "SUBMIT <json>" (chỉ dùng ở chế độ hàng chờ)
+        self.submit_handler = None
+
+    def handle_command(self, command):
+        command = command.strip()
+        if command[:7].upper() == 'SUBMIT ' and self.submit_handler:
+            try:
+                self.submit_handler(json.loads(command[7:]))
+            except Exception as e:
+                print(f"WARNING: Không thể nhận job mới: {e}", flush=True)
+            return
+        command = command.upper()
+        if command == 'PAUSE':
+            self.paused.set()
+            print("STATUS: Đã tạm dừng.", flush=True)
+        elif command == 'RESUME':
+            self.paused.clear()
+            print("STATUS: Tiếp tục xử lý...", flush=True)
+        elif command == 'CANCEL':
+            self.cancelled.set()
+            self.paused.clear()
+            print("STATUS: Đang hủy...", flush=True)
+
+    def wait_if_paused(self):
+        """Chặn trước khi khởi chạy tiến trình mới nếu đang tạm dừng"""
+        while self.paused.is_set() and not self.cancelled.is_set():
+            self.cancelled.wait(CONTROL_POLL_INTERVAL)
+        if self.cancelled.is_set():
+            raise ProcessCancelled("Đã hủy theo yêu cầu")
+
+control = ProcessControl()
+
+def start_control_listener(stream=None):
+    """Đọc lệnh PAUSE/RESUME/CANCEL từ stdin (mỗi dòng 1 lệnh) trong thread nền"""
+    stream = stream or sys.stdin
+    if stream is None:
+        return
+
+    def listen():
+        try:
+            for line in stream:
+                control.handle_command(line)
+        except (OSError, ValueError):
+            pass
+
+    threading.Thread(target=listen, name="process-control", daemon=True).start()
+
+# --- ĐIỀU KHIỂN NHÓM TIẾN TRÌNH ---
+def _spawn_kwargs():
+    if sys.platform == 'win32':
+        return {'creationflags': subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+def _windows_suspend(pid, suspend):
+    import ctypes
+    PROCESS_SUSPEND_RESUME = 0x0800
+    handle = ctypes.windll.kernel32.OpenProcess(PROCESS_SUSPEND_RESUME, False, pid)
+    if not handle:
+        return
+    try:
+        if suspend:
+            ctypes.windll.ntdll.NtSuspendProcess(handle)
+        else:
+            ctypes.windll.ntdll.NtResumeProcess(handle)
+    finally:
+        ctypes.windll.kernel32.CloseHandle(handle)
+
+def _suspend(process):
+    if sys.platform == 'win32':
+        _windows_suspend(process.pid, True)
+    else:
+        os.killpg(process.pid, signal.SIGSTOP)
+
+def _resume(process):
+    if sys.platform == 'win32':
+        _windows_suspend(process.pid, False)
+    else:
+        os.killpg(process.pid, signal.SIGCONT)
+
+def _terminate(process):
+    try:
+        if sys.platform == 'win32':
+            subprocess.run(['taskkill', '/T', '/F', '/PID', str(process.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           creationflags=subprocess.CREATE_NO_WINDOW)
+        else:
+            # Tiến trình đang bị SIGSTOP phải được CONT thì mới nhận SIGTERM
+            os.killpg(process.pid, signal.SIGCONT)
+            os.killpg(process.pid, signal.SIGTERM)
+    except (ProcessLookupError, OSError):
+        pass
+
+# --- CHẠY TIẾN TRÌNH ---
+async def _run_async(cmd, total_duration, stall_timeout, echo_stdout, capture_stdout, stdout_sink=None):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **_spawn_kwargs()
+    )
+    stdout_tail = deque(maxlen=LOG_TAIL_LINES)
+    stderr_tail = deque(maxlen=LOG_TAIL_LINES)
+    captured = [] if capture_stdout else None
+    state = {'last_output': loop.time(), 'stalled': False, 'cancelled': False}
+
+    def handle_line(line, is_stderr):
+        if is_stderr:
+            if total_duration:
+                match = FFMPEG_TIME_REGEX.search(line)
+                if match:
+                    h, m, s, ms = map(int, match.groups())
+                    current_time_seconds = h * 3600 + m * 60 + s + ms / 100
+                    percent = min(100, (current_time_seconds / total_duration) * 100)
+                    print(f"PROGRESS:RENDER:{'%.2f' % percent}", flush=True)
+                    return
+            stderr_tail.append(line)
+            return
+        stdout_tail.append(line)
+        if captured is not None:
+            captured.append(line)
+        elif echo_stdout:
+            print(line, flush=True)
+
+    async def read_stream(stream, is_stderr):
+        # ffmpeg dùng '\r' cho dòng tiến độ nên tách theo cả '\r' và '\n'
+        buffer = b''
+        while True:
+            chunk = await stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            state['last_output'] = loop.time()
+            if stdout_sink and not is_stderr:
+                # Stdout nhị phân (PCM, ...): giao nguyên từng đoạn, không tách dòng
+                stdout_sink(chunk)
+                continue
+            buffer += chunk
+            pieces = re.split(rb'[\r\n]', buffer)
+            buffer = pieces.pop()
+            for piece in pieces:
+                line = piece.decode('utf-8', errors='replace').strip()
+                if line:
+                    handle_line(line, is_stderr)
+        line = buffer.decode('utf-8', errors='replace').strip()
+        if line:
+            handle_line(line, is_stderr)
+
+    readers = asyncio.gather(read_stream(process.stdout, False), read_stream(process.stderr, True))
+    wait_task = asyncio.ensure_future(process.wait())
+    suspended = False
+    while not wait_task.done():
+        await asyncio.wait([wait_task], timeout=CONTROL_POLL_INTERVAL)
+        if wait_task.done():
+            break
+        if control.cancelled.is_set():
+            state['cancelled'] = True
+            _terminate(process)
+            break
+        if control.paused.is_set() and not suspended:
+            _suspend(process)
+            suspended = True
+        elif not control.paused.is_set() and suspended:
+            _resume(process)
+            suspended = False
+            state['last_output'] = loop.time()
+        if not suspended and stall_timeout and loop.time() - state['last_output'] > stall_timeout:
+            state['stalled'] = True
+            _terminate(process)
+            break
+
+    returncode = await wait_task
+    await readers
+    return returncode, stdout_tail, stderr_tail, captured, state
+
+def run_process(cmd, total_duration=None, stall_timeout=DEFAULT_STALL_TIMEOUT, echo_stdout=True, capture_stdout=False,
+                stdout_sink=None):
+    """Chạy cmd tới khi kết thúc. Trả về (returncode, stdout_tail, stderr_tail, stdout đầy đủ nếu capture_stdout).
+    stdout_sink: hàm nhận từng đoạn bytes của stdout (dữ liệu nhị phân), thay cho việc đọc theo dòng"""
+    # asyncio chỉ được nạp khi chạy tiến trình đầu tiên, không tính vào thời gian khởi động
+    import asyncio
+    control.wait_if_paused()
+    returncode, stdout_tail, stderr_tail, captured, state = asyncio.run(
+        _run_async(cmd, total_duration, stall_timeout, echo_stdout, capture_stdout, stdout_sink)
+    )
+    if state['cancelled']:
+        raise ProcessCancelled("Đã hủy theo yêu cầu")
+    if state['stalled']:
+        raise subprocess.TimeoutExpired(cmd, stall_timeout, output='\n'.join(stdout_tail), stderr='\n'.join(stderr_tail))
+    return returncode, list(stdout_tail), list(stderr_tail), captured
@@ -0,0 +1,302 @@
+"""
+Module xuất theo fragment - theo dõi file fMP4 / playlist HLS (CMAF) ffmpeg đang ghi và gọi hook
+(thư mục, HTTP PUT, dòng FRAGMENT: cho app) với mỗi fragment đã hoàn chỉnh trong lúc phần vẫn đang encode
+"""
+import os
+import json
+import shutil
+import struct
+import threading
+from urllib.parse import quote
+
+OUTPUT_FORMATS = ('mp4', 'fmp4', 'hls')
+# Độ dài mỗi fragment / segment (giây): keyframe được ép đúng nhịp này để cắt fragment đều
+FRAGMENT_SECONDS = 2
+POLL_INTERVAL = 0.5
+PUBLISH_TIMEOUT = 30
+HLS_PLAYLIST_NAME = "index.m3u8"
+HLS_INIT_NAME = "init.mp4"
+
+def is_fragmented(output_format):
+    return output_format in ('fmp4', 'hls')
+
+def keyframe_args(output_format):
+    """Ép keyframe mỗi FRAGMENT_SECONDS giây để mỗi fragment bắt đầu bằng keyframe (đặt cạnh tham số encoder video)"""
+    if not is_fragmented(output_format):
+        return []
+    return ['-force_key_frames', f"expr:gte(t,n_forced*{FRAGMENT_SECONDS})"]
+
+def muxer_args(output_format, output_path):
+    """Tham số muxer + đích cuối lệnh ffmpeg. fmp4: moov rỗng ở đầu nên file dùng được ngay, không cần remux faststart;
+    hls: output_path là playlist, segment fMP4 (CMAF) nằm cùng thư mục"""
+    if output_format == 'fmp4':
+        return ['-movflags', '+frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', output_path]
+    if output_format == 'hls':
+        segment_dir = os.path.dirname(output_path)
+        return [
+            '-f', 'hls', '-hls_time', str(FRAGMENT_SECONDS), '-hls_playlist_type', 'event',
+            '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', HLS_INIT_NAME,
+            '-hls_flags', 'independent_segments+temp_file',
+            '-hls_segment_filename', os.path.join(segment_dir, 'seg_%05d.m4s'), output_path
+        ]
+    return [output_path]
+
+def part_output_path(output_dir, title, part_num, output_format):
+    """Đường dẫn kết quả 1 phần: file .mp4, hoặc playlist trong thư mục riêng với HLS"""
+    if output_format == 'hls':
+        return os.path.join(output_dir, f"{title}_Part_{part_num}", HLS_PLAYLIST_NAME)
+    return os.path.join(output_dir, f"{title}_Part_{part_num}.mp4")
+
+def prepare_output(output_format, output_path):
+    """Dọn kết quả cũ của lần render trước (fragment cũ không được trộn với fragment mới)"""
+    if output_format == 'hls':
+        shutil.rmtree(os.path.dirname(output_path), ignore_errors=True)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    elif os.path.exists(output_path):
+        os.remove(output_path)
+
+# --- ĐỌC FRAGMENT ---
+def _read_box_header(f, offset, file_size):
+    """(kiểu box, kích thước) của box bắt đầu tại offset, None nếu header chưa ghi xong"""
+    if offset + 8 > file_size:
+        return None
+    f.seek(offset)
+    size, box_type = struct.unpack('>I4s', f.read(8))
+    if size == 1:
+        if offset + 16 > file_size:
+            return None
+        size = struct.unpack('>Q', f.read(8))[0]
+    elif size == 0:
+        # Box kéo dài tới hết file: chỉ biết kích thước khi ffmpeg đã ghi xong
+        return None
+    return box_type.decode('latin-1'), size
+
+class _Mp4Scanner:
+    """Tách file fMP4 đang ghi thành init (ftyp+moov) và các fragment (moof+mdat) đã ghi đủ byte"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.group_start = 0
+        self.init_done = False
+
+    def scan(self):
+        found = []
+        try:
+            file_size = os.path.getsize(self.path)
+            f = open(self.path, 'rb')
+        except OSError:
+            return found
+        with f:
+            while True:
+                header = _read_box_header(f, self.offset, file_size)
+                if header is None or self.offset + header[1] > file_size:
+                    break
+                box_type, size = header
+                self.offset += size
+                if box_type == 'moov' and not self.init_done:
+                    self.init_done = True
+                    found.append(('init', self.group_start, self.offset - self.group_start))
+                    self.group_start = self.offset
+                elif box_type == 'mdat' and self.init_done:
+                    found.append(('media', self.group_start, self.offset - self.group_start))
+                    self.group_start = self.offset
+                elif box_type == 'mfra':
+                    # Chỉ mục cuối file, không phải fragment
+                    self.group_start = self.offset
+        return found
+
+class _HlsScanner:
+    """Segment được liệt kê trong playlist là đã ghi xong (ffmpeg ghi segment ra .tmp rồi mới đổi tên)"""
+
+    def __init__(self, playlist_path):
+        self.playlist_path = playlist_path
+        self.seen = set()
+        self.init_done = False
+
+    def scan(self):
+        found = []
+        try:
+            with open(self.playlist_path, 'r', encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+        except OSError:
+            return found
+        segment_dir = os.path.dirname(self.playlist_path)
+        for line in lines:
+            if line.startswith('#EXT-X-MAP:') and not self.init_done:
+                self.init_done = True
+                found.append(('init', os.path.join(segment_dir, HLS_INIT_NAME)))
+            elif line and not line.startswith('#') and line not in self.seen:
+                self.seen.add(line)
+                found.append(('media', os.path.join(segment_dir, line)))
+        return found
+
+# --- HOOK ---
+def stdout_hook(event):
+    """Báo cho app qua stdout: FRAGMENT:<json>"""
+    print(f"FRAGMENT:{json.dumps(event, ensure_ascii=False)}", flush=True)
+
+def _fragment_bytes(event):
+    with open(event['source'], 'rb') as f:
+        f.seek(event.get('offset', 0))
+        return f.read(event['size'])
+
+class DirectoryHook:
+    """Ghi mỗi fragment thành 1 file trong publish_dir/<tên phần>/ (init.mp4, frag_00001.m4s, ...) kèm playlist HLS
+    để công cụ upload/đóng gói xử lý ngay; file chỉ xuất hiện khi đã ghi đủ (ghi .tmp rồi đổi tên)"""
+
+    def __init__(self, publish_dir):
+        self.publish_dir = publish_dir
+
+    def __call__(self, event):
+        target_dir = os.path.join(self.publish_dir, event['name'])
+        os.makedirs(target_dir, exist_ok=True)
+        if event['kind'] == 'end':
+            if event.get('playlist'):
+                _write_atomic(os.path.join(target_dir, HLS_PLAYLIST_NAME), event['playlist'].encode('utf-8'))
+            return
+        _write_atomic(os.path.join(target_dir, event['file']), _fragment_bytes(event))
+        if event.get('playlist'):
+            _write_atomic(os.path.join(target_dir, HLS_PLAYLIST_NAME), event['playlist'].encode('utf-8'))
+
+class HttpHook:
+    """PUT mỗi fragment tới <base_url>/<tên phần>/<file>, kèm playlist HLS cập nhật sau mỗi fragment"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def _put(self, name, file_name, body, content_type, headers=None):
+        # urllib.request (kéo theo ssl, http.client) chỉ được nạp khi thật sự có URL để công bố
+        import urllib.request
+        url = f"{self.base_url}/{quote(name)}/{quote(file_name)}"
+        request = urllib.request.Request(url, data=body, method='PUT', headers=dict(headers or {}, **{
+            'Content-Type': content_type, 'Content-Length': str(len(body)),
+        }))
+        with urllib.request.urlopen(request, timeout=PUBLISH_TIMEOUT) as response:
+            response.read()
+
+    def __call__(self, event):
+        if event['kind'] != 'end':
+            self._put(event['name'], event['file'], _fragment_bytes(event), 'video/mp4', {
+                'X-Fragment-Index': str(event['index']), 'X-Part': str(event['part']),
+            })
+        if event.get('playlist'):
+            self._put(event['name'], HLS_PLAYLIST_NAME, event['playlist'].encode('utf-8'), 'application/vnd.apple.mpegurl')
+
+def _write_atomic(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def _media_playlist(fragments, ended):
+    """Playlist HLS (CMAF) cho các fragment đã công bố của 1 file fMP4"""
+    target = max([FRAGMENT_SECONDS] + [int(d + 0.999) for d in (f['duration'] for f in fragments) if d])
+    lines = [
+        '#EXTM3U', '#EXT-X-VERSION:7', f'#EXT-X-TARGETDURATION:{target}', '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:EVENT', '#EXT-X-INDEPENDENT-SEGMENTS', f'#EXT-X-MAP:URI="{HLS_INIT_NAME}"',
+    ]
+    for fragment in fragments:
+        lines += [f"#EXTINF:{fragment['duration'] or FRAGMENT_SECONDS:.3f},", fragment['file']]
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    return "\n".join(lines) + "\n"
+
+def build_hooks(publish_dir=None, publish_url=None):
+    """Danh sách hook theo cấu hình: luôn báo qua stdout, thêm thư mục / HTTP nếu có"""
+    hooks = [stdout_hook]
+    if publish_dir:
+        hooks.append(DirectoryHook(publish_dir))
+    if publish_url:
+        hooks.append(HttpHook(publish_url))
+    return hooks
+
+# --- THEO DÕI ---
+class FragmentPublisher:
+    """Theo dõi output của 1 phần trong lúc ffmpeg ghi (thread nền), gọi từng hook theo đúng thứ tự fragment.
+    Hook lỗi chỉ cảnh báo, không làm hỏng bước render"""
+
+    def __init__(self, output_format, output_path, part_num, hooks):
+        self.output_format = output_format
+        self.output_path = output_path
+        self.part_num = part_num
+        self.hooks = hooks
+        if output_format == 'hls':
+            self.name = os.path.basename(os.path.dirname(output_path))
+            self._scanner = _HlsScanner(output_path)
+        else:
+            self.name = os.path.splitext(os.path.basename(output_path))[0]
+            self._scanner = _Mp4Scanner(output_path)
+        self._fragments = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.failed_hooks = 0
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._loop, name=f"publish-part{self.part_num}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        if exc_type is None:
+            # ffmpeg đã thoát: quét lần cuối rồi báo phần đã xong
+            self._publish_new()
+            self._emit({
+                'kind': 'end', 'part': self.part_num, 'name': self.name, 'path': self.output_path,
+                'fragments': len(self._fragments), 'playlist': self._playlist(ended=True),
+            })
+        return False
+
+    def _loop(self):
+        while not self._stop.wait(POLL_INTERVAL):
+            self._publish_new()
+
+    def _publish_new(self):
+        for found in self._scanner.scan():
+            kind = found[0]
+            index = len(self._fragments)
+            event = {'kind': kind, 'part': self.part_num, 'name': self.name, 'path': self.output_path}
+            if self.output_format == 'hls':
+                event.update(source=found[1], file=os.path.basename(found[1]), offset=0, size=os.path.getsize(found[1]))
+            else:
+                event.update(source=self.output_path, offset=found[1], size=found[2],
+                             file=HLS_INIT_NAME if kind == 'init' else f"frag_{index:05d}.m4s")
+            if kind == 'media':
+                event['index'] = index
+                event['duration'] = self._fragment_duration(event)
+                self._fragments.append(event)
+            event['playlist'] = self._playlist(ended=False) if kind == 'media' else None
+            self._emit(event)
+
+    def _fragment_duration(self, event):
+        if self.output_format != 'hls':
+            return None
+        # Lấy từ #EXTINF ngay trước tên segment trong playlist của ffmpeg
+        try:
+            with open(self.output_path, 'r', encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+            position = lines.index(event['file'])
+            return float(lines[position - 1].split(':', 1)[1].rstrip(','))
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _playlist(self, ended):
+        if self.output_format == 'hls':
+            try:
+                with open(self.output_path, 'r', encoding='utf-8') as f:
+                    return f.read()
+            except OSError:
+                return None
+        return _media_playlist(self._fragments, ended)
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            # Dòng stdout không cần nội dung playlist
+            payload = {k: v for k, v in event.items() if k != 'playlist'} if hook is stdout_hook else event
+            try:
+                hook(payload)
+            except Exception as e:
+                self.failed_hooks += 1
+                print(f"WARNING: Hook xuất fragment lỗi (Part {self.part_num}, {event.get('file', event['kind'])}): {e}", flush=True)
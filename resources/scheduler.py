@@ -0,0 +1,150 @@
+"""
+Module lập lịch render - ưu tiên theo priority, chia đều giữa các nguồn, giành slot giữa các phần
+"""
+import itertools
+import threading
+import traceback
+
+# Priority lớn hơn được chạy trước (ví dụ: 10 = gấp, 0 = bình thường, -10 = back-catalog)
+DEFAULT_PRIORITY = 0
+
+class RenderJob:
+    """1 job gồm bước chuẩn bị (tải, phân tích) rồi tới từng phần render độc lập.
+    prepare() trả về số phần; render_part(i) render phần thứ i"""
+
+    def __init__(self, job_id, prepare, render_part, priority=DEFAULT_PRIORITY, source=None,
+                 on_done=None, on_error=None):
+        self.job_id = job_id
+        self.prepare = prepare
+        self.render_part = render_part
+        self.priority = priority
+        self.source = source or job_id
+        self.on_done = on_done
+        self.on_error = on_error
+        self.prepared = False
+        self.preparing = False
+        self.total_parts = None
+        self.next_part = 0
+        self.running = 0
+        self.finished_parts = []
+        self.failed = False
+        self.error = None
+
+    def has_pending_task(self):
+        if self.failed:
+            return False
+        if not self.prepared:
+            return not self.preparing
+        return self.next_part < self.total_parts
+
+    def is_finished(self):
+        if self.failed:
+            return self.running == 0
+        return self.prepared and self.next_part >= self.total_parts and self.running == 0
+
+class JobScheduler:
+    """Chia max_workers slot cho các job. Mỗi task là 1 bước chuẩn bị hoặc 1 phần, nên job ưu tiên cao
+    nộp vào giữa chừng sẽ chiếm slot ngay khi 1 phần của job khác xong (các phần đã xong được giữ nguyên)"""
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max(1, int(max_workers))
+        self._jobs = []
+        self._lock = threading.Condition()
+        self._running = 0
+        self._closed = False
+        self._order = itertools.count()
+        # Số task "đã được phục vụ" của mỗi nguồn, dùng để chia đều giữa các nguồn cùng priority
+        self._served = {}
+
+    def submit(self, job):
+        with self._lock:
+            job.order = next(self._order)
+            # Nguồn mới bắt đầu từ mức phục vụ thấp nhất hiện có để không chiếm trọn slot của nguồn cũ
+            if job.source not in self._served:
+                self._served[job.source] = min(self._served.values(), default=0)
+            self._jobs.append(job)
+            self._lock.notify_all()
+
+    def close(self):
+        """Không nhận thêm job; run() kết thúc khi các job hiện có xong"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(1 for job in self._jobs if not job.is_finished())
+
+    def _pick_task(self):
+        """Chọn (job, loại task, chỉ số phần): priority cao nhất, rồi nguồn ít được phục vụ nhất, rồi FIFO"""
+        candidates = [
+            (-job.priority, self._served[job.source], job.order, job)
+            for job in self._jobs if job.has_pending_task()
+        ]
+        if not candidates:
+            return None
+        job = min(candidates, key=lambda c: c[:3])[3]
+        self._served[job.source] += 1
+        job.running += 1
+        if not job.prepared:
+            job.preparing = True
+            return job, 'prepare', None
+        index = job.next_part
+        job.next_part += 1
+        return job, 'part', index
+
+    def _run_task(self, job, kind, index):
+        try:
+            if kind == 'prepare':
+                total_parts = job.prepare()
+                with self._lock:
+                    job.total_parts = int(total_parts)
+                    job.prepared = True
+                    job.preparing = False
+            else:
+                result = job.render_part(index)
+                with self._lock:
+                    job.finished_parts.append((index, result))
+        except Exception as e:
+            with self._lock:
+                if not job.failed:
+                    job.failed = True
+                    job.error = e
+            if not job.on_error:
+                traceback.print_exc()
+        finally:
+            with self._lock:
+                job.running -= 1
+                self._running -= 1
+                finished = job.is_finished()
+                if finished:
+                    self._jobs.remove(job)
+                    # Nguồn không còn job chờ / đang chạy: bỏ bộ đếm để hàng chờ chạy lâu không phình theo số nguồn
+                    if not any(other.source == job.source for other in self._jobs):
+                        self._served.pop(job.source, None)
+                self._lock.notify_all()
+            # Callback chỉ gọi 1 lần, khi không còn task nào của job đang chạy
+            if finished and job.failed and job.on_error:
+                job.on_error(job, job.error)
+            elif finished and not job.failed and job.on_done:
+                job.on_done(job)
+
+    def run(self):
+        """Chạy tới khi hết job (và đã close()). Trả về khi mọi task kết thúc"""
+        threads = []
+        with self._lock:
+            while True:
+                task = None
+                if self._running < self.max_workers:
+                    task = self._pick_task()
+                if task:
+                    self._running += 1
+                    thread = threading.Thread(target=self._run_task, args=task, daemon=True)
+                    threads = [t for t in threads if t.is_alive()] + [thread]
+                    thread.start()
+                    continue
+                if self._closed and not self._jobs:
+                    break
+                self._lock.wait()
+        for thread in threads:
+            thread.join()
@@ -1,54 +1,33 @@
 """
 Module xử lý video với ffmpeg
 """
-import sys
 import os
 import subprocess
-import re
-import threading
 from utils import get_executable_path, hex_to_ffmpeg_color, ffmpeg_safe_path
+from process_runner import run_process, ProcessCancelled, DEFAULT_STALL_TIMEOUT
 
-def run_command_with_live_output(cmd, total_duration=None):
-    """Chạy command và hiển thị output real-time, track progress nếu có"""
-    creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
-        encoding='utf-8', errors='replace', creationflags=creationflags
-    )
-    stdout_output, stderr_output = [], []
-    ffmpeg_time_regex = re.compile(r"time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})")
-    
-    def stream_reader(stream, output_list, is_stderr=False):
-        for line in iter(stream.readline, ''):
-            trimmed_line = line.strip()
-            output_list.append(trimmed_line)
-            
-            if total_duration and is_stderr:
-                match = ffmpeg_time_regex.search(trimmed_line)
-                if match:
-                    h, m, s, ms = map(int, match.groups())
-                    current_time_seconds = h * 3600 + m * 60 + s + ms / 100
-                    percent = min(100, (current_time_seconds / total_duration) * 100)
-                    print(f"PROGRESS:RENDER:{'%.2f' % percent}", flush=True)
-                    continue
-            
-            if trimmed_line and not is_stderr: 
-                print(trimmed_line, flush=True)
-                
-    stdout_thread = threading.Thread(target=stream_reader, args=(process.stdout, stdout_output))
-    stderr_thread = threading.Thread(target=stream_reader, args=(process.stderr, stderr_output, True))
-    stdout_thread.start()
-    stderr_thread.start()
-    stdout_thread.join()
-    stderr_thread.join()
-    process.wait()
+# Khung hình đầu ra của mọi phần
+OUTPUT_WIDTH = 720
+OUTPUT_HEIGHT = 1280
+OUTPUT_FPS = 30
+# Layout không có video nào nhìn thấy (audio + ảnh tĩnh): encode ở fps thấp, không có gì chuyển động
+STILL_FPS = 5
+# Placeholder của 2 nguồn tải từ link: video nền (link 2) và thumbnail (link 1)
+SOURCE_PLACEHOLDERS = ('video-placeholder', 'thumbnail-placeholder')
+# Các layer video cùng nguồn + tốc độ dùng chung 1 lần decode (split trong graph) khi offset lệch nhau không quá
+# chừng này giây đầu ra; lệch nhiều hơn thì split phải giữ quá nhiều frame chờ, mở input riêng (seek) rẻ hơn
+SHARED_DECODE_MAX_SKEW = 5.0
+
+def run_command_with_live_output(cmd, total_duration=None, stall_timeout=DEFAULT_STALL_TIMEOUT):
+    """Chạy command và hiển thị output real-time, track progress nếu có (tạm dừng/hủy theo lệnh điều khiển)"""
+    returncode, stdout_output, stderr_output, _ = run_process(cmd, total_duration=total_duration, stall_timeout=stall_timeout)
     
-    if process.returncode != 0:
+    if returncode != 0:
         for line in stderr_output:
             if line: 
                 print(f"FFMPEG_ERROR: {line}", flush=True)
         raise subprocess.CalledProcessError(
-            process.returncode, cmd, 
+            returncode, cmd, 
             output='\n'.join(stdout_output), 
             stderr='\n'.join(stderr_output)
         )
@@ -61,47 +40,247 @@ def get_video_duration(video_path, ffmpeg_path):
             ffprobe_path, '-v', 'error', '-show_entries', 'format=duration',
             '-of', 'default=noprint_wrappers=1:nokey=1', video_path
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        duration = float(result.stdout.strip())
+        _, _, _, stdout_lines = run_process(cmd, stall_timeout=60, capture_stdout=True)
+        duration = float('\n'.join(stdout_lines).strip())
         return duration
+    except ProcessCancelled:
+        raise
     except Exception as e:
         print(f"WARNING: Không thể lấy độ dài video: {e}", flush=True)
         return 0
 
-def build_ffmpeg_filter(layout, input_map, start, duration, part_num, resources_path):
-    """Xây dựng filter complex cho ffmpeg từ layout"""
-    layout.sort(key=lambda x: int(x.get('zIndex', 0)))
-    filters, last_stream = ["color=s=720x1280:c=black[canvas]"], "canvas"
+def get_video_fps(video_path, ffmpeg_path):
+    """Lấy frame rate của stream video đầu tiên bằng ffprobe (None nếu không đọc được)"""
+    try:
+        ffprobe_path = get_executable_path("ffprobe", os.path.dirname(ffmpeg_path))
+        cmd = [
+            ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=avg_frame_rate',
+            '-of', 'default=noprint_wrappers=1:nokey=1', video_path
+        ]
+        _, _, _, stdout_lines = run_process(cmd, stall_timeout=60, capture_stdout=True)
+        num, _, den = '\n'.join(stdout_lines).strip().partition('/')
+        fps = float(num) / float(den or 1)
+        return fps if fps > 0 else None
+    except ProcessCancelled:
+        raise
+    except Exception as e:
+        print(f"WARNING: Không thể lấy frame rate video: {e}", flush=True)
+        return None
+
+def get_video_bitrate(video_path, ffmpeg_path):
+    """Bitrate (kbps) của riêng stream video, tính từ kích thước packet (không decode). None nếu không đọc được"""
+    try:
+        ffprobe_path = get_executable_path("ffprobe", os.path.dirname(ffmpeg_path))
+        cmd = [
+            ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=size',
+            '-of', 'csv=p=0', video_path
+        ]
+        _, _, _, stdout_lines = run_process(cmd, stall_timeout=60, echo_stdout=False, capture_stdout=True)
+        total_bytes = sum(int(line.strip().rstrip(',')) for line in stdout_lines if line.strip())
+        duration = get_video_duration(video_path, ffmpeg_path)
+        return total_bytes * 8 / 1000 / duration if duration > 0 else None
+    except ProcessCancelled:
+        raise
+    except Exception as e:
+        print(f"WARNING: Không thể đo bitrate video: {e}", flush=True)
+        return None
+
+# --- TỐI ƯU FILTER GRAPH ---
+def _layer_rect(item):
+    """Khung (left, top, right, bottom) của layer trên canvas"""
+    x = float(item.get('x', 0) or 0)
+    y = float(item.get('y', 0) or 0)
+    w = float(item.get('width', OUTPUT_WIDTH) or 0)
+    h = float(item.get('height', OUTPUT_HEIGHT) or 0)
+    return (x, y, x + w, y + h)
+
+def _clip_to_canvas(rect):
+    left, top = max(rect[0], 0), max(rect[1], 0)
+    right, bottom = min(rect[2], OUTPUT_WIDTH), min(rect[3], OUTPUT_HEIGHT)
+    if right <= left or bottom <= top:
+        return None
+    return (left, top, right, bottom)
+
+def _subtract_rect(rect, cover):
+    """Phần còn lại của rect sau khi bỏ vùng cover (tối đa 4 hình chữ nhật)"""
+    left, top, right, bottom = rect
+    c_left, c_top = max(cover[0], left), max(cover[1], top)
+    c_right, c_bottom = min(cover[2], right), min(cover[3], bottom)
+    if c_right <= c_left or c_bottom <= c_top:
+        return [rect]
+    pieces = [
+        (left, top, right, c_top),
+        (left, c_bottom, right, bottom),
+        (left, c_top, c_left, c_bottom),
+        (c_right, c_top, right, c_bottom),
+    ]
+    return [p for p in pieces if p[2] > p[0] and p[3] > p[1]]
+
+def _is_covered(rect, covers):
+    remaining = [rect]
+    for cover in covers:
+        remaining = [piece for r in remaining for piece in _subtract_rect(r, cover)]
+        if not remaining:
+            return True
+    return False
+
+def _is_opaque(item):
+    """Video và thumbnail (jpg) luôn che kín khung của chúng; ảnh chỉ chắc chắn đục nếu là jpeg"""
+    if item.get('type') == 'video' or item.get('id') == 'thumbnail-placeholder':
+        return True
+    source = item.get('source') or ''
+    return source.startswith('data:image/jpeg') or source.startswith('data:image/jpg')
+
+def plan_visible_layers(layout, input_map):
+    """Bỏ các layer nằm ngoài canvas hoặc bị layer đục phía trên che hết.
+    Trả về list (item, khung layer, phần nhìn thấy) theo thứ tự zIndex tăng dần"""
+    layers = [
+        item for item in sorted(layout, key=lambda x: int(x.get('zIndex', 0)))
+        if item.get('type') != 'text' and item.get('id') in input_map
+    ]
+    visible, covers = [], []
+    # Duyệt từ trên xuống để biết vùng nào đã bị che
+    for item in reversed(layers):
+        rect = _layer_rect(item)
+        clipped = _clip_to_canvas(rect)
+        if clipped is None or _is_covered(clipped, covers):
+            continue
+        visible.append((item, rect, clipped))
+        if _is_opaque(item):
+            covers.append(clipped)
+    visible.reverse()
+    return visible
+
+def _source_layer_ids(layout):
+    """Id các layer lấy hình từ input của lệnh render (placeholder, layer video, ảnh data URI)"""
+    ids = set(SOURCE_PLACEHOLDERS)
+    ids.update(
+        item['id'] for item in layout
+        if item.get('type') == 'video'
+        or item.get('type') == 'image' and (item.get('source') or '').startswith('data:image')
+    )
+    return ids
+
+def plan_video_streams(layout, default_speed=1.0):
+    """Gom các layer video nhìn thấy thành stream đọc từ nguồn. Mỗi layer video có source (None = link 2),
+    speed (mặc định default_speed) và offset (giây nguồn bỏ qua ở đầu). Layer cùng nguồn + tốc độ, offset gần nhau
+    dùng chung 1 stream. Trả về list dict: source, speed, lead (giây đầu ra bỏ qua ở đầu bản đã đổi tốc độ),
+    layers {id layer: lead riêng tính từ lead của stream}, size (khung lớn nhất các layer chiếm)"""
+    groups = {}
+    for item, rect, _ in plan_visible_layers(layout, _source_layer_ids(layout)):
+        if item['type'] != 'video':
+            continue
+        speed = float(item.get('speed') or default_speed)
+        lead = max(0.0, float(item.get('offset') or 0)) / speed
+        groups.setdefault((item.get('source') or None, speed), []).append((lead, item['id'], rect))
+    streams = []
+    for (source, speed), layers in groups.items():
+        current = None
+        for lead, item_id, rect in sorted(layers, key=lambda layer: layer[0]):
+            if current is None or lead - current['lead'] > SHARED_DECODE_MAX_SKEW:
+                current = {'source': source, 'speed': speed, 'lead': lead, 'layers': {}, 'size': (0, 0)}
+                streams.append(current)
+            current['layers'][item_id] = round(lead - current['lead'], 6)
+            current['size'] = (max(current['size'][0], rect[2] - rect[0]), max(current['size'][1], rect[3] - rect[1]))
+    return streams
+
+def visible_video_area(layout):
+    """Số pixel đầu ra do video nền chiếm (phần nhìn thấy trên canvas), dùng để quy đổi độ phức tạp ra bitrate"""
+    area = 0.0
+    for item, _, clipped in plan_visible_layers(layout, _source_layer_ids(layout)):
+        if item['type'] == 'video':
+            area += (clipped[2] - clipped[0]) * (clipped[3] - clipped[1])
+    return area
+
+def plan_layout_inputs(layout):
+    """Nguồn nào thực sự hiện trên canvas và khung lớn nhất của nó: {id: (rộng, cao)}.
+    Placeholder / ảnh nằm ngoài canvas hoặc bị layer đục che hết không có trong kết quả nên không cần tải hay decode"""
+    usage = {}
+    for item, rect, _ in plan_visible_layers(layout, _source_layer_ids(layout)):
+        width, height = usage.get(item['id'], (0, 0))
+        usage[item['id']] = (max(width, rect[2] - rect[0]), max(height, rect[3] - rect[1]))
+    return usage
+
+def _layer_chain(item, rect, clipped, input_label, start, duration, source_fps):
+    """Chuỗi filter cho 1 layer: trim + giảm fps trước, rồi cắt phần ngoài canvas trước khi scale"""
+    chain = []
+    if item['type'] == 'video':
+        chain.append(f"trim=start={start}:duration={duration},setpts=PTS-STARTPTS")
+        # Hạ fps ngay từ đầu để scale/overlay chỉ xử lý số frame thực sự xuất ra
+        if source_fps is None or source_fps > OUTPUT_FPS + 0.01:
+            chain.append(f"fps={OUTPUT_FPS}")
+    width, height = rect[2] - rect[0], rect[3] - rect[1]
+    if clipped != rect:
+        # Phần nằm ngoài canvas được cắt ở kích thước gốc, tính theo tỉ lệ với khung layer
+        crop_w = (clipped[2] - clipped[0]) / width
+        crop_h = (clipped[3] - clipped[1]) / height
+        crop_x = (clipped[0] - rect[0]) / width
+        crop_y = (clipped[1] - rect[1]) / height
+        chain.append(f"crop=iw*{crop_w:.6f}:ih*{crop_h:.6f}:iw*{crop_x:.6f}:ih*{crop_y:.6f}")
+    out_w = int(round(clipped[2] - clipped[0]))
+    out_h = int(round(clipped[3] - clipped[1]))
+    chain.append(f"scale={out_w}:{out_h},setsar=1")
+    return f"[{input_label}]" + ",".join(chain)
+
+def build_audio_chain(start, duration, audio_filter=None):
+    """Chuỗi filter nhánh audio của 1 phần: cắt theo mốc rồi áp audio_filter (chuẩn hoá loudness)"""
+    audio_chain = f"atrim=start={start}:duration={duration},asetpts=PTS-STARTPTS"
+    if audio_filter:
+        audio_chain += f",{audio_filter}"
+    return audio_chain
+
+def build_ffmpeg_filter(layout, input_map, start, duration, part_num, resources_path, audio_filter=None, source_fps=None,
+                        include_audio=True, fps=OUTPUT_FPS, video_timing=None):
+    """Xây dựng filter complex cho ffmpeg từ layout (audio_filter: chuỗi filter thêm vào cuối nhánh audio).
+    Graph được rút gọn: bỏ layer bị che/ngoài canvas, dùng video phủ kín canvas làm nền thay cho color,
+    hạ fps và cắt trước khi scale. include_audio=False: chỉ dựng nhánh video (render theo chunk).
+    fps: fps của nền color (STILL_FPS khi layout chỉ có ảnh tĩnh).
+    video_timing: {id layer video: (mốc trim trong input, fps nguồn)} khi input đã được seek sẵn;
+    input dùng cho nhiều layer được decode 1 lần rồi split"""
+    layers = plan_visible_layers(layout, input_map)
+    filters = []
     overlay_count = 0
+    video_timing = video_timing or {}
     
-    # Xử lý video và image
-    for item in layout:
-        if item.get('type') == 'text' or item.get('id') not in input_map: 
+    # Input dùng chung cho nhiều layer: split 1 lần, mỗi layer lấy 1 nhánh
+    input_labels = {}
+    users = {}
+    for item, _, _ in layers:
+        users.setdefault(input_map[item['id']], []).append(item['id'])
+    for input_index, item_ids in users.items():
+        if len(item_ids) == 1:
+            input_labels[item_ids[0]] = f"{input_index}:v"
             continue
-        
-        input_index = input_map.get(item['id'])
-        w = item.get('width', 720) 
-        h = item.get('height', 1280)
-        x = item.get('x', 0) 
-        y = item.get('y', 0) 
-        
+        branches = [f"in{input_index}_{i}" for i in range(len(item_ids))]
+        filters.append(f"[{input_index}:v]split={len(item_ids)}" + "".join(f"[{b}]" for b in branches))
+        input_labels.update(zip(item_ids, branches))
+
+    def layer_chain(item, rect, clipped):
+        layer_start, layer_fps = video_timing.get(item['id'], (start, source_fps))
+        return _layer_chain(item, rect, clipped, input_labels[item['id']], layer_start, duration, layer_fps)
+    
+    # Xử lý video và image
+    base = layers[0] if layers else None
+    full_canvas = (0, 0, OUTPUT_WIDTH, OUTPUT_HEIGHT)
+    if base and base[0]['type'] == 'video' and base[2] == full_canvas:
+        # Video phủ kín canvas: dùng trực tiếp làm nền, không cần color + overlay
+        item, rect, clipped = base
+        # Giữ yuv420p như khi nền là color (nguồn 4:4:4/10-bit không làm đổi định dạng đầu ra)
+        filters.append(f"{layer_chain(item, rect, clipped)},format=yuv420p[bg0]")
+        last_stream = "bg0"
+        layers = layers[1:]
+    else:
+        filters.append(f"color=s={OUTPUT_WIDTH}x{OUTPUT_HEIGHT}:c=black:r={fps}[canvas]")
+        last_stream = "canvas"
+    
+    for item, rect, clipped in layers:
         scaled_stream, output_stream = f"s{overlay_count}", f"bg{overlay_count + 1}"
-        
-        # Ưu tiên GPU: sử dụng GPU-accelerated scale nếu có NVIDIA GPU
-        # scale_npp chỉ hoạt động với CUDA frames (cần hwaccel cuda)
-        # Nếu không có CUDA, dùng CPU scale
-        scale_filter = f"scale={w}:{h},setsar=1"
-        
-        if item['type'] == 'video': 
-            filters.append(f"[{input_index}:v]trim=start={start}:duration={duration},setpts=PTS-STARTPTS,{scale_filter}[{scaled_stream}]")
-        else: 
-            filters.append(f"[{input_index}:v]{scale_filter}[{scaled_stream}]") 
-        
-        filters.append(f"[{last_stream}][{scaled_stream}]overlay={x}:{y}[{output_stream}]")
+        filters.append(f"{layer_chain(item, rect, clipped)}[{scaled_stream}]")
+        filters.append(f"[{last_stream}][{scaled_stream}]overlay={clipped[0]:g}:{clipped[1]:g}[{output_stream}]")
         last_stream, overlay_count = output_stream, overlay_count + 1
     
     # Xử lý text
-    for item in layout:
+    for item in sorted(layout, key=lambda x: int(x.get('zIndex', 0))):
         if item.get('type') == 'text':
             style = item.get("textStyle", {})
             content = item.get("content", " ")
@@ -156,10 +335,31 @@ def build_ffmpeg_filter(layout, input_map, start, duration, part_num, resources_
             last_stream = output_stream
             overlay_count += 1
     
-    if last_stream != "canvas": 
-        filters.append(f"[{last_stream}]copy[final_v]")
-    else: 
-        filters.append(f"[canvas]copy[final_v]")
-    filters.append(f"[0:a]atrim=start={start}:duration={duration},asetpts=PTS-STARTPTS[final_a]")
+    # Đổi nhãn đầu ra cuối cùng thành final_v thay vì thêm 1 filter copy
+    filters[-1] = filters[-1][:-len(f"[{last_stream}]")] + "[final_v]"
+    if include_audio:
+        filters.append(f"[0:a]{build_audio_chain(start, duration, audio_filter)}[final_a]")
     return ";".join(filters), "final_v"
 
+
+# --- RENDER THEO CHUNK ---
+def plan_chunks(duration, chunk_count, fps=OUTPUT_FPS):
+    """Chia 1 phần thành chunk_count đoạn, mốc nằm đúng lưới frame đầu ra để ghép lại không lệch timestamp.
+    Trả về list (offset giây, số frame)"""
+    total_frames = max(1, int(round(duration * fps)))
+    chunk_count = max(1, min(int(chunk_count), total_frames))
+    chunks = []
+    first_frame = 0
+    for i in range(1, chunk_count + 1):
+        end_frame = total_frames * i // chunk_count
+        chunks.append((first_frame / fps, end_frame - first_frame))
+        first_frame = end_frame
+    return chunks
+
+def write_concat_list(paths, list_path):
+    """Ghi file danh sách cho concat demuxer"""
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in paths:
+            safe_path = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{safe_path}'\n")
+    return list_path
@@ -0,0 +1,225 @@
+"""
+Module phân tích audio - envelope năng lượng (RMS), đo loudness và chọn điểm cắt tại khoảng lặng
+"""
+import os
+import json
+import math
+from metrics import record_cache
+from process_runner import run_process
+
+# Audio được decode 1 lần thành PCM mono tần số thấp, đủ để đo năng lượng
+ANALYSIS_SAMPLE_RATE = 8000
+# Mỗi điểm của envelope ứng với 1 cửa sổ 50ms
+ENVELOPE_WINDOW = 0.05
+# Số cửa sổ xử lý mỗi lần đọc pipe (giới hạn bộ nhớ ~ 1.6MB mỗi chunk)
+CHUNK_WINDOWS = 2048
+# Ngưỡng coi là khoảng lặng (dBFS) và độ dài làm mượt envelope khi tìm điểm cắt
+SILENCE_THRESHOLD_DB = -40.0
+SMOOTHING_SECONDS = 0.3
+# Khi không có khoảng lặng, chỉ dời mốc nếu chỗ mới nhỏ tiếng hơn ít nhất chừng này dB
+MIN_QUIETER_DB = 6.0
+# Khoảng an toàn giữa trần sample peak của limiter và trần true peak yêu cầu
+TRUE_PEAK_MARGIN_DB = 1.0
+
+def envelope_cache_path(cache_dir, audio_id):
+    window_ms = int(ENVELOPE_WINDOW * 1000)
+    return os.path.join(cache_dir, f"{audio_id}_envelope_{ANALYSIS_SAMPLE_RATE}_{window_ms}ms.npy")
+
+def _loudness_cache_path(cache_dir, audio_id):
+    return os.path.join(cache_dir, f"{audio_id}_loudness.json")
+
+def analysis_cached(cache_dir, audio_id, want_envelope=True, want_loudness=True):
+    """True nếu mọi phần phân tích được yêu cầu đã có trong cache"""
+    return ((not want_envelope or os.path.exists(envelope_cache_path(cache_dir, audio_id)))
+            and (not want_loudness or os.path.exists(_loudness_cache_path(cache_dir, audio_id))))
+
+def _parse_loudnorm_output(stderr_text):
+    """Lấy khối JSON mà filter loudnorm in ra stderr khi kết thúc"""
+    start = stderr_text.rfind('{')
+    end = stderr_text.rfind('}')
+    if start < 0 or end < start:
+        raise Exception("Không đọc được kết quả đo loudness từ ffmpeg")
+    data = json.loads(stderr_text[start:end + 1])
+    return {
+        'integrated': float(data['input_i']),
+        'true_peak': float(data['input_tp']),
+        'lra': float(data['input_lra']),
+    }
+
+class _EnvelopeReader:
+    """Nhận PCM s16le theo từng đoạn từ stdout của ffmpeg và tính RMS cho từng cửa sổ theo chunk,
+    bộ nhớ không phụ thuộc độ dài audio"""
+
+    def __init__(self, np):
+        self.np = np
+        self.window_samples = int(ANALYSIS_SAMPLE_RATE * ENVELOPE_WINDOW)
+        self.window_bytes = self.window_samples * 2  # s16le
+        self.chunk_bytes = self.window_bytes * CHUNK_WINDOWS
+        self.pending = bytearray()
+        self.envelope_chunks = []
+
+    def _consume(self, usable):
+        np = self.np
+        samples = np.frombuffer(bytes(self.pending[:usable]), dtype='<i2').astype(np.float32)
+        del self.pending[:usable]
+        samples /= 32768.0
+        windows = samples.reshape(-1, self.window_samples)
+        self.envelope_chunks.append(np.sqrt(np.mean(windows * windows, axis=1)))
+
+    def feed(self, data):
+        self.pending += data
+        if len(self.pending) >= self.chunk_bytes:
+            self._consume(len(self.pending) - len(self.pending) % self.window_bytes)
+
+    def finish(self):
+        np = self.np
+        usable = len(self.pending) - len(self.pending) % self.window_bytes
+        if usable:
+            self._consume(usable)
+        if len(self.pending) >= 2:
+            # Cửa sổ cuối không đủ dài vẫn được tính để envelope phủ hết audio
+            tail = np.frombuffer(bytes(self.pending[:len(self.pending) - len(self.pending) % 2]), dtype='<i2')
+            tail = tail.astype(np.float32) / 32768.0
+            self.envelope_chunks.append(np.array([np.sqrt(np.mean(tail * tail))], dtype=np.float32))
+        if not self.envelope_chunks:
+            raise Exception("Audio rỗng, không có dữ liệu để phân tích")
+        return np.concatenate(self.envelope_chunks).astype(np.float32)
+
+def analyze_audio(audio_path, ffmpeg_path, cache_dir, audio_id, want_envelope=True, want_loudness=True):
+    """Phân tích audio trong 1 lần decode: envelope RMS và/hoặc loudness (có cache theo audio id).
+    Trả về (envelope, loudness), phần nào không yêu cầu thì là None"""
+    envelope, loudness = None, None
+    envelope_path = envelope_cache_path(cache_dir, audio_id)
+    loudness_path = _loudness_cache_path(cache_dir, audio_id)
+
+    if want_envelope and os.path.exists(envelope_path):
+        try:
+            import numpy as np
+            envelope = np.load(envelope_path)
+        except Exception as e:
+            print(f"WARNING: Cache envelope bị lỗi, phân tích lại: {e}", flush=True)
+    if want_loudness and os.path.exists(loudness_path):
+        try:
+            with open(loudness_path, 'r', encoding='utf-8') as f:
+                loudness = json.load(f)
+        except Exception as e:
+            print(f"WARNING: Cache loudness bị lỗi, đo lại: {e}", flush=True)
+
+    need_envelope = want_envelope and envelope is None
+    need_loudness = want_loudness and loudness is None
+    record_cache('analysis', not need_envelope and not need_loudness)
+    if not need_envelope and not need_loudness:
+        return envelope, loudness
+
+    if need_envelope:
+        import numpy as np
+
+    # Dựng 1 lệnh ffmpeg duy nhất: nhánh PCM cho envelope, nhánh loudnorm để đo loudness
+    # -stats: dòng tiến độ trên stderr giữ cho watchdog biết ffmpeg vẫn chạy (nhất là khi chỉ đo loudness)
+    cmd = [ffmpeg_path, '-hide_banner', '-stats', '-nostdin', '-v', 'info', '-i', audio_path]
+    pcm_chain = f"aresample={ANALYSIS_SAMPLE_RATE},aformat=sample_fmts=s16:channel_layouts=mono"
+    loud_chain = "loudnorm=print_format=json"
+    if need_envelope and need_loudness:
+        cmd += ['-filter_complex', f"[0:a]asplit=2[pcm_in][loud_in];[pcm_in]{pcm_chain}[pcm];[loud_in]{loud_chain},anullsink",
+                '-map', '[pcm]', '-f', 's16le', '-']
+    elif need_envelope:
+        cmd += ['-vn', '-af', pcm_chain, '-f', 's16le', '-']
+    else:
+        cmd += ['-vn', '-af', loud_chain, '-f', 'null', '-']
+
+    # Chạy qua process_runner để PAUSE/CANCEL và watchdog áp dụng cho cả lần decode này
+    reader = _EnvelopeReader(np) if need_envelope else None
+    returncode, _, stderr_tail, _ = run_process(
+        cmd, echo_stdout=False, stdout_sink=reader.feed if reader else None
+    )
+    if returncode != 0:
+        raise Exception(f"ffmpeg không decode được audio để phân tích (mã {returncode}): {' '.join(stderr_tail[-3:])}")
+    if reader:
+        envelope = reader.finish()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if need_envelope:
+        temp_path = envelope_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, envelope)
+        os.replace(temp_path, envelope_path)
+    if need_loudness:
+        loudness = _parse_loudnorm_output('\n'.join(stderr_tail))
+        temp_path = loudness_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(loudness, f)
+        os.replace(temp_path, loudness_path)
+    return envelope, loudness
+
+def build_loudness_filter(loudness, target_lufs, true_peak_db):
+    """Tính gain tuyến tính (dB) và limiter để đưa audio về target_lufs, không vượt true_peak_db.
+    alimiter chỉ giới hạn peak của mẫu (sample peak), nên trần của limiter được hạ thêm TRUE_PEAK_MARGIN_DB
+    để phần vọt lên giữa các mẫu (và sau khi encode AAC) vẫn nằm dưới true_peak_db"""
+    if not math.isfinite(loudness['integrated']) or not math.isfinite(loudness['true_peak']):
+        # Audio im lặng hoàn toàn: không có gì để chuẩn hoá
+        return None
+    gain_db = target_lufs - loudness['integrated']
+    filters = [f"volume={gain_db:.2f}dB"]
+    # true_peak đo từ nguồn là true peak thật (loudnorm), so thẳng với trần
+    if loudness['true_peak'] + gain_db > true_peak_db:
+        # Gain đẩy peak vượt ngưỡng: thêm limiter ngay sau volume
+        limit = min(1.0, max(0.0625, 10 ** ((true_peak_db - TRUE_PEAK_MARGIN_DB) / 20.0)))
+        filters.append(f"alimiter=limit={limit:.4f}:level=0")
+    return ",".join(filters)
+
+def _snap_to_silence(energy_db, target, low, high):
+    """Tìm điểm lặng gần target nhất trong [low, high]; nếu không có, lấy điểm nhỏ tiếng nhất"""
+    import numpy as np
+
+    lo_idx = max(0, int(low / ENVELOPE_WINDOW))
+    hi_idx = min(len(energy_db), int(high / ENVELOPE_WINDOW) + 1)
+    if hi_idx <= lo_idx:
+        return target
+    segment = energy_db[lo_idx:hi_idx]
+    positions = (np.arange(lo_idx, hi_idx) + 0.5) * ENVELOPE_WINDOW
+    distance = np.abs(positions - target)
+
+    silent = segment <= SILENCE_THRESHOLD_DB
+    if np.any(silent):
+        return float(positions[np.argmin(np.where(silent, distance, np.inf))])
+
+    # Không có khoảng lặng: lấy chỗ nhỏ tiếng nhất nếu nó nhỏ hơn hẳn tại mốc cũ
+    best = int(np.argmin(segment))
+    target_idx = min(max(int(target / ENVELOPE_WINDOW), 0), len(energy_db) - 1)
+    if segment[best] <= energy_db[target_idx] - MIN_QUIETER_DB:
+        return float(positions[best])
+    return target
+
+def plan_part_boundaries(envelope, total_duration, part_duration, num_parts, tolerance):
+    """Tính danh sách (start, duration) cho từng phần, mốc cắt được dời về khoảng lặng gần nhất trong ±tolerance giây"""
+    import numpy as np
+
+    smooth_windows = max(1, int(SMOOTHING_SECONDS / ENVELOPE_WINDOW))
+    kernel = np.ones(smooth_windows, dtype=np.float32)
+    # Chia cho số điểm thực tế trong cửa sổ để 2 đầu envelope không bị kéo về 0
+    smoothed = np.convolve(envelope, kernel, mode='same') / np.convolve(np.ones_like(envelope), kernel, mode='same')
+    energy_db = 20.0 * np.log10(np.maximum(smoothed, 1e-6))
+
+    min_part = min(part_duration / 2, max(part_duration - tolerance, 0.0))
+    cuts = []
+    previous = 0.0
+    for i in range(1, num_parts + 1):
+        nominal = i * part_duration
+        if nominal >= total_duration - 1e-3:
+            cuts.append(total_duration)
+            break
+        low = max(nominal - tolerance, previous + min_part)
+        high = min(nominal + tolerance, total_duration)
+        if i < num_parts:
+            # Còn phần phía sau thì không để phần đó quá ngắn
+            high = min(high, total_duration - min_part)
+        cut = _snap_to_silence(energy_db, nominal, low, high) if tolerance > 0 else nominal
+        cuts.append(cut)
+        previous = cut
+
+    segments = []
+    start = 0.0
+    for cut in cuts:
+        segments.append((round(start, 3), round(cut - start, 3)))
+        start = cut
+    return segments
@@ -0,0 +1,300 @@
+"""
+Module cache lâu dài - metadata theo URL, file media đã tải và file dẫn xuất, giới hạn dung lượng theo LRU
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+METADATA_TTL = 7 * 24 * 3600
+# Chỉ giữ các trường metadata mà pipeline dùng tới
+METADATA_FIELDS = (
+    'id', 'title', 'thumbnail', 'duration', 'webpage_url', 'extractor_key',
+    # Dùng cho --plan: ước lượng dung lượng tải và chi phí xử lý khi chưa có file
+    'width', 'height', 'fps', 'filesize', 'filesize_approx', 'tbr',
+)
+MEDIA_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# URL đang được lấy metadata (theo đường dẫn file cache), dùng chung mọi MetadataCache trong process
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+class MetadataCache:
+    """Cache metadata yt-dlp theo URL, lưu mỗi URL 1 file JSON nhỏ"""
+
+    def __init__(self, cache_dir, ttl=METADATA_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get_or_fetch(self, url, fetch):
+        """Lấy từ cache, nếu chưa có thì gọi fetch(url). Nhiều thread cùng cần 1 URL chỉ fetch 1 lần.
+        Trả về (metadata, trúng cache)"""
+        info = self.get(url)
+        if info is not None:
+            return info, True
+        path = self._path(url)
+        with _inflight_lock:
+            event = _inflight.get(path)
+            owner = event is None
+            if owner:
+                event = _inflight[path] = threading.Event()
+        if not owner:
+            event.wait()
+            info = self.get(url)
+            if info is not None:
+                return info, True
+            # Thread kia lỗi: tự lấy lại để báo lỗi đúng cho job này
+            return self.put(url, fetch(url)), False
+        try:
+            return self.put(url, fetch(url)), False
+        finally:
+            with _inflight_lock:
+                _inflight.pop(path, None)
+            event.set()
+
+    def put(self, url, info):
+        data = {key: info.get(key) for key in METADATA_FIELDS}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(url)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        return data
+
+class MetadataPrefetcher:
+    """Lấy metadata đầy đủ cho nhiều URL ở nền (số luồng giới hạn, theo thứ tự đưa vào) để job sau trúng cache"""
+
+    def __init__(self, cache, fetch, workers=4):
+        from concurrent.futures import ThreadPoolExecutor
+        self.cache = cache
+        self.fetch = fetch
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="metadata")
+        self._submitted = set()
+        self.failed = {}
+
+    def submit(self, urls):
+        for url in urls:
+            if url in self._submitted:
+                continue
+            self._submitted.add(url)
+            self._executor.submit(self._resolve, url)
+
+    def _resolve(self, url):
+        try:
+            self.cache.get_or_fetch(url, self.fetch)
+        except Exception as e:
+            # Job tương ứng sẽ tự lấy lại và báo lỗi khi chạy tới
+            self.failed[url] = str(e)
+
+    def close(self, wait=False):
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+def touch(path):
+    """Đánh dấu file vừa được dùng (để LRU không xóa nhầm)"""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def store_file(src_path, cache_path):
+    """Chuyển file vừa tạo vào cache (cùng ổ đĩa nên chỉ là rename)"""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    os.replace(src_path, cache_path)
+    return cache_path
+
+# --- FILE ĐANG DÙNG ---
+# File cache mà job đang chạy cần (media nguồn, bản đổi tốc độ / lặp, bumper) không được LRU xóa, kể cả khi
+# eviction do job khác trong cùng process gây ra. Process khác (--prefetch, editor chạy song song) không thấy
+# pin nên file đang giữ được touch định kỳ, và eviction bỏ qua mọi file được dùng trong EVICTION_GRACE_SECONDS
+PIN_REFRESH_SECONDS = 300
+EVICTION_GRACE_SECONDS = 900
+
+class PinRegistry:
+    """Đếm tham chiếu các file cache đang được giữ trong process (nhiều job có thể cùng giữ 1 file)"""
+
+    def __init__(self, refresh_interval=PIN_REFRESH_SECONDS):
+        self.refresh_interval = refresh_interval
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def pin(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._counts[path] = self._counts.get(path, 0) + 1
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name='cache-pins', daemon=True)
+                self._refresher.start()
+        touch(path)
+
+    def unpin(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            count = self._counts.get(path, 0) - 1
+            if count > 0:
+                self._counts[path] = count
+            else:
+                self._counts.pop(path, None)
+
+    def is_pinned(self, path):
+        with self._lock:
+            return os.path.abspath(path) in self._counts
+
+    def _refresh_loop(self):
+        # Giữ mtime của file đang dùng luôn mới hơn EVICTION_GRACE_SECONDS để process khác không xóa
+        while True:
+            time.sleep(self.refresh_interval)
+            with self._lock:
+                paths = list(self._counts)
+            for path in paths:
+                touch(path)
+
+pins = PinRegistry()
+
+class PinSet:
+    """Các file cache 1 job đang giữ; release() khi job kết thúc (thành công, lỗi hay bị hủy)"""
+
+    def __init__(self, registry=None):
+        self.registry = registry or pins
+        self.paths = []
+        self._lock = threading.Lock()
+
+    def add(self, *paths):
+        for path in paths:
+            if path:
+                self.registry.pin(path)
+                with self._lock:
+                    self.paths.append(path)
+
+    def release(self):
+        with self._lock:
+            paths, self.paths = self.paths, []
+        for path in paths:
+            self.registry.unpin(path)
+
+def enforce_size_limit(cache_dir, max_bytes, keep=(), grace=EVICTION_GRACE_SECONDS):
+    """Xóa file ít dùng nhất (theo mtime) tới khi tổng dung lượng <= max_bytes; bỏ qua các file trong keep,
+    file đang được job trong process giữ (pins) và file dùng trong grace giây gần đây (có thể của process khác).
+    Trả về tổng dung lượng còn lại (có thể vẫn lớn hơn max_bytes nếu mọi file đều đang dùng)"""
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if not os.path.isfile(path):
+            continue
+        total += stat.st_size
+        entries.append((stat.st_mtime, stat.st_size, path))
+    keep = {os.path.abspath(p) for p in keep}
+    recent = time.time() - grace
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes or mtime > recent:
+            # Sắp theo mtime: từ đây trở đi đều là file vừa dùng
+            break
+        if os.path.abspath(path) in keep or pins.is_pinned(path):
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+# --- CACHE FILE DẪN XUẤT ---
+DERIVED_CACHE_MAX_BYTES = 10 * 1024 ** 3
+# Dấu vân tay file nguồn: kích thước + sha256 của phần đầu và phần cuối (không phải đọc cả file video)
+FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
+
+def fingerprint_file(path):
+    """Dấu vân tay nhanh của file, đổi khi nội dung đổi (dùng để kiểm tra provenance)"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+        if size > FINGERPRINT_SAMPLE_BYTES:
+            f.seek(max(FINGERPRINT_SAMPLE_BYTES, size - FINGERPRINT_SAMPLE_BYTES))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class DerivedCache:
+    """Cache file dẫn xuất (video đã đổi tốc độ, đã lặp, ...) dùng lại giữa các job.
+    Khóa = loại biến đổi + tham số; file provenance .json đi kèm ghi tham số, dấu vân tay input và output,
+    bản cache chỉ được dùng khi input hiện tại khớp với input đã tạo ra nó"""
+
+    def __init__(self, cache_dir, max_bytes=DERIVED_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def key(self, kind, params):
+        canonical = json.dumps({'kind': kind, 'params': params}, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def _paths(self, kind, params, ext):
+        base = os.path.join(self.cache_dir, f"{kind}_{self.key(kind, params)}")
+        return base + ext, base + '.json'
+
+    def get(self, kind, params, inputs, ext):
+        """Đường dẫn bản cache nếu còn hợp lệ với inputs ({tên: đường dẫn}), ngược lại None"""
+        path, provenance_path = self._paths(kind, params, ext)
+        try:
+            with open(provenance_path, 'r', encoding='utf-8') as f:
+                provenance = json.load(f)
+            if os.path.getsize(path) != provenance['output']['size']:
+                return None
+            if provenance['inputs'] != {name: fingerprint_file(p) for name, p in inputs.items()}:
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        touch(path)
+        touch(provenance_path)
+        return path
+
+    def build(self, kind, params, inputs, ext, produce, keep=()):
+        """Lấy bản cache hoặc gọi produce(temp_path) để tạo rồi lưu vào cache. Trả về (đường dẫn, trúng cache).
+        Trong cùng process, các job cần cùng 1 file chờ nhau thay vì cùng encode"""
+        path, provenance_path = self._paths(kind, params, ext)
+        with self._locks_guard:
+            lock = self._locks.setdefault(path, threading.Lock())
+        with lock:
+            cached = self.get(kind, params, inputs, ext)
+            if cached:
+                return cached, True
+            os.makedirs(self.cache_dir, exist_ok=True)
+            input_fingerprints = {name: fingerprint_file(p) for name, p in inputs.items()}
+            temp_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+            started = time.time()
+            try:
+                produce(temp_path)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            provenance = {
+                'kind': kind, 'params': params, 'inputs': input_fingerprints,
+                'output': {'size': os.path.getsize(path), 'fingerprint': fingerprint_file(path)},
+                'created': time.time(), 'build_seconds': round(time.time() - started, 3),
+            }
+            with open(provenance_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(provenance, f, ensure_ascii=False, indent=2)
+            os.replace(provenance_path + '.tmp', provenance_path)
+        enforce_size_limit(self.cache_dir, self.max_bytes, keep=(path, provenance_path) + tuple(keep))
+        return path, False
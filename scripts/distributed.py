@@ -0,0 +1,404 @@
+"""
+Module render phân tán - coordinator chia job thành task theo phần, worker (cùng máy hoặc máy khác trong LAN)
+kéo task qua HTTP, tải input theo sha256, render rồi đẩy kết quả về kèm checksum
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from process_runner import ProcessCancelled
+
+DEFAULT_PORT = 8765
+# Task không được heartbeat trong chừng này giây thì coi như worker đã chết và giao lại
+LEASE_SECONDS = 120
+HEARTBEAT_INTERVAL = 30
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 1.0
+HASH_CHUNK_SIZE = 1024 * 1024
+# Trường path trong job dict được gửi dưới dạng tham chiếu nội dung
+INPUT_FIELDS = ('thumbnail_path', 'audio_path', 'intro_path', 'outro_path')
+
+class RemoteError(Exception):
+    """Coordinator trả lỗi hoặc không liên lạc được"""
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _file_ref(path):
+    return {'sha256': file_sha256(path), 'ext': os.path.splitext(path)[1]}
+
+# --- COORDINATOR ---
+class Coordinator:
+    """Giữ danh sách task của 1 job đã chuẩn bị; mỗi phần là 1 task, giao lại khi worker lỗi hoặc mất heartbeat.
+    on_claim(part_index, worker_id) / on_result(part_index, worker_id, seconds) được gọi khi giao và nhận xong 1 phần"""
+
+    def __init__(self, job, output_dir, output_name, token=None, on_claim=None, on_result=None):
+        self.output_dir = output_dir
+        self.output_name = output_name
+        self.token = token
+        self.on_claim = on_claim
+        self.on_result = on_result
+        self.blobs = {}
+        spec = {key: value for key, value in job.items()
+                if key not in INPUT_FIELDS + ('image_paths', 'video_paths', 'ffmpeg_path', 'resources_path', 'temp_dir')}
+        # Nguồn layout không dùng (video nền / thumbnail bị che hết) không có file để gửi
+        spec['inputs'] = {field: self._register(job[field]) for field in INPUT_FIELDS if job.get(field)}
+        spec['images'] = {item_id: self._register(path) for item_id, path in job['image_paths'].items()}
+        spec['videos'] = {stream_id: self._register(path) for stream_id, path in job.get('video_paths', {}).items()}
+        self.spec = spec
+        self.tasks = {
+            f"part{i + 1}": {'part_index': i, 'state': 'pending', 'attempts': 0, 'lease_until': 0, 'worker': None,
+                             'claimed_at': None}
+            for i in range(len(job['segments']))
+        }
+        self.results = {}
+        self.failed_error = None
+        self._lock = threading.Condition()
+        self._server = None
+
+    def _register(self, path):
+        ref = _file_ref(path)
+        self.blobs[ref['sha256']] = path
+        return ref
+
+    def is_finished(self):
+        return self.failed_error is not None or all(task['state'] == 'done' for task in self.tasks.values())
+
+    def _requeue_expired(self):
+        now = time.time()
+        for task_id, task in self.tasks.items():
+            if task['state'] == 'running' and task['lease_until'] < now:
+                print(f"WARNING: Worker {task['worker']} mất liên lạc, giao lại {task_id}", flush=True)
+                task['state'] = 'pending'
+
+    # Các hàm dưới được gọi từ thread của HTTP server
+    def claim(self, worker_id):
+        """Trả về task tiếp theo (dict), None nếu tạm hết, hoặc False nếu job đã kết thúc"""
+        with self._lock:
+            if self.is_finished():
+                return False
+            self._requeue_expired()
+            for task_id, task in self.tasks.items():
+                if task['state'] == 'pending':
+                    task.update(state='running', worker=worker_id, lease_until=time.time() + LEASE_SECONDS,
+                                claimed_at=time.time())
+                    task['attempts'] += 1
+                    print(f"STATUS: Giao {task_id} cho worker {worker_id} (lần {task['attempts']})", flush=True)
+                    claimed = {'task_id': task_id, 'part_index': task['part_index'], 'job': self.spec}
+                    break
+            else:
+                return None
+        if self.on_claim:
+            self.on_claim(claimed['part_index'], worker_id)
+        return claimed
+
+    def heartbeat(self, task_id, worker_id):
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if not task or task['state'] != 'running' or task['worker'] != worker_id:
+                return False
+            task['lease_until'] = time.time() + LEASE_SECONDS
+            return True
+
+    def fail(self, task_id, worker_id, error):
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if not task or task['state'] != 'running' or task['worker'] != worker_id:
+                return
+            print(f"WARNING: {task_id} lỗi trên worker {worker_id}: {error}", flush=True)
+            if task['attempts'] >= MAX_ATTEMPTS:
+                task['state'] = 'failed'
+                self.failed_error = f"{task_id} lỗi sau {task['attempts']} lần: {error}"
+            else:
+                task['state'] = 'pending'
+            self._lock.notify_all()
+
+    def accept_result(self, task_id, worker_id, temp_path, expected_sha256):
+        """Nhận file kết quả đã upload; sai checksum thì tính là 1 lần lỗi"""
+        actual = file_sha256(temp_path)
+        if actual != expected_sha256:
+            os.remove(temp_path)
+            self.fail(task_id, worker_id, f"checksum không khớp ({actual[:12]} != {expected_sha256[:12]})")
+            return False
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if not task or task['state'] == 'done':
+                # Task đã được worker khác hoàn thành trước
+                os.remove(temp_path)
+                return True
+            output_path = os.path.join(self.output_dir, self.output_name(task['part_index']))
+            os.replace(temp_path, output_path)
+            task['state'] = 'done'
+            self.results[task['part_index']] = output_path
+            print(f"RESULT:{output_path}", flush=True)
+            self._lock.notify_all()
+        if self.on_result:
+            self.on_result(task['part_index'], worker_id, time.time() - task['claimed_at'])
+        return True
+
+    # --- SERVER ---
+    def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self._server = ThreadingHTTPServer((host, port), _CoordinatorHandler)
+        self._server.daemon_threads = True
+        self._server.coordinator = self
+        threading.Thread(target=self._server.serve_forever, name="coordinator-http", daemon=True).start()
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def wait(self, should_stop=None):
+        """Chờ tới khi mọi phần xong (hoặc 1 phần lỗi quá số lần). Trả về list đường dẫn kết quả theo thứ tự phần"""
+        with self._lock:
+            while not self.is_finished():
+                if should_stop:
+                    should_stop()
+                self._requeue_expired()
+                self._lock.wait(POLL_INTERVAL)
+            if self.failed_error:
+                raise RemoteError(self.failed_error)
+            return [self.results[i] for i in sorted(self.results)]
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+class _CoordinatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        coordinator = self.server.coordinator
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        if coordinator.token and self.headers.get('X-Render-Token') != coordinator.token:
+            self.close_connection = True
+            self._send_json(403, {'error': 'token không hợp lệ'})
+            return None
+        return coordinator, parts.path.strip('/').split('/'), query
+
+    def do_GET(self):
+        route = self._route()
+        if not route:
+            return
+        coordinator, path, query = route
+        if path == ['task']:
+            task = coordinator.claim(query.get('worker', self.client_address[0]))
+            if task is False:
+                self._send_json(410, {'done': True})
+            elif task is None:
+                self._send_json(204)
+            else:
+                self._send_json(200, task)
+        elif len(path) == 2 and path[0] == 'blob' and path[1] in coordinator.blobs:
+            blob_path = coordinator.blobs[path[1]]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(blob_path)))
+            self.end_headers()
+            with open(blob_path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, HASH_CHUNK_SIZE)
+        else:
+            self._send_json(404, {'error': 'không tìm thấy'})
+
+    def do_POST(self):
+        route = self._route()
+        if not route:
+            return
+        coordinator, path, query = route
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length) or b'{}')
+        worker_id = query.get('worker', '')
+        if len(path) == 2 and path[0] == 'heartbeat':
+            ok = coordinator.heartbeat(path[1], worker_id)
+            self._send_json(200 if ok else 409, {'ok': ok})
+        elif len(path) == 2 and path[0] == 'fail':
+            coordinator.fail(path[1], worker_id, data.get('error', ''))
+            self._send_json(200, {'ok': True})
+        else:
+            self._send_json(404, {'error': 'không tìm thấy'})
+
+    def do_PUT(self):
+        route = self._route()
+        if not route:
+            return
+        coordinator, path, query = route
+        if len(path) != 2 or path[0] != 'result' or path[1] not in coordinator.tasks:
+            self._send_json(404, {'error': 'không tìm thấy'})
+            return
+        remaining = int(self.headers.get('Content-Length') or 0)
+        temp_path = os.path.join(coordinator.output_dir, f".{path[1]}.{query.get('worker', '')}.upload")
+        with open(temp_path, 'wb') as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(HASH_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            os.remove(temp_path)
+            self._send_json(400, {'error': 'upload bị ngắt giữa chừng'})
+            return
+        ok = coordinator.accept_result(path[1], query.get('worker', ''), temp_path, self.headers.get('X-Content-SHA256', ''))
+        self._send_json(200 if ok else 422, {'ok': ok})
+
+# --- WORKER ---
+class WorkerClient:
+    """Gọi API của coordinator (mỗi request retry vài lần khi lỗi mạng)"""
+
+    def __init__(self, base_url, worker_id, token=None, retries=3):
+        self.base_url = base_url.rstrip('/')
+        self.worker_id = worker_id
+        self.token = token
+        self.retries = retries
+
+    def _call(self, method, path, data=None, headers=None, sink=None):
+        url = f"{self.base_url}/{path}?worker={self.worker_id}"
+        request_headers = dict(headers or {})
+        if self.token:
+            request_headers['X-Render-Token'] = self.token
+        for attempt in range(self.retries + 1):
+            body = data() if callable(data) else data
+            if sink is not None:
+                # Lần thử lại ghi đè từ đầu
+                sink.seek(0)
+                sink.truncate()
+            request = urllib.request.Request(url, data=body, method=method, headers=request_headers)
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    if sink is not None:
+                        shutil.copyfileobj(response, sink, HASH_CHUNK_SIZE)
+                        return response.status, None
+                    content = response.read()
+                    return response.status, json.loads(content) if content else None
+            except urllib.error.HTTPError as e:
+                content = e.read()
+                return e.code, json.loads(content) if content else None
+            except OSError as e:
+                if attempt >= self.retries:
+                    raise RemoteError(f"Không liên lạc được coordinator {self.base_url}: {e}")
+                time.sleep(min(8.0, 0.5 * (2 ** attempt)))
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+
+    def next_task(self):
+        status, data = self._call('GET', 'task')
+        if status == 410:
+            return False
+        if status == 204:
+            return None
+        if status != 200:
+            raise RemoteError(f"Lấy task lỗi: HTTP {status} {data}")
+        return data
+
+    def fetch_blob(self, ref, cache_dir):
+        """Tải input theo sha256 vào cache của worker; đã có (đúng checksum) thì dùng lại"""
+        path = os.path.join(cache_dir, ref['sha256'] + ref.get('ext', ''))
+        if os.path.exists(path):
+            return path
+        # Nhiều worker trên cùng máy dùng chung cache: mỗi tiến trình tải vào file tạm riêng
+        temp_path = f"{path}.{os.getpid()}.part"
+        with open(temp_path, 'wb') as f:
+            status, _ = self._call('GET', f"blob/{ref['sha256']}", sink=f)
+        if status != 200 or file_sha256(temp_path) != ref['sha256']:
+            os.remove(temp_path)
+            raise RemoteError(f"Input {ref['sha256'][:12]} tải về bị lỗi (HTTP {status} hoặc sai checksum)")
+        os.replace(temp_path, path)
+        return path
+
+    def heartbeat(self, task_id):
+        status, _ = self._call('POST', f"heartbeat/{task_id}", data=b'{}')
+        return status == 200
+
+    def fail(self, task_id, error):
+        self._call('POST', f"fail/{task_id}", data=json.dumps({'error': str(error)}).encode('utf-8'))
+
+    def upload_result(self, task_id, path):
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(os.path.getsize(path)),
+            'X-Content-SHA256': file_sha256(path),
+        }
+        status, data = self._call('PUT', f"result/{task_id}", data=lambda: open(path, 'rb'), headers=headers)
+        if status != 200:
+            raise RemoteError(f"Upload kết quả {task_id} bị từ chối: HTTP {status} {data}")
+
+def run_worker(client, cache_dir, work_dir, localize_job, render):
+    """Vòng lặp worker: kéo task tới khi coordinator báo hết việc.
+    localize_job(spec, inputs) dựng job dict dùng được trên máy này; render(job, part_index, output_dir) -> path"""
+    os.makedirs(cache_dir, exist_ok=True)
+    completed = 0
+    while True:
+        try:
+            task = client.next_task()
+        except RemoteError as e:
+            # Coordinator đã tắt sau khi xong job cũng rơi vào đây
+            print(f"STATUS: Worker dừng: {e}", flush=True)
+            return completed
+        if task is False:
+            return completed
+        if task is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        task_id = task['task_id']
+        spec = task['job']
+        task_dir = os.path.join(work_dir, task_id)
+        stop_heartbeat = threading.Event()
+
+        def keep_alive():
+            while not stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+                try:
+                    client.heartbeat(task_id)
+                except RemoteError:
+                    pass
+
+        heartbeat_thread = threading.Thread(target=keep_alive, daemon=True)
+        heartbeat_thread.start()
+        try:
+            inputs = {field: client.fetch_blob(ref, cache_dir) for field, ref in spec['inputs'].items()}
+            images = {item_id: client.fetch_blob(ref, cache_dir) for item_id, ref in spec['images'].items()}
+            # Video nền của từng stream đi cùng các input khác (job.update(inputs) ở localize_job)
+            inputs['video_paths'] = {stream_id: client.fetch_blob(ref, cache_dir)
+                                     for stream_id, ref in spec.get('videos', {}).items()}
+            os.makedirs(task_dir, exist_ok=True)
+            job = localize_job(spec, inputs, images, task_dir)
+            output_path = render(job, task['part_index'], task_dir)
+            client.upload_result(task_id, output_path)
+            completed += 1
+            print(f"STATUS: Worker đã xong {task_id}", flush=True)
+        except ProcessCancelled:
+            client.fail(task_id, "worker bị hủy")
+            raise
+        except Exception as e:
+            print(f"WARNING: {task_id} lỗi: {e}", flush=True)
+            try:
+                client.fail(task_id, e)
+            except RemoteError:
+                pass
+        finally:
+            stop_heartbeat.set()
+            shutil.rmtree(task_dir, ignore_errors=True)
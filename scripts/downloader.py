@@ -3,32 +3,199 @@ Module tải video/audio từ YouTube bằng yt-dlp
 """
 import sys
 import os
+import json
+import time
+import atexit
+import shutil
+import threading
+import contextlib
 import subprocess
-from utils import get_executable_path
+from urllib.parse import urlparse
+from utils import get_executable_path, patch_popen_utf8
+from metrics import record_download
+from governor import governor
+
+# --- BACKEND TẢI VIDEO ---
+DOWNLOAD_BACKENDS = ('auto', 'aria2c', 'native')
+# Số kết nối song song (aria2c) / số fragment song song (native), tự điều chỉnh theo tốc độ đo được
+DEFAULT_CONNECTIONS = 8
+MIN_CONNECTIONS = 2
+MAX_CONNECTIONS = 16
+CONNECTION_STEP = 2
+# Chỉ đổi số kết nối sau khi có đủ chừng này lần tải ở mức hiện tại (so trung bình, không so 1 lần tải lẻ);
+# lần tải quá nhỏ bị bỏ qua vì thời gian chủ yếu là độ trễ chứ không phải băng thông
+TUNING_SAMPLES = 3
+MIN_TUNING_BYTES = 4 * 1024 * 1024
+# Retry ở mức fragment/range để 1 fragment lỗi không làm hỏng cả lần tải
+FRAGMENT_RETRIES = 10
+# Chia request HTTP thành từng range để tránh bị giới hạn tốc độ trên 1 stream dài
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024
+
+class DownloadYielded(Exception):
+    """Lượt tải nền dừng để nhường job đang chạy; file .part được giữ lại để tải tiếp"""
+
+def _make_yield_hook(should_yield):
+    """Progress hook dừng lượt tải khi should_yield() trả True"""
+    def hook(d):
+        if d['status'] == 'downloading' and should_yield():
+            raise load_yt_dlp().utils.DownloadCancelled("Nhường băng thông cho job đang chạy")
+    return hook
 
 # --- TỰ ĐỘNG CÀI ĐẶT yt-dlp NẾU THIẾU ---
 def ensure_yt_dlp():
-    """Tự động cài đặt yt-dlp nếu chưa có"""
+    """Tự động cài đặt yt-dlp nếu chưa có (chỉ kiểm tra, không import để khởi động nhanh)"""
+    import importlib
+    import importlib.util
+    if importlib.util.find_spec('yt_dlp') is not None:
+        return True
+    print("STATUS: Đang cài đặt yt-dlp...", flush=True)
     try:
-        import yt_dlp
+        # Cài đặt yt-dlp bằng pip
+        subprocess.check_call([
+            sys.executable, '-m', 'pip', 'install', '--quiet', '--upgrade', 'yt-dlp'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        print("STATUS: Đã cài đặt yt-dlp thành công!", flush=True)
+        importlib.invalidate_caches()
         return True
-    except ImportError:
-        print("STATUS: Đang cài đặt yt-dlp...", flush=True)
+    except subprocess.CalledProcessError as e:
+        print(f"PYTHON_ERROR: Không thể cài đặt yt-dlp. Vui lòng cài đặt thủ công bằng lệnh: pip install yt-dlp", file=sys.stderr, flush=True)
+        return False
+    except Exception as e:
+        print(f"PYTHON_ERROR: Lỗi khi cài đặt yt-dlp: {e}", file=sys.stderr, flush=True)
+        return False
+
+_yt_dlp_module = None
+
+def load_yt_dlp():
+    """Nạp yt_dlp khi có bước tải thực sự chạy; job chỉ dùng dữ liệu cache/local không phải trả chi phí này"""
+    global _yt_dlp_module
+    if _yt_dlp_module is None:
+        if not ensure_yt_dlp():
+            raise Exception("Không thể cài đặt yt-dlp. Vui lòng cài đặt thủ công bằng lệnh: pip install yt-dlp")
+        patch_popen_utf8()
+        import yt_dlp
+        _yt_dlp_module = yt_dlp
+    return _yt_dlp_module
+
+# --- PHIÊN YoutubeDL DÙNG LẠI ---
+# Tuỳ chọn yt-dlp đọc lại ở mỗi lượt tải/extract: đặt theo từng lượt, không thuộc khoá profile
+PER_CALL_OPTIONS = (
+    'outtmpl', 'ratelimit', 'playlistend', 'retries', 'fragment_retries', 'concurrent_fragments',
+    'http_chunk_size', 'external_downloader', 'external_downloader_args',
+)
+
+_sessions_lock = threading.Lock()
+_idle_sessions = {}
+_cookie_jars = {}
+_session_cache_dir = None
+
+def configure_sessions(cache_dir):
+    """Thư mục cache của extractor (player JS, hàm giải chữ ký) dùng chung giữa các lần chạy"""
+    global _session_cache_dir
+    _session_cache_dir = cache_dir
+
+def _cookie_version(cookie_file):
+    try:
+        return os.path.getmtime(cookie_file)
+    except OSError:
+        return None
+
+def _shared_cookie_jar(yt_dlp, cookie_file, ydl):
+    """Cookie jar nạp 1 lần mỗi process cho mỗi file cookies (nạp lại khi file được cập nhật)"""
+    version = _cookie_version(cookie_file)
+    with _sessions_lock:
+        cached = _cookie_jars.get(cookie_file)
+        if cached and cached[0] == version:
+            return cached
+    jar = yt_dlp.cookies.load_cookies(cookie_file, None, ydl)
+    with _sessions_lock:
+        _cookie_jars[cookie_file] = (version, jar)
+    return version, jar
+
+class _Session:
+    """1 YoutubeDL đã cấu hình theo profile; progress hook của từng lượt đi qua 1 hook điều phối"""
+
+    def __init__(self, yt_dlp, profile):
+        self.hooks = []
+        params = dict(profile, progress_hooks=[self._dispatch])
+        if _session_cache_dir:
+            params.setdefault('cachedir', _session_cache_dir)
+        self.ydl = yt_dlp.YoutubeDL(params)
+        self.base = dict(self.ydl.params)
+        self.cookie_file = profile.get('cookiefile')
+        self.cookie_version = None
+        if self.cookie_file:
+            self.cookie_version, self.ydl.cookiejar = _shared_cookie_jar(yt_dlp, self.cookie_file, self.ydl)
+
+    def _dispatch(self, d):
+        for hook in self.hooks:
+            hook(d)
+
+    def current(self):
+        return not self.cookie_file or self.cookie_version == _cookie_version(self.cookie_file)
+
+    def begin(self, ydl_opts):
+        for key in PER_CALL_OPTIONS:
+            if key in ydl_opts:
+                self.ydl.params[key] = ydl_opts[key]
+        if 'outtmpl' in ydl_opts:
+            self.ydl.params['outtmpl'] = dict(self.base['outtmpl'], default=ydl_opts['outtmpl'])
+        self.hooks = list(ydl_opts.get('progress_hooks', []))
+
+    def end(self):
+        for key in PER_CALL_OPTIONS:
+            if key in self.base:
+                self.ydl.params[key] = self.base[key]
+            else:
+                self.ydl.params.pop(key, None)
+        self.hooks = []
+
+    def close(self):
         try:
-            # Cài đặt yt-dlp bằng pip
-            subprocess.check_call([
-                sys.executable, '-m', 'pip', 'install', '--quiet', '--upgrade', 'yt-dlp'
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-            print("STATUS: Đã cài đặt yt-dlp thành công!", flush=True)
-            # Import lại sau khi cài đặt
-            import yt_dlp
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"PYTHON_ERROR: Không thể cài đặt yt-dlp. Vui lòng cài đặt thủ công bằng lệnh: pip install yt-dlp", file=sys.stderr, flush=True)
-            return False
-        except Exception as e:
-            print(f"PYTHON_ERROR: Lỗi khi cài đặt yt-dlp: {e}", file=sys.stderr, flush=True)
-            return False
+            self.ydl.close()
+        except Exception:
+            pass
+
+@contextlib.contextmanager
+def ydl_session(ydl_opts):
+    """YoutubeDL cho profile của ydl_opts (mọi tuỳ chọn trừ PER_CALL_OPTIONS / progress_hooks), lấy từ pool hoặc
+    tạo mới, trả lại pool sau khi dùng. Instance giữ extractor, cache player JS và cookie jar giữa các link;
+    mỗi lượt dùng độc quyền 1 instance nên nhiều job tải song song vẫn an toàn"""
+    yt_dlp = load_yt_dlp()
+    profile = {k: v for k, v in ydl_opts.items() if k not in PER_CALL_OPTIONS and k != 'progress_hooks'}
+    key = json.dumps(profile, sort_keys=True, default=str)
+    session, stale = None, []
+    with _sessions_lock:
+        pool = _idle_sessions.get(key, [])
+        while pool and session is None:
+            candidate = pool.pop()
+            if candidate.current():
+                session = candidate
+            else:
+                stale.append(candidate)
+    for old in stale:
+        old.close()
+    if session is None:
+        session = _Session(yt_dlp, profile)
+    session.begin(ydl_opts)
+    try:
+        yield session.ydl
+    except BaseException:
+        # Instance vừa lỗi giữa chừng không được dùng lại
+        session.close()
+        raise
+    session.end()
+    with _sessions_lock:
+        _idle_sessions.setdefault(key, []).append(session)
+
+@atexit.register
+def close_sessions():
+    """Đóng mọi phiên rảnh (yt-dlp ghi lại file cookies khi đóng)"""
+    with _sessions_lock:
+        sessions = [session for pool in _idle_sessions.values() for session in pool]
+        _idle_sessions.clear()
+    for session in sessions:
+        session.close()
 
 def ytdlp_progress_hook(d):
     """Callback để hiển thị progress khi download"""
@@ -43,9 +210,136 @@ def ytdlp_progress_hook(d):
     elif d['status'] == 'finished':
         print("PROGRESS:DOWNLOAD:100", flush=True)
 
+def resolve_download_backend(backend, resources_path):
+    """Chọn backend tải: aria2c (bundle trong resources hoặc có trong PATH) hoặc downloader native của yt-dlp.
+    Trả về (tên backend, đường dẫn aria2c hoặc None)"""
+    if backend not in DOWNLOAD_BACKENDS:
+        raise ValueError(f"Backend tải không hợp lệ: {backend}")
+    if backend == 'native':
+        return 'native', None
+    aria2c_path = get_executable_path("aria2c", resources_path)
+    if not os.path.exists(aria2c_path):
+        aria2c_path = shutil.which("aria2c")
+    if aria2c_path:
+        return 'aria2c', aria2c_path
+    if backend == 'aria2c':
+        print("WARNING: Không tìm thấy aria2c, dùng downloader native của yt-dlp", flush=True)
+    return 'native', None
+
+def _load_tuning(tuning_dir):
+    if not tuning_dir:
+        return {}
+    try:
+        with open(os.path.join(tuning_dir, 'download_tuning.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_tuning(tuning_dir, tuning):
+    if not tuning_dir:
+        return
+    try:
+        os.makedirs(tuning_dir, exist_ok=True)
+        path = os.path.join(tuning_dir, 'download_tuning.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(tuning, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"WARNING: Không thể lưu thống kê tốc độ tải: {e}", flush=True)
+
+def _tune_connections(entry, connections, transfer_bytes, transfer_seconds):
+    """Leo đồi trên số kết nối theo tốc độ trung bình của TUNING_SAMPLES lần tải gần nhất ở mức hiện tại:
+    trung bình tăng so với mức trước thì đi tiếp theo hướng cũ, giảm thì quay đầu"""
+    if entry.get('connections', DEFAULT_CONNECTIONS) != connections or transfer_bytes < MIN_TUNING_BYTES \
+            or transfer_seconds <= 0:
+        # Lần tải bị governor cắt bớt kết nối hoặc quá nhỏ: không phản ánh mức đang thử
+        return entry
+    samples = (entry.get('samples') or []) + [[transfer_bytes, transfer_seconds]]
+    direction = entry.get('direction', 1)
+    previous = entry.get('throughput')
+    if len(samples) < TUNING_SAMPLES:
+        return {'connections': connections, 'throughput': previous, 'direction': direction, 'samples': samples}
+    average = sum(b for b, _ in samples) / sum(t for _, t in samples)
+    next_connections = connections
+    if previous and average < previous * 0.95:
+        direction = -direction
+        next_connections += direction * CONNECTION_STEP
+    elif not previous or average > previous * 1.05:
+        next_connections += direction * CONNECTION_STEP
+    # Không thay đổi đáng kể: giữ nguyên số kết nối, lấy trung bình mới làm mốc cho cửa sổ sau
+    next_connections = max(MIN_CONNECTIONS, min(MAX_CONNECTIONS, next_connections))
+    return {'connections': next_connections, 'throughput': average, 'direction': direction, 'samples': []}
+
+def _make_metrics_hook(metrics):
+    """Progress hook gom số byte và thời gian truyền dữ liệu (không tính lúc extractor / lấy metadata)
+    theo từng file để tính throughput"""
+    def hook(d):
+        filename = d.get('filename') or ''
+        downloaded = d.get('downloaded_bytes') or 0
+        now = time.monotonic()
+        started = metrics['started'].setdefault(filename, now)
+        if d['status'] == 'finished':
+            downloaded = d.get('total_bytes') or downloaded
+            if not downloaded and filename and os.path.exists(filename):
+                downloaded = os.path.getsize(filename)
+            # elapsed của yt-dlp tính từ lúc bắt đầu truyền file này (cả native lẫn aria2c)
+            metrics['transfer'][filename] = d.get('elapsed') or (now - started)
+        metrics['files'][filename] = max(metrics['files'].get(filename, 0), downloaded)
+    return hook
+
+def _apply_download_backend(ydl_opts, backend, aria2c_path, connections, rate_limit=None):
+    """Cấu hình yt-dlp theo backend, số kết nối, retry ở mức fragment và giới hạn băng thông (bytes/s)"""
+    ydl_opts['retries'] = FRAGMENT_RETRIES
+    ydl_opts['fragment_retries'] = FRAGMENT_RETRIES
+    if backend == 'aria2c':
+        ydl_opts['external_downloader'] = {'default': aria2c_path}
+        ydl_opts['external_downloader_args'] = {'aria2c': [
+            '-x', str(connections), '-s', str(connections), '-j', str(connections),
+            '-k', '1M', f'--max-tries={FRAGMENT_RETRIES}', '--retry-wait=1',
+        ] + ([f'--max-overall-download-limit={int(rate_limit)}'] if rate_limit else [])}
+    else:
+        ydl_opts['concurrent_fragments'] = connections
+        ydl_opts['http_chunk_size'] = HTTP_CHUNK_SIZE
+    if rate_limit:
+        ydl_opts['ratelimit'] = int(rate_limit)
+
+def _run_tuned_download(url, ydl_opts, backend, resources_path, tuning_dir, rate_limit=None):
+    """Tải với backend đã chọn, đo throughput và cập nhật số kết nối cho lần tải sau.
+    rate_limit (bytes/s): tải nền, dùng ít kết nối và không cập nhật số kết nối (tốc độ bị giới hạn không phản ánh mạng).
+    Trả về dict metrics: backend, connections, bytes, seconds, throughput (bytes/s)"""
+    backend_name, aria2c_path = resolve_download_backend(backend, resources_path)
+    tuning = _load_tuning(tuning_dir)
+    tuning_key = f"{backend_name}:{urlparse(url).netloc}"
+    entry = tuning.get(tuning_key, {})
+    connections = MIN_CONNECTIONS if rate_limit else entry.get('connections', DEFAULT_CONNECTIONS)
+
+    # Số kết nối thực dùng bị giới hạn bởi phần ngân sách mạng còn lại khi nhiều job cùng tải
+    with governor.acquire('download', net=(min(MIN_CONNECTIONS, connections), connections)) as grant:
+        connections = grant.connections
+        metrics = {'backend': backend_name, 'connections': connections, 'files': {}, 'started': {}, 'transfer': {}}
+        _apply_download_backend(ydl_opts, backend_name, aria2c_path, connections, rate_limit)
+        ydl_opts['progress_hooks'] = ydl_opts.get('progress_hooks', []) + [_make_metrics_hook(metrics)]
+
+        started = time.monotonic()
+        with ydl_session(ydl_opts) as ydl:
+            ydl.download([url])
+        metrics['seconds'] = time.monotonic() - started
+    metrics['bytes'] = sum(metrics.pop('files').values())
+    metrics.pop('started')
+    # Throughput chỉ tính trên thời gian truyền dữ liệu; seconds vẫn là tổng thời gian của cả bước
+    transfer_seconds = sum(metrics.pop('transfer').values()) or metrics['seconds']
+    metrics['transfer_seconds'] = transfer_seconds
+    metrics['throughput'] = metrics['bytes'] / transfer_seconds if transfer_seconds > 0 else 0.0
+
+    record_download(urlparse(url).netloc, 'video', metrics['bytes'], transfer_seconds)
+    if metrics['bytes'] > 0 and not rate_limit:
+        tuning[tuning_key] = _tune_connections(entry, connections, metrics['bytes'], transfer_seconds)
+        _save_tuning(tuning_dir, tuning)
+    return metrics
+
 def fetch_video_metadata(url, cookies_path):
     """Lấy metadata của video từ YouTube"""
-    import yt_dlp
+    yt_dlp = load_yt_dlp()
     ydl_opts = {
         'quiet': True, 
         'no_warnings': True, 
@@ -55,7 +349,7 @@ def fetch_video_metadata(url, cookies_path):
     if cookies_path and os.path.exists(cookies_path): 
         ydl_opts['cookiefile'] = cookies_path
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl: 
+        with ydl_session(ydl_opts) as ydl:
             return ydl.extract_info(url, download=False)
     except yt_dlp.utils.DownloadError as e:
         if 'HTTP Error 403' in str(e):
@@ -68,9 +362,66 @@ def fetch_video_metadata(url, cookies_path):
         print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
         raise Exception(f"Lỗi không xác định: {e}")
 
-def download_main_video(url, ffmpeg_path, dest_path, cookies_path):
-    """Tải video chính (có audio) từ YouTube"""
-    import yt_dlp
+def _flat_entry_url(entry):
+    """URL xem được của 1 mục trong danh sách flat (yt-dlp có thể chỉ trả id)"""
+    url = entry.get('url') or entry.get('webpage_url') or ''
+    if url.startswith('http'):
+        return url
+    if entry.get('ie_key') == 'Youtube' or (not url and entry.get('id')):
+        return f"https://www.youtube.com/watch?v={entry.get('id') or url}"
+    return url
+
+def fetch_playlist_entries(url, cookies_path, limit=None):
+    """Liệt kê video của playlist/kênh bằng 1 lần extract flat (không lấy metadata từng video).
+    Trả về (thông tin playlist, list {id, url, title, duration}); tab của kênh (Videos, Shorts...) được mở thêm 1 cấp"""
+    yt_dlp = load_yt_dlp()
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'encoding': 'utf-8',
+    }
+    if limit:
+        ydl_opts['playlistend'] = limit
+    if cookies_path and os.path.exists(cookies_path):
+        ydl_opts['cookiefile'] = cookies_path
+    entries, seen = [], set()
+    try:
+        with ydl_session(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            pending = [(info, 0)]
+            while pending and not (limit and len(entries) >= limit):
+                playlist, depth = pending.pop(0)
+                for entry in playlist.get('entries') or []:
+                    if not entry:
+                        continue
+                    if entry.get('_type') == 'playlist' or (entry.get('ie_key') == 'YoutubeTab' and depth == 0):
+                        # Kênh trả về các tab dưới dạng playlist con
+                        if depth == 0:
+                            child = entry if entry.get('entries') is not None else ydl.extract_info(_flat_entry_url(entry), download=False)
+                            pending.append((child, depth + 1))
+                        continue
+                    entry_url = _flat_entry_url(entry)
+                    if not entry_url or entry_url in seen:
+                        continue
+                    seen.add(entry_url)
+                    entries.append({
+                        'id': entry.get('id'), 'url': entry_url,
+                        'title': entry.get('title'), 'duration': entry.get('duration'),
+                    })
+                    if limit and len(entries) >= limit:
+                        break
+    except yt_dlp.utils.DownloadError as e:
+        print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
+        raise Exception(f"Lỗi lấy danh sách playlist: {e}")
+    playlist_info = {'id': info.get('id'), 'title': info.get('title'), 'webpage_url': info.get('webpage_url') or url}
+    return playlist_info, entries
+
+def download_main_video(url, ffmpeg_path, dest_path, cookies_path, backend='auto', tuning_dir=None,
+                        rate_limit=None, should_yield=None):
+    """Tải video chính (có audio) từ YouTube, trả về metrics tốc độ tải.
+    Tải nền: rate_limit (bytes/s) giới hạn băng thông, should_yield() trả True thì dừng với DownloadYielded"""
+    yt_dlp = load_yt_dlp()
     output_template = os.path.splitext(dest_path)[0]
     
     ydl_opts = {
@@ -79,7 +430,6 @@ def download_main_video(url, ffmpeg_path, dest_path, cookies_path):
         'outtmpl': f'{output_template}.%(ext)s',
         'ffmpeg_location': os.path.dirname(ffmpeg_path),
         'progress_hooks': [ytdlp_progress_hook], 
-        'concurrent_fragments': 10, 
         'noplaylist': True,
         'quiet': True, # Tắt log % download
         'no_warnings': True, # Tắt log cảnh báo
@@ -88,12 +438,16 @@ def download_main_video(url, ffmpeg_path, dest_path, cookies_path):
     
     if cookies_path and os.path.exists(cookies_path): 
         ydl_opts['cookiefile'] = cookies_path
+    if should_yield:
+        ydl_opts['progress_hooks'].append(_make_yield_hook(should_yield))
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl: 
-            ydl.download([url])
+        metrics = _run_tuned_download(url, ydl_opts, backend, os.path.dirname(ffmpeg_path), tuning_dir, rate_limit)
         final_dest_path_with_ext = f"{output_template}.mp4"
         if os.path.exists(final_dest_path_with_ext) and final_dest_path_with_ext != dest_path:
              os.rename(final_dest_path_with_ext, dest_path)
+        return metrics
+    except yt_dlp.utils.DownloadCancelled as e:
+        raise DownloadYielded(str(e))
     except yt_dlp.utils.DownloadError as e:
         if 'HTTP Error 403' in str(e):
             print(f"PYTHON_ERROR: Video yêu cầu cookies. {e}", file=sys.stderr, flush=True)
@@ -105,9 +459,9 @@ def download_main_video(url, ffmpeg_path, dest_path, cookies_path):
         print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
         raise Exception(f"Lỗi không xác định khi tải video: {e}")
 
-def download_audio_only(url, ffmpeg_path, dest_path, cookies_path):
-    """Tải audio từ YouTube"""
-    import yt_dlp
+def download_audio_only(url, ffmpeg_path, dest_path, cookies_path, rate_limit=None, should_yield=None):
+    """Tải audio từ YouTube (rate_limit / should_yield như download_main_video)"""
+    yt_dlp = load_yt_dlp()
     output_template = os.path.splitext(dest_path)[0]
     
     ydl_opts = {
@@ -128,8 +482,13 @@ def download_audio_only(url, ffmpeg_path, dest_path, cookies_path):
     
     if cookies_path and os.path.exists(cookies_path): 
         ydl_opts['cookiefile'] = cookies_path
+    if rate_limit:
+        ydl_opts['ratelimit'] = int(rate_limit)
+    if should_yield:
+        ydl_opts['progress_hooks'].append(_make_yield_hook(should_yield))
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        started = time.monotonic()
+        with governor.acquire('download', net=1), ydl_session(ydl_opts) as ydl:
             ydl.download([url])
             # yt-dlp sẽ tự động extract thành .mp3 với postprocessor
             # Tìm file .mp3 đã được tạo
@@ -147,6 +506,10 @@ def download_audio_only(url, ffmpeg_path, dest_path, cookies_path):
                         old_path = os.path.join(parent_dir, file)
                         os.rename(old_path, dest_path)
                         break
+        if os.path.exists(dest_path):
+            record_download(urlparse(url).netloc, 'audio', os.path.getsize(dest_path), time.monotonic() - started)
+    except yt_dlp.utils.DownloadCancelled as e:
+        raise DownloadYielded(str(e))
     except yt_dlp.utils.DownloadError as e:
         if 'HTTP Error 403' in str(e):
             print(f"PYTHON_ERROR: Video yêu cầu cookies. {e}", file=sys.stderr, flush=True)
@@ -157,10 +520,10 @@ def download_audio_only(url, ffmpeg_path, dest_path, cookies_path):
         print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
         raise Exception(f"Lỗi không xác định khi tải audio: {e}")
 
-def download_thumbnail(thumbnail_url, dest_path):
-    """Tải thumbnail từ URL"""
-    import urllib.request
-    urllib.request.urlretrieve(thumbnail_url, dest_path)
+def download_thumbnail(thumbnail_url, dest_path, cache_dir=None):
+    """Tải thumbnail từ URL qua HTTP session dùng chung (timeout, retry, cache ETag/Last-Modified)"""
+    from http_client import get_session
+    get_session(cache_dir).download(thumbnail_url, dest_path)
     if not os.path.exists(dest_path): 
         raise FileNotFoundError("Could not download thumbnail")
 
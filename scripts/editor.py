@@ -9,6 +9,10 @@ import argparse
 import base64
 import math
 import shutil
+import time
+import threading
+import contextlib
+import subprocess
 
 # --- SETUP ENCODING NGAY TỪ ĐẦU (giống ProjectRB) ---
 # Phải setup encoding TRƯỚC khi import bất kỳ module nào để tránh lỗi
@@ -27,245 +31,1117 @@ if sys.platform == 'win32':
         sys.stderr.reconfigure(encoding='utf-8', errors='replace')
 
 # Import các module (sau khi đã setup encoding)
-from utils import get_executable_path, sanitize_filename
-from downloader import (
-    ensure_yt_dlp, fetch_video_metadata, download_main_video, 
-    download_audio_only, download_thumbnail
-)
+from utils import get_executable_path, sanitize_filename, get_cache_dir
 from video_processor import (
-    run_command_with_live_output, get_video_duration, build_ffmpeg_filter
+    run_command_with_live_output, get_video_duration, get_video_fps, get_video_bitrate, build_ffmpeg_filter, OUTPUT_FPS,
+    build_audio_chain, plan_chunks, write_concat_list, visible_video_area, plan_layout_inputs, plan_video_streams, OUTPUT_WIDTH, OUTPUT_HEIGHT,
+    STILL_FPS
+)
+from process_runner import start_control_listener, control, ProcessCancelled
+from local_input import is_local_input, local_input_info, link_local_input, local_thumbnail
+from cache import MetadataCache, MetadataPrefetcher, DerivedCache, PinSet, touch, store_file, enforce_size_limit, MEDIA_CACHE_MAX_BYTES
+from job_store import default_db_path, JOB_STATUSES
+from planner import (
+    CostModel, PlanBuilder, EtaTracker, StageTimer, resolution_label, format_duration,
+    DEFAULT_AUDIO_BYTES_PER_SECOND, DEFAULT_VIDEO_BYTES_PER_SECOND, DEFAULT_THUMBNAIL_BYTES
+)
+from governor import governor, hw_family, lower_process_priority, MAX_THREADS_PER_STAGE
+import publisher
+from publisher import FragmentPublisher, OUTPUT_FORMATS, build_hooks, keyframe_args, muxer_args, is_fragmented
+from metrics import (
+    start_exporter, record_cache, record_part, record_failure, record_job, set_queue_depth, classify_error
 )
 
-def process_video(audio_url, video_url, video_speed,
-                  num_parts, save_path, part_duration, layout_file, encoder, 
-                  resources_path, user_data_path):
-    """Xử lý: tải audio+thumb từ link 1, video từ link 2, áp dụng tốc độ phát, ghép lại, duplicate nếu cần, rồi cắt"""
-    with open(layout_file, 'r', encoding='utf-8') as f: 
-        layout = json.load(f)
+# Chế độ chunk tự động: mỗi chunk dài ít nhất chừng này giây (chunk ngắn hơn thì chi phí khởi động ffmpeg lấn át)
+CHUNK_MIN_SECONDS = 120
+# Số phiên encode đồng thời an toàn cho NVENC/AMF/QSV trên card phổ thông
+HW_ENCODER_MAX_CHUNKS = 2
+# Thời gian chờ worker cục bộ tự thoát sau khi coordinator xong việc
+WORKER_EXIT_TIMEOUT = 10
+# Số luồng lấy metadata đầy đủ ở nền khi nhập cả playlist/kênh
+METADATA_PREFETCH_WORKERS = 4
+# Chế độ hàng chờ: chu kỳ lấy job mới từ kho và gia hạn lease cho job đang chạy
+QUEUE_FEED_INTERVAL = 1.0
+QUEUE_LEASE_RENEW_INTERVAL = 30
+# Tải trước link trong hàng chờ: băng thông tối đa (bytes/s) và chu kỳ kiểm tra job đang chạy khi đang nhường
+PREFETCH_RATE_LIMIT = 2 * 1024 ** 2
+PREFETCH_POLL_INTERVAL = 2.0
 
-    output_dir = save_path or os.path.join(user_data_path, "output")
-    temp_dir = os.path.join(user_data_path, "temp_files")
-    
-    os.makedirs(output_dir, exist_ok=True)
+def plan_parts(audio_duration, num_parts, part_duration):
+    """Thời lượng mỗi phần và số phần thực tế (part_duration <= 0: chia đều audio thành num_parts phần)"""
+    try:
+        part_duration = float(part_duration)
+    except ValueError:
+        part_duration = 0.0
+
+    if part_duration <= 0: 
+        actual_num_parts = num_parts
+        part_duration = audio_duration / num_parts 
+    else:
+        total_parts_by_duration = math.ceil(audio_duration / part_duration)
+        actual_num_parts = min(num_parts, total_parts_by_duration)
+    return part_duration, int(actual_num_parts)
+
+def node_suffix(index):
+    """Hậu tố tên bước của nguồn / stream video thứ index (nguồn đầu tiên giữ tên cũ: download_video, speed, ...)"""
+    return f"_{index + 1}" if index else ''
+
+def background_params(video_id, video_speed, source_fps, encoder, size=None):
+    """Khóa cache của video nền đã đổi tốc độ / lặp, kèm filter (fps, kích thước) và tham số encode tương ứng.
+    size=(rộng, cao): khung lớn nhất video nền chiếm trong layout, bản trung gian không cần lớn hơn"""
+    # Nguồn có fps cao hơn đầu ra được hạ fps ngay lúc encode trung gian vì lúc render cũng sẽ bỏ các frame đó
+    filters = [f"fps={OUTPUT_FPS}"] if source_fps and source_fps * video_speed > OUTPUT_FPS + 0.01 else []
+    if size:
+        # Chỉ thu nhỏ (không phóng to nguồn nhỏ hơn khung), giữ kích thước chẵn cho yuv420p
+        size = tuple(int(math.ceil(value / 2)) * 2 for value in size)
+        filters.append(f"scale='trunc(min(iw,{size[0]})/2)*2':'trunc(min(ih,{size[1]})/2)*2'")
+    encoder_args = intermediate_encoder_args(encoder)
+    params = {
+        'source': video_id, 'speed': video_speed, 'size': list(size) if size else None,
+        'fps': OUTPUT_FPS if filters and filters[0].startswith('fps=') else None, 'encoder': ' '.join(encoder_args),
+    }
+    return params, ','.join(filters) or None, encoder_args
+
+def loop_count_for(needed_duration, video_duration):
+    """Số vòng lặp video nền (đã đổi tốc độ) để dài ít nhất needed_duration. Bản lặp được cache theo số vòng chứ
+    không theo độ dài audio nên các job cần cùng số vòng dùng chung 1 file; lúc render mỗi phần tự seek và cắt"""
+    # Trừ hao 1 frame: độ dài thực của bản đổi tốc độ có thể ngắn hơn độ dài tính ra một chút
+    return int(math.ceil((needed_duration + 1.0 / OUTPUT_FPS) / video_duration))
+
+def plan_part_rates(job_paths, video_id, source_duration, video_speed, layout, part_segments, encoder,
+                    rate_control, target_kbps, derived_cache, timer):
+    """Rate control cho từng phần theo độ phức tạp của video nền. Phân tích (encode nhanh ở khung nhỏ) được cache
+    theo nguồn trong cache dẫn xuất nên mọi job dùng cùng video nền chỉ phân tích 1 lần.
+    job_paths: dict ffmpeg_path, source_video_path, analysis_dir"""
+    from rate_control import analysis_params as complexity_params, analyze_complexity, predict_bitrate, plan_rate, load_calibration
+    def produce(output_path):
+        with timer.stage('complexity', units=source_duration), governor.acquire('analysis', cpu=1):
+            analyze_complexity(job_paths['ffmpeg_path'], job_paths['source_video_path'], output_path)
+
+    path, hit = derived_cache.build(
+        'complexity', complexity_params(video_id), {'source': job_paths['source_video_path']}, '.rc.json', produce
+    )
+    record_cache('derived', hit)
+    with open(path, 'r', encoding='utf-8') as f:
+        analysis = json.load(f)
+    calibration = load_calibration(job_paths['analysis_dir'], encoder)
+    video_area = visible_video_area(layout)
+    rate_plan = []
+    for start, duration in part_segments:
+        predicted = predict_bitrate(analysis, start, duration, video_speed, source_duration, video_area, calibration)
+        rate_plan.append(plan_rate(predicted, rate_control, encoder, target_kbps))
+    return rate_plan
+
+def download_video_no_audio(url, video_id, output_path, temp_dir, ffmpeg_path, cookies_path, user_data_path,
+                            download_backend='auto', rate_limit=None, should_yield=None):
+    """Tải video không audio: luôn tải video+audio rồi tách audio để tránh phải chờ download 2 lần"""
+    from downloader import download_main_video, DownloadYielded
+    print(f"STATUS: Tải video+audio rồi tách audio...", flush=True)
+    temp_video_with_audio = os.path.join(temp_dir, f"{video_id}_temp.mp4")
+    try:
+        metrics = download_main_video(
+            url, ffmpeg_path, temp_video_with_audio, cookies_path,
+            backend=download_backend, tuning_dir=get_cache_dir(user_data_path, "downloader"),
+            rate_limit=rate_limit, should_yield=should_yield
+        )
+        if not os.path.exists(temp_video_with_audio):
+            raise Exception(f"Video không được tải thành công: {temp_video_with_audio}")
+        if metrics:
+            print(f"STATUS: Đã tải {metrics['bytes'] / 1048576:.1f} MB trong {metrics['seconds']:.1f}s "
+                  f"({metrics['throughput'] / 1048576:.2f} MB/s, {metrics['backend']}, {metrics['connections']} kết nối)", flush=True)
+        print(f"STATUS: Tách audio khỏi video...", flush=True)
+        cmd = [ffmpeg_path, '-y', '-i', temp_video_with_audio, '-c:v', 'copy', '-an', output_path]
+        with governor.acquire('copy'):
+            run_command_with_live_output(cmd)
+        if not os.path.exists(output_path):
+            raise Exception(f"Video sau khi tách audio không tồn tại: {output_path}")
+        return metrics
+    except DownloadYielded:
+        raise
+    except Exception as e:
+        print(f"PYTHON_ERROR: Lỗi khi tải video: {e}", flush=True)
+        raise
+    finally:
+        # Dọn dẹp file tạm (file .part của lượt tải dở được giữ lại để tải tiếp)
+        if os.path.exists(temp_video_with_audio):
+            try:
+                os.remove(temp_video_with_audio)
+            except:
+                pass
+
+def prepare_job(audio_url, video_url, video_speed, num_parts, part_duration, layout, encoder,
+                resources_path, user_data_path, temp_dir, silence_tolerance=0.0,
+                loudness_target=None, true_peak=-1.0, download_backend='auto', effects=(), effect_workers=0,
+                timer=None, output_format='mp4', publish_dir=None, publish_url=None, rate_control='fixed',
+                target_kbps=0, intro_file=None, outro_file=None, pins=None):
+    """Tải audio+thumb từ link 1, video từ link 2, áp dụng tốc độ phát, duplicate nếu cần và lên kế hoạch cắt.
+    Trả về dict job chứa mọi thứ render_part cần. timer (StageTimer) đo từng bước cho mô hình chi phí / ETA.
+    intro_file / outro_file: clip ghép vào đầu / cuối mỗi phần (encode 1 lần, ghép bằng concat -c copy)
+    pins (PinSet): giữ các file cache job dùng để job khác không xóa chúng; caller release() khi job kết thúc"""
+    from downloader import fetch_video_metadata, download_audio_only, download_thumbnail
+    from audio_analysis import analyze_audio, analysis_cached, plan_part_boundaries, build_loudness_filter
     os.makedirs(temp_dir, exist_ok=True)
-    
+    timer = timer or StageTimer()
     ffmpeg_path = get_executable_path("ffmpeg", resources_path)
     user_cookie_path = os.path.join(user_data_path, 'cookies.txt')
     cookies_path_to_use = user_cookie_path if os.path.exists(user_cookie_path) else ""
+    # Metadata và media đã tải được giữ lại giữa các job: job trúng cache không cần nạp yt-dlp
+    metadata_cache = MetadataCache(get_cache_dir(user_data_path, "metadata"))
+    media_dir = get_cache_dir(user_data_path, "media")
+
+    def hold(*paths):
+        if pins is not None:
+            pins.add(*paths)
+
+    def get_metadata(url, node):
+        info = metadata_cache.get(url)
+        record_cache('metadata', info is not None)
+        if info is None:
+            with timer.stage('metadata', units=1, node=node):
+                # Có thể đang được MetadataPrefetcher lấy ở nền: chờ kết quả đó thay vì lấy lần nữa
+                info, _ = metadata_cache.get_or_fetch(url, lambda u: fetch_video_metadata(u, cookies_path_to_use))
+        else:
+            timer.skip(node)
+        return info
+
+    def get_local(ref, kind, node):
+        # File local / tham chiếu cache: chỉ probe, không qua yt-dlp
+        timer.skip(node)
+        return local_input_info(ref, kind, media_dir, ffmpeg_path)
 
+    # Chỉ tải / decode nguồn mà layout thực sự hiện ra (không bị che hết, không nằm ngoài canvas)
+    layout_usage = plan_layout_inputs(layout)
+    video_streams = plan_video_streams(layout, video_speed)
+    needs_video = bool(video_streams)
+    needs_thumbnail = 'thumbnail-placeholder' in layout_usage
+
+    # Lấy thông tin từ link 1 (audio + thumbnail)
+    print("STATUS: Lấy thông tin từ Link 1 (Audio + Thumbnail)...", flush=True)
+    audio_local = is_local_input(audio_url)
     try:
-        # Lấy thông tin từ link 1 (audio + thumbnail)
-        print("STATUS: Lấy thông tin từ Link 1 (Audio + Thumbnail)...", flush=True)
-        try:
-            audio_info = fetch_video_metadata(audio_url, cookies_path_to_use)
-            audio_title, audio_id, thumbnail_url = audio_info['title'], audio_info['id'], audio_info['thumbnail']
-            sanitized_title = sanitize_filename(audio_title)
-        except Exception as e:
-            print(f"PYTHON_ERROR: Lỗi khi lấy metadata từ Link 1: {e}", flush=True)
-            raise Exception(f"Lỗi khi lấy metadata từ Link 1: {e}")
-        
-        # Tải audio và thumbnail từ link 1
+        audio_info = get_local(audio_url, 'audio', 'metadata_audio') if audio_local else get_metadata(audio_url, 'metadata_audio')
+        audio_title, audio_id, thumbnail_url = audio_info['title'], audio_info['id'], audio_info.get('thumbnail')
+        sanitized_title = sanitize_filename(audio_title)
+    except Exception as e:
+        record_failure('download', 'metadata')
+        print(f"PYTHON_ERROR: Lỗi khi lấy metadata từ Link 1: {e}", flush=True)
+        raise Exception(f"Lỗi khi lấy metadata từ Link 1: {e}")
+    
+    # Tải audio và thumbnail từ link 1
+    audio_path = os.path.join(media_dir, f"{audio_id}_audio.mp3")
+    if audio_local:
+        audio_path = link_local_input(audio_info, 'audio', temp_dir)
+        timer.skip('download_audio')
+    elif os.path.exists(audio_path):
+        record_cache('media', True)
+        print("STATUS: Dùng audio đã cache của Link 1.", flush=True)
+        touch(audio_path)
+        timer.skip('download_audio')
+    else:
+        record_cache('media', False)
         print("STATUS: Tải audio từ Link 1...", flush=True)
         try:
-            audio_path = os.path.join(temp_dir, f"{audio_id}_audio.mp3")
-            download_audio_only(audio_url, ffmpeg_path, audio_path, cookies_path_to_use)
-            if not os.path.exists(audio_path):
-                raise Exception(f"Audio không được tải thành công: {audio_path}")
+            temp_audio_path = os.path.join(temp_dir, f"{audio_id}_audio.mp3")
+            with timer.stage('download_audio') as record:
+                download_audio_only(audio_url, ffmpeg_path, temp_audio_path, cookies_path_to_use)
+                if not os.path.exists(temp_audio_path):
+                    raise Exception(f"Audio không được tải thành công: {temp_audio_path}")
+                record['units'] = os.path.getsize(temp_audio_path)
+            store_file(temp_audio_path, audio_path)
         except Exception as e:
+            record_failure('download', 'audio')
             print(f"PYTHON_ERROR: Lỗi khi tải audio từ Link 1: {e}", flush=True)
             raise
-        
+    if not audio_local:
+        hold(audio_path)
+    
+    thumbnail_path = os.path.join(media_dir, f"{audio_id}_thumb.jpg")
+    if not needs_thumbnail:
+        thumbnail_path = None
+        timer.skip('download_thumbnail')
+    elif audio_local:
+        # Thumbnail của audio local được tạo sau khi có video nền (dùng frame đầu nếu không có ảnh nào khác)
+        timer.skip('download_thumbnail')
+    elif os.path.exists(thumbnail_path):
+        record_cache('media', True)
+        touch(thumbnail_path)
+        timer.skip('download_thumbnail')
+    else:
+        record_cache('media', False)
         print("STATUS: Tải thumbnail từ Link 1...", flush=True)
         try:
-            thumbnail_path = os.path.join(temp_dir, f"{audio_id}_thumb.jpg")
-            download_thumbnail(thumbnail_url, thumbnail_path)
-            if not os.path.exists(thumbnail_path):
-                raise Exception(f"Thumbnail không được tải thành công: {thumbnail_path}")
+            temp_thumbnail_path = os.path.join(temp_dir, f"{audio_id}_thumb.jpg")
+            with timer.stage('download_thumbnail') as record:
+                download_thumbnail(thumbnail_url, temp_thumbnail_path, cache_dir=get_cache_dir(user_data_path, "http"))
+                if not os.path.exists(temp_thumbnail_path):
+                    raise Exception(f"Thumbnail không được tải thành công: {temp_thumbnail_path}")
+                record['units'] = os.path.getsize(temp_thumbnail_path)
+            store_file(temp_thumbnail_path, thumbnail_path)
         except Exception as e:
+            record_failure('download', 'thumbnail')
             print(f"PYTHON_ERROR: Lỗi khi tải thumbnail từ Link 1: {e}", flush=True)
             raise
-        
-        # Lấy thông tin từ link 2 (video)
-        print("STATUS: Lấy thông tin từ Link 2 (Video)...", flush=True)
+    if needs_thumbnail and not audio_local:
+        hold(thumbnail_path)
+    
+    # Video nền: mỗi nguồn (link 2 hoặc source riêng của layer) tải 1 lần; mỗi stream (nguồn + tốc độ) đổi tốc độ /
+    # lặp 1 lần. Chỉ khi layout thực sự hiện video
+    source_refs = []
+    for stream in video_streams:
+        ref = stream['source'] or video_url
+        if ref not in source_refs:
+            source_refs.append(ref)
+    source_refs.sort(key=lambda ref: ref != video_url)
+
+    def fetch_video(ref, suffix):
+        """Metadata + file video (không audio) của 1 nguồn video nền"""
+        label = "Link 2" if ref == video_url else ref
+        print(f"STATUS: Lấy thông tin từ {label} (Video)...", flush=True)
+        video_local = is_local_input(ref)
         try:
-            video_info = fetch_video_metadata(video_url, cookies_path_to_use)
+            video_info = get_local(ref, 'video', f'metadata_video{suffix}') if video_local else get_metadata(ref, f'metadata_video{suffix}')
             video_id = video_info['id']
         except Exception as e:
-            print(f"PYTHON_ERROR: Lỗi khi lấy metadata từ Link 2: {e}", flush=True)
-            raise Exception(f"Lỗi khi lấy metadata từ Link 2: {e}")
-        
-        # Hàm helper để tải video không audio
-        # Luôn tải video+audio rồi tách audio để tránh phải chờ download 2 lần
-        def download_video_no_audio(url, video_id, output_path):
-            print(f"STATUS: Tải video+audio rồi tách audio...", flush=True)
-            temp_video_with_audio = os.path.join(temp_dir, f"{video_id}_temp.mp4")
+            record_failure('download', 'metadata')
+            print(f"PYTHON_ERROR: Lỗi khi lấy metadata từ {label}: {e}", flush=True)
+            raise Exception(f"Lỗi khi lấy metadata từ {label}: {e}")
+    
+        # Tải video (không audio)
+        video_path = os.path.join(media_dir, f"{video_id}_video.mp4")
+        if video_local:
+            video_path = link_local_input(video_info, 'video', temp_dir)
+            timer.skip(f'download_video{suffix}')
+        elif os.path.exists(video_path):
+            record_cache('media', True)
+            print(f"STATUS: Dùng video đã cache của {label}.", flush=True)
+            touch(video_path)
+            timer.skip(f'download_video{suffix}')
+        else:
+            record_cache('media', False)
+            print(f"STATUS: Tải video từ {label} (không audio)...", flush=True)
             try:
-                download_main_video(url, ffmpeg_path, temp_video_with_audio, cookies_path_to_use)
-                if not os.path.exists(temp_video_with_audio):
-                    raise Exception(f"Video không được tải thành công: {temp_video_with_audio}")
-                print(f"STATUS: Tách audio khỏi video...", flush=True)
-                cmd = [ffmpeg_path, '-y', '-i', temp_video_with_audio, '-c:v', 'copy', '-an', output_path]
-                run_command_with_live_output(cmd)
-                if not os.path.exists(output_path):
-                    raise Exception(f"Video sau khi tách audio không tồn tại: {output_path}")
+                temp_video_path = os.path.join(temp_dir, f"{video_id}_video.mp4")
+                with timer.stage('download_video', node=f'download_video{suffix}') as record:
+                    metrics = download_video_no_audio(
+                        ref, video_id, temp_video_path, temp_dir, ffmpeg_path, cookies_path_to_use,
+                        user_data_path, download_backend=download_backend
+                    )
+                    if not os.path.exists(temp_video_path):
+                        raise Exception(f"Video không được tải thành công: {temp_video_path}")
+                    record['units'] = (metrics or {}).get('bytes') or os.path.getsize(temp_video_path)
+                store_file(temp_video_path, video_path)
             except Exception as e:
+                record_failure('download', 'video')
                 print(f"PYTHON_ERROR: Lỗi khi tải video: {e}", flush=True)
                 raise
-            finally:
-                # Dọn dẹp file tạm
-                if os.path.exists(temp_video_with_audio):
-                    try:
-                        os.remove(temp_video_with_audio)
-                    except:
-                        pass
-        
-        # Tải video (không audio)
-        print("STATUS: Tải video từ Link 2 (không audio)...", flush=True)
-        try:
-            video_path = os.path.join(temp_dir, f"{video_id}_video.mp4")
-            download_video_no_audio(video_url, video_id, video_path)
-            if not os.path.exists(video_path):
-                raise Exception(f"Video không được tải thành công: {video_path}")
-        except Exception as e:
-            print(f"PYTHON_ERROR: Lỗi khi tải video: {e}", flush=True)
-            raise
-        
-        # Lấy độ dài audio và video (trước khi áp dụng speed)
-        audio_duration = get_video_duration(audio_path, ffmpeg_path)
+        if not video_local:
+            hold(video_path)
+        return video_info, video_path
+
+    sources = {}
+    if needs_video:
+        for n, ref in enumerate(source_refs):
+            sources[ref] = fetch_video(ref, node_suffix(n))
+        timer.resolution = resolution_label(sources[source_refs[0]][0].get('height'))
+    else:
+        print("STATUS: Layout không hiện video nền, bỏ qua Link 2 (render ảnh tĩnh).", flush=True)
+        for node in ('metadata_video', 'download_video', 'speed', 'loop'):
+            timer.skip(node)
+    if audio_local and needs_thumbnail:
+        first_video = sources[source_refs[0]][1] if sources else None
+        thumbnail_path = local_thumbnail(audio_info, temp_dir, ffmpeg_path, fallback_video=first_video)
+    enforce_size_limit(media_dir, MEDIA_CACHE_MAX_BYTES,
+                       keep=tuple(p for p in (audio_path, thumbnail_path) if p) + tuple(p for _, p in sources.values()))
+    
+    # Lấy độ dài audio
+    audio_duration = get_video_duration(audio_path, ffmpeg_path)
+    if audio_duration <= 0:
+        raise Exception("Không thể lấy độ dài audio.")
+    
+    # Video đổi tốc độ / lặp lại được cache theo (nguồn, tốc độ, kích thước, fps, encoder) và dùng chung giữa các job
+    derived_cache = DerivedCache(get_cache_dir(user_data_path, "derived"))
+
+    def prepare_stream(stream, video_id, video_path, suffix):
+        """Đổi tốc độ / lặp nguồn cho 1 stream, đủ dài cho cả job tính từ lead của stream.
+        Trả về (đường dẫn, độ dài nguồn trước khi đổi tốc độ)"""
+        video_speed = stream['speed']
         original_video_duration = get_video_duration(video_path, ffmpeg_path)
-        
-        if audio_duration <= 0:
-            raise Exception("Không thể lấy độ dài audio.")
         if original_video_duration <= 0:
             raise Exception("Không thể lấy độ dài video.")
-        
+        # Phần đầu bị offset của layer bỏ qua cũng phải có trong bản lặp
+        needed_duration = round(audio_duration + stream['lead'] + max(stream['layers'].values()), 3)
+        needs_transform = video_speed != 1.0 or original_video_duration / video_speed < needed_duration
+        source_fps = get_video_fps(video_path, ffmpeg_path) if needs_transform else None
+        derived_params, frame_filter, encoder_args = background_params(
+            video_id, video_speed, source_fps, encoder, size=stream['size']
+        )
+    
         # Áp dụng tốc độ phát cho video nếu khác 1.0
         if video_speed != 1.0:
             print(f"STATUS: Áp dụng tốc độ phát {video_speed}x cho Video...", flush=True)
-            speeded_video_path = os.path.join(temp_dir, f"{video_id}_video_speeded.mp4")
-            cmd = [
-                ffmpeg_path, '-y', '-i', video_path,
-                '-filter:v', f'setpts=PTS/{video_speed}',
-                '-an'
-            ]
-            if 'nvenc' in encoder:
-                cmd += ['-c:v', encoder, '-preset', 'p5', '-cq', '23', '-b:v', '0']
-            elif 'amf' in encoder:
-                cmd += ['-c:v', encoder, '-quality', 'balanced', '-qp', '23']
-            elif 'qsv' in encoder:
-                cmd += ['-c:v', encoder, '-preset', 'medium', '-global_quality', '23']
-            else:
-                cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-threads', '4']
-            cmd.append(speeded_video_path)
-            run_command_with_live_output(cmd)
-            video_path = speeded_video_path
+
+            speed_input = video_path
+
+            def make_speeded(output_path):
+                filters = ','.join(f for f in (f'setpts=PTS/{video_speed}', frame_filter) if f)
+                with timer.stage('speed', units=original_video_duration, node=f'speed{suffix}'), \
+                        governor.acquire('transcode', cpu=encode_cpu_range(encoder), encoder=encoder) as grant:
+                    run_command_with_live_output(
+                        [ffmpeg_path, '-y', '-i', speed_input, '-filter:v', filters, '-an']
+                        + intermediate_encoder_args(encoder, grant.threads) + [output_path]
+                    )
+
+            video_path, hit = derived_cache.build('speeded', derived_params, {'source': speed_input}, '.mp4', make_speeded)
+            hold(video_path)
+            record_cache('derived', hit)
+            if hit:
+                print("STATUS: Dùng video đã đổi tốc độ từ cache.", flush=True)
+                timer.skip(f'speed{suffix}')
             # Duration sau khi áp dụng speed = original_duration / speed
             video_duration = original_video_duration / video_speed
         else:
             video_duration = original_video_duration
-        
-        # Nếu video ngắn hơn audio, duplicate video cho bằng audio
-        if video_duration < audio_duration:
-            print(f"STATUS: Video ({video_duration:.2f}s) ngắn hơn Audio ({audio_duration:.2f}s). Đang duplicate video...", flush=True)
-            loop_count = int(math.ceil(audio_duration / video_duration))
-            looped_video_path = os.path.join(temp_dir, f"{video_id}_video_looped.mp4")
-            cmd = [
-                ffmpeg_path, '-y', '-stream_loop', str(loop_count), '-i', video_path,
-                '-t', str(audio_duration), '-an'
-            ]
-            if 'nvenc' in encoder:
-                cmd += ['-c:v', encoder, '-preset', 'p5', '-cq', '23', '-b:v', '0']
-            elif 'amf' in encoder:
-                cmd += ['-c:v', encoder, '-quality', 'balanced', '-qp', '23']
-            elif 'qsv' in encoder:
-                cmd += ['-c:v', encoder, '-preset', 'medium', '-global_quality', '23']
+    
+        # Nếu video ngắn hơn audio (cộng phần offset), duplicate video cho đủ
+        if video_duration < needed_duration:
+            print(f"STATUS: Video ({video_duration:.2f}s) ngắn hơn Audio ({needed_duration:.2f}s). Đang duplicate video...", flush=True)
+            loop_count = loop_count_for(needed_duration, video_duration)
+            # Bản đã đổi tốc độ đã được hạ fps / thu nhỏ nên lúc lặp không cần filter nữa
+            loop_filter = frame_filter if video_speed == 1.0 else None
+            loop_input = video_path
+
+            def make_looped(output_path):
+                # -stream_loop N phát thêm N lần sau lần đầu: đúng loop_count vòng trọn vẹn, không cắt theo audio
+                cmd = [ffmpeg_path, '-y', '-stream_loop', str(loop_count - 1), '-i', loop_input, '-an']
+                if loop_filter:
+                    cmd += ['-filter:v', loop_filter]
+                with timer.stage('loop', units=loop_count * video_duration, node=f'loop{suffix}'), \
+                        governor.acquire('transcode', cpu=encode_cpu_range(encoder), encoder=encoder) as grant:
+                    run_command_with_live_output(cmd + intermediate_encoder_args(encoder, grant.threads) + [output_path])
+
+            looped_params = dict(derived_params, loops=loop_count)
+            video_path, hit = derived_cache.build('looped', looped_params, {'source': loop_input}, '.mp4', make_looped,
+                                                  keep=(loop_input,))
+            hold(video_path)
+            record_cache('derived', hit)
+            if hit:
+                print("STATUS: Dùng video đã lặp từ cache.", flush=True)
+                timer.skip(f'loop{suffix}')
+        return video_path, original_video_duration
+
+    # Mỗi stream là 1 input của lệnh render; layer cùng stream được split trong graph
+    video_paths, stream_specs = {}, []
+    primary = None
+    for n, stream in enumerate(video_streams):
+        video_info, source_path = sources[stream['source'] or video_url]
+        stream_id = f"v{n}"
+        video_paths[stream_id], original_duration = prepare_stream(stream, video_info['id'], source_path, node_suffix(n))
+        # Frame rate của video nguồn cuối cùng: chỉ thêm filter fps khi nguồn cao hơn fps đầu ra
+        stream_specs.append({
+            'id': stream_id, 'lead': stream['lead'], 'layers': stream['layers'],
+            'fps': get_video_fps(video_paths[stream_id], ffmpeg_path),
+        })
+        if primary is None:
+            # Rate control theo độ phức tạp của stream đầu tiên
+            primary = {'video_id': video_info['id'], 'path': source_path, 'duration': original_duration,
+                       'speed': stream['speed']}
+    
+    # Tính toán số phần và thời lượng mỗi phần
+    part_duration, actual_num_parts = plan_parts(audio_duration, num_parts, part_duration)
+    
+    # Phân tích audio 1 lần cho cả job: envelope để cắt tại khoảng lặng, loudness để chuẩn hoá âm lượng
+    part_segments = [(i * part_duration, part_duration) for i in range(actual_num_parts)]
+    audio_filter = None
+    want_envelope = silence_tolerance > 0 and actual_num_parts > 0
+    want_loudness = bool(loudness_target)
+    if want_envelope or want_loudness:
+        print("STATUS: Phân tích audio (khoảng lặng / loudness)...", flush=True)
+        envelope, loudness = None, None
+        analysis_dir = get_cache_dir(user_data_path, "analysis")
+        try:
+            if analysis_cached(analysis_dir, audio_id, want_envelope, want_loudness):
+                timer.skip('analysis')
+                envelope, loudness = analyze_audio(
+                    audio_path, ffmpeg_path, analysis_dir, audio_id,
+                    want_envelope=want_envelope, want_loudness=want_loudness
+                )
             else:
-                cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-threads', '4']
-            cmd.append(looped_video_path)
-            run_command_with_live_output(cmd)
-            video_path = looped_video_path
-            video_duration = audio_duration
-        
-        # Tính toán số phần và thời lượng mỗi phần
+                with timer.stage('analysis', units=audio_duration), governor.acquire('analysis', cpu=1):
+                    envelope, loudness = analyze_audio(
+                        audio_path, ffmpeg_path, analysis_dir, audio_id,
+                        want_envelope=want_envelope, want_loudness=want_loudness
+                    )
+        except ImportError as e:
+            # Thiếu numpy: vẫn đo loudness, chỉ bỏ phần cắt theo khoảng lặng
+            print(f"WARNING: Thiếu thư viện phân tích audio ({e}), dùng mốc cắt cố định", flush=True)
+            if want_loudness:
+                try:
+                    _, loudness = analyze_audio(
+                        audio_path, ffmpeg_path, get_cache_dir(user_data_path, "analysis"), audio_id,
+                        want_envelope=False, want_loudness=True
+                    )
+                except Exception as e:
+                    print(f"WARNING: Không thể đo loudness: {e}", flush=True)
+        except Exception as e:
+            print(f"WARNING: Không thể phân tích audio, dùng mốc cắt cố định: {e}", flush=True)
+        if envelope is not None:
+            part_segments = plan_part_boundaries(envelope, audio_duration, part_duration, actual_num_parts, silence_tolerance)
+        if loudness is not None:
+            audio_filter = build_loudness_filter(loudness, loudness_target, true_peak)
+            print(f"STATUS: Loudness gốc {loudness['integrated']:.1f} LUFS, peak {loudness['true_peak']:.1f} dBTP -> {loudness_target:.1f} LUFS", flush=True)
+    
+    rate_plan = None
+    if rate_control != 'fixed' and part_segments and needs_video:
+        print("STATUS: Lập kế hoạch rate control theo độ phức tạp video nền...", flush=True)
         try:
-            part_duration = float(part_duration)
-        except ValueError:
-            part_duration = 0.0
+            rate_plan = plan_part_rates(
+                {'ffmpeg_path': ffmpeg_path, 'source_video_path': primary['path'],
+                 'analysis_dir': get_cache_dir(user_data_path, "analysis")},
+                primary['video_id'], primary['duration'], primary['speed'], layout, part_segments, encoder,
+                rate_control, target_kbps, derived_cache, timer
+            )
+            for i, rate in enumerate(rate_plan):
+                print(f"STATUS: Part {i + 1}: chất lượng {rate['quality']}, trần {rate['maxrate']}k "
+                      f"(dự kiến {rate['predicted_kbps']}k)", flush=True)
+        except ProcessCancelled:
+            raise
+        except Exception as e:
+            print(f"WARNING: Không phân tích được độ phức tạp, dùng chất lượng cố định: {e}", flush=True)
+    
+    # Không có video nào hiện ra: render ảnh tĩnh ở fps thấp (hiệu ứng frame vẫn cần fps đầy đủ)
+    fps = STILL_FPS if not needs_video and not effects else OUTPUT_FPS
+    bumper_paths = {}
+    if intro_file or outro_file:
+        bumper_paths = prepare_bumpers(
+            {'intro': intro_file, 'outro': outro_file}, encoder, fps, output_format, ffmpeg_path,
+            DerivedCache(get_cache_dir(user_data_path, "derived"))
+        )
+        hold(*bumper_paths.values())
+    
+    # Ảnh trong layout được giải mã ra file 1 lần cho cả job (bỏ ảnh bị che hết / ngoài canvas)
+    image_paths = {}
+    for item in layout:
+        if item['id'] in layout_usage and item['type'] == 'image' and item['source'] and item['source'].startswith('data:image'):
+            try:
+                header, encoded = item['source'].split(',', 1)
+                image_format = header.split(';')[0].split('/')[1]
+                image_data = base64.b64decode(encoded)
+                temp_image_path = os.path.join(temp_dir, f"temp_img_{item['id']}.{image_format}")
+                with open(temp_image_path, 'wb') as img_f: 
+                    img_f.write(image_data)
+                image_paths[item['id']] = temp_image_path
+            except Exception as e: 
+                print(f"Warning: Could not process image {item['id']}: {e}")
+    
+    return {
+        'title': sanitized_title,
+        'audio_id': audio_id,
+        'video_id': primary['video_id'] if primary else None,
+        'audio_path': audio_path,
+        'thumbnail_path': thumbnail_path,
+        'video_paths': video_paths,
+        'video_streams': stream_specs,
+        'fps': fps,
+        'intro_path': bumper_paths.get('intro'),
+        'outro_path': bumper_paths.get('outro'),
+        'resolution': timer.resolution,
+        'image_paths': image_paths,
+        'audio_duration': audio_duration,
+        'segments': part_segments,
+        'audio_filter': audio_filter,
+        'layout': layout,
+        'encoder': encoder,
+        'ffmpeg_path': ffmpeg_path,
+        'resources_path': resources_path,
+        'temp_dir': temp_dir,
+        'analysis_dir': get_cache_dir(user_data_path, "analysis"),
+        'effects': list(effects),
+        'effect_workers': effect_workers,
+        'rate_plan': rate_plan,
+        'output_format': output_format,
+        'publish_dir': publish_dir,
+        'publish_url': publish_url,
+    }
+
+def plan_job(audio_url, video_url, video_speed, num_parts, part_duration, encoder, resources_path, user_data_path,
+             silence_tolerance=0.0, loudness_target=None, model=None, layout=None):
+    """Kế hoạch chạy của 1 job: chỉ lấy metadata (qua cache) và probe file đã có trong cache, không tải media.
+    Mỗi bước của DAG có dự đoán byte tải, CPU-giây và thời gian chạy; bước trúng cache có chi phí 0.
+    layout: bỏ các bước của nguồn layout không hiện ra (None = coi như dùng cả video nền lẫn thumbnail)"""
+    from downloader import fetch_video_metadata
+    from audio_analysis import analysis_cached
+    ffmpeg_path = get_executable_path("ffmpeg", resources_path)
+    user_cookie_path = os.path.join(user_data_path, 'cookies.txt')
+    cookies_path_to_use = user_cookie_path if os.path.exists(user_cookie_path) else ""
+    metadata_cache = MetadataCache(get_cache_dir(user_data_path, "metadata"))
+    media_dir = get_cache_dir(user_data_path, "media")
+    layout_usage = plan_layout_inputs(layout) if layout is not None else None
+    if layout is None:
+        # Không có layout: 1 layer video nền từ link 2 như trước
+        video_streams = [{'source': None, 'speed': video_speed, 'lead': 0.0, 'layers': {'video-placeholder': 0.0},
+                          'size': None}]
+    else:
+        video_streams = plan_video_streams(layout, video_speed)
+    needs_thumbnail = layout_usage is None or 'thumbnail-placeholder' in layout_usage
+
+    def get_metadata(url, kind):
+        if is_local_input(url):
+            # File local / tham chiếu cache: có sẵn, không có bước lấy metadata hay tải
+            return local_input_info(url, kind, media_dir, ffmpeg_path), True
+        info = metadata_cache.get(url)
+        if info is not None:
+            return info, True
+        return metadata_cache.put(url, fetch_video_metadata(url, cookies_path_to_use)), False
+
+    def probe_duration(path, info):
+        return get_video_duration(path, ffmpeg_path) if os.path.exists(path) else float(info.get('duration') or 0)
+
+    audio_info, audio_meta_cached = get_metadata(audio_url, 'audio')
+    audio_id = audio_info['id']
+    audio_path = audio_info['path'] if audio_info.get('local') else os.path.join(media_dir, f"{audio_id}_audio.mp3")
+    # Thumbnail của audio local được tạo từ file có sẵn, không tải
+    thumbnail_path = audio_path if audio_info.get('local') else os.path.join(media_dir, f"{audio_id}_thumb.jpg")
+    audio_duration = probe_duration(audio_path, audio_info)
+    if audio_duration <= 0:
+        raise Exception("Không xác định được độ dài audio/video từ metadata.")
+    # Mỗi nguồn video nền (link 2 / source riêng của layer) được lấy metadata và tải 1 lần
+    source_refs = []
+    for stream in video_streams:
+        ref = stream['source'] or video_url
+        if ref not in source_refs:
+            source_refs.append(ref)
+    source_refs.sort(key=lambda ref: ref != video_url)
+    sources = {}
+    for ref in source_refs:
+        video_info, video_meta_cached = get_metadata(ref, 'video')
+        video_path = video_info['path'] if video_info.get('local') else os.path.join(media_dir, f"{video_info['id']}_video.mp4")
+        video_duration = probe_duration(video_path, video_info)
+        if video_duration <= 0:
+            raise Exception("Không xác định được độ dài audio/video từ metadata.")
+        sources[ref] = (video_info, video_meta_cached, video_path, video_duration)
+    first_video = sources[source_refs[0]] if source_refs else ({}, True, None, 0.0)
+
+    builder = PlanBuilder(model or CostModel(), encoder, resolution_label(first_video[0].get('height')))
+    builder.add('metadata_audio', 'metadata', 1, cached=audio_meta_cached, label="Metadata Link 1")
+    audio_bytes = audio_duration * DEFAULT_AUDIO_BYTES_PER_SECOND
+    builder.add('download_audio', 'download_audio', audio_bytes, deps=['metadata_audio'],
+                cached=os.path.exists(audio_path), bytes=audio_bytes, label="Tải audio")
+    thumbnail = None
+    if needs_thumbnail:
+        thumbnail = builder.add('download_thumbnail', 'download_thumbnail', DEFAULT_THUMBNAIL_BYTES, deps=['metadata_audio'],
+                                cached=os.path.exists(thumbnail_path), bytes=DEFAULT_THUMBNAIL_BYTES, label="Tải thumbnail")
+    downloads = {}
+    for n, ref in enumerate(source_refs):
+        video_info, video_meta_cached, video_path, video_duration = sources[ref]
+        suffix = node_suffix(n)
+        builder.add(f'metadata_video{suffix}', 'metadata', 1, cached=video_meta_cached,
+                    label="Metadata Link 2" if ref == video_url else f"Metadata video {n + 1}")
+        video_bytes = (video_info.get('filesize') or video_info.get('filesize_approx')
+                       or (video_info.get('tbr') or 0) * 125 * video_duration
+                       or video_duration * DEFAULT_VIDEO_BYTES_PER_SECOND)
+        downloads[ref] = builder.add(f'download_video{suffix}', 'download_video', video_bytes,
+                                     deps=[f'metadata_video{suffix}'], cached=os.path.exists(video_path),
+                                     bytes=video_bytes, label=f"Tải video{suffix.replace('_', ' ')}")
+
+    # Mỗi stream (nguồn + tốc độ) đổi tốc độ / lặp 1 lần; bước trúng cache dẫn xuất có chi phí 0
+    derived_cache = DerivedCache(get_cache_dir(user_data_path, "derived"))
+    backgrounds = []
+    # Các stream cùng nguồn + tốc độ dùng chung 1 bản đổi tốc độ
+    speeded_nodes = {}
+    for n, stream in enumerate(video_streams):
+        ref = stream['source'] or video_url
+        video_info, _, video_path, video_duration = sources[ref]
+        suffix, speed = node_suffix(n), stream['speed']
+        video_cached = os.path.exists(video_path)
+        source_fps = get_video_fps(video_path, ffmpeg_path) if video_cached else video_info.get('fps')
+        needed_duration = round(audio_duration + stream['lead'] + max(stream['layers'].values()), 3)
+        derived_params, _, _ = background_params(video_info['id'], speed, source_fps, encoder, size=stream['size'])
+        background = downloads[ref]
+        loop_source = video_path if video_cached else None
+        if speed != 1.0:
+            loop_source = derived_cache.get('speeded', derived_params, {'source': video_path}, '.mp4') if video_cached else None
+            if (ref, speed) not in speeded_nodes:
+                speeded_nodes[(ref, speed)] = builder.add(f'speed{suffix}', 'speed', video_duration, deps=[background],
+                                                          cached=bool(loop_source), label=f"Đổi tốc độ {speed}x")
+            background = speeded_nodes[(ref, speed)]
+        if video_duration / speed < needed_duration:
+            loop_count = loop_count_for(needed_duration, video_duration / speed)
+            looped_params = dict(derived_params, loops=loop_count)
+            looped = derived_cache.get('looped', looped_params, {'source': loop_source}, '.mp4') if loop_source else None
+            background = builder.add(f'loop{suffix}', 'loop', loop_count * video_duration / speed, deps=[background],
+                                     cached=bool(looped),
+                                     label="Lặp video")
+        backgrounds.append(background)
+
+    part_duration, actual_num_parts = plan_parts(audio_duration, num_parts, part_duration)
+    want_envelope = silence_tolerance > 0 and actual_num_parts > 0
+    want_loudness = bool(loudness_target)
+    analysis = None
+    if want_envelope or want_loudness:
+        analysis = builder.add(
+            'analysis', 'analysis', audio_duration, deps=['download_audio'],
+            cached=analysis_cached(get_cache_dir(user_data_path, "analysis"), audio_id, want_envelope, want_loudness),
+            label="Phân tích audio"
+        )
+    for i in range(actual_num_parts):
+        builder.add(
+            f"part{i + 1}", 'render_part', max(0.0, min(part_duration, audio_duration - i * part_duration)),
+            deps=backgrounds + [thumbnail, 'download_audio', analysis], label=f"Render Part {i + 1}"
+        )
+    plan = builder.build()
+    plan.update(title=audio_info.get('title'), audio_duration=audio_duration, video_duration=first_video[3],
+                parts=actual_num_parts)
+    return plan
+
+def print_plan(plan):
+    """In kế hoạch cho người đọc (STATUS) và cho app (1 dòng PLAN:<json>)"""
+    for node in plan['nodes']:
+        details = [f"CPU {format_duration(node['cpu_seconds'])}"]
+        if node['bytes']:
+            details.append(f"{node['bytes'] / 1048576:.1f} MB")
+        details.append('cache' if node['cached'] else node['model'])
+        print(f"STATUS: [plan] {node['label']}: {format_duration(node['wall_seconds'])} ({', '.join(details)})", flush=True)
+    total = plan['total']
+    print(f"STATUS: [plan] Tổng: {format_duration(total['wall_seconds'])}, CPU {format_duration(total['cpu_seconds'])}, "
+          f"tải {total['download_bytes'] / 1048576:.1f} MB", flush=True)
+    print(f"PLAN:{json.dumps(plan, ensure_ascii=False)}", flush=True)
+
+def load_layout(layout_file):
+    """Layout cho --plan (None khi không có file: kế hoạch tính cả video nền lẫn thumbnail)"""
+    if not layout_file:
+        return None
+    with open(layout_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def plan_queue(queue_file, workers, defaults, resources_path, user_data_path, db_path=None):
+    """Kế hoạch cho cả file hàng chờ: từng job + thời gian cả lô khi chạy trên `workers` worker"""
+    from job_store import JobStore
+    store = JobStore(db_path or default_db_path(user_data_path))
+    model = CostModel(store)
+    jobs = []
+    try:
+        with open(queue_file, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        for entry in entries:
+            options = dict(defaults)
+            options.update(entry)
+            try:
+                plan = plan_job(
+                    options['audio_url'], options['video_url'], float(options.get('video_speed', 1.0)),
+                    int(options['parts']), options['part_duration'], options['encoder'], resources_path, user_data_path,
+                    silence_tolerance=options['silence_tolerance'], loudness_target=options['loudness_target'], model=model,
+                    layout=load_layout(options.get('layout_file'))
+                )
+            except Exception as e:
+                print(f"WARNING: Không lập được kế hoạch cho {entry.get('id') or options['audio_url']}: {e}", flush=True)
+                continue
+            plan['id'] = entry.get('id')
+            jobs.append(plan)
+    finally:
+        store.close()
+    # Ước lượng thời gian cả lô: job dài nhất được giao trước cho worker rảnh sớm nhất
+    loads = [0.0] * max(1, workers)
+    for plan in sorted(jobs, key=lambda p: -p['total']['wall_seconds']):
+        loads[loads.index(min(loads))] += plan['total']['wall_seconds']
+    total = {
+        'jobs': len(jobs),
+        'wall_seconds': sum(p['total']['wall_seconds'] for p in jobs),
+        'cpu_seconds': sum(p['total']['cpu_seconds'] for p in jobs),
+        'download_bytes': sum(p['total']['download_bytes'] for p in jobs),
+        'batch_seconds': max(loads),
+    }
+    for plan in jobs:
+        print(f"STATUS: [plan] {plan.get('id') or plan['title']}: {format_duration(plan['total']['wall_seconds'])}", flush=True)
+    print(f"STATUS: [plan] Cả lô {len(jobs)} job trên {len(loads)} worker: khoảng {format_duration(total['batch_seconds'])}", flush=True)
+    print(f"PLAN:{json.dumps({'jobs': jobs, 'total': total}, ensure_ascii=False)}", flush=True)
+
+def intermediate_encoder_args(encoder, threads=None):
+    """Tham số encode video trung gian (đổi tốc độ / lặp) trước khi render.
+    Khóa cache dùng số thread mặc định; threads là phần governor cấp lúc encode thật"""
+    if 'nvenc' in encoder:
+        return ['-c:v', encoder, '-preset', 'p5', '-cq', '23', '-b:v', '0']
+    elif 'amf' in encoder:
+        return ['-c:v', encoder, '-quality', 'balanced', '-qp', '23']
+    elif 'qsv' in encoder:
+        return ['-c:v', encoder, '-preset', 'medium', '-global_quality', '23']
+    return ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-threads', str(threads or 4)]
+
+def encode_cpu_range(encoder, threads=None):
+    """Số core xin governor cho 1 tiến trình encode: encoder phần cứng chỉ cần 1 core, libx264 nhận 1..6 tùy tải
+    (threads cố định khi các chunk phải encode giống hệt nhau)"""
+    if hw_family(encoder):
+        return 1
+    return threads or (1, MAX_THREADS_PER_STAGE)
+
+def video_encoder_args(encoder, threads=None, rate=None, still=False):
+    """Tham số encoder video dùng chung cho cả phần lẫn từng chunk (chunk phải encode giống hệt để ghép -c copy).
+    rate: tham số rate control theo độ phức tạp của phần (None = chất lượng cố định 23).
+    still: layout chỉ có ảnh tĩnh, libx264 dùng tune stillimage"""
+    from rate_control import rate_args
+    # Ưu tiên GPU: giảm CPU threads xuống 1 khi dùng GPU encoder để GPU làm nhiều việc hơn
+    if 'nvenc' in encoder: 
+        return ['-c:v', encoder, '-preset', 'p5'] + rate_args(encoder, rate) + ['-threads', '1']
+    elif 'amf' in encoder: 
+        return ['-c:v', encoder, '-quality', 'balanced'] + rate_args(encoder, rate) + ['-threads', '1']
+    elif 'qsv' in encoder: 
+        return ['-c:v', encoder, '-preset', 'medium'] + rate_args(encoder, rate) + ['-threads', '1']
+    # CPU encoder: dùng nhiều threads hơn
+    if threads is None:
+        cpu_count = os.cpu_count() or 4
+        threads = min(cpu_count - 1, 6)  # Giữ lại 1 core cho hệ thống, tối đa 6 threads
+    tune = ['-tune', 'stillimage'] if still else []
+    return ['-c:v', 'libx264', '-preset', 'veryfast'] + tune + rate_args(encoder, rate) + ['-threads', str(threads)]
+
+def job_bumpers(job):
+    """(intro, outro) đã encode sẵn của job, phần tử None nếu không có"""
+    return job.get('intro_path'), job.get('outro_path')
+
+def has_bumpers(job):
+    return any(job_bumpers(job))
+
+def audio_encoder_args(job):
+    """Tham số encoder audio của phần; có bumper thì ép cùng sample rate / số kênh với bumper"""
+    from bumpers import AUDIO_FORMAT_ARGS
+    return ['-c:a', 'aac', '-b:a', '192k'] + (AUDIO_FORMAT_ARGS if has_bumpers(job) else [])
+
+def bumper_video_args(job):
+    """Profile / level cố định khi phần được ghép với bumper (rỗng nếu không có bumper)"""
+    from bumpers import pinned_video_args
+    return pinned_video_args(job['encoder']) if has_bumpers(job) else []
+
+def prepare_bumpers(sources, encoder, fps, output_format, ffmpeg_path, derived_cache):
+    """Encode từng bumper ({'intro': path, 'outro': path}) 1 lần theo tham số encode của phần, cache theo
+    (nguồn, encoder, fps, định dạng) nên các job sau dùng lại. Trả về {loại: đường dẫn đã encode}"""
+    from bumpers import BUMPER_KINDS, resolve_bumper, bumper_params, encode_bumper
+    encoded = {}
+    for kind in BUMPER_KINDS:
+        if not sources.get(kind):
+            continue
+        source_path = resolve_bumper(sources[kind])
+
+        def produce(output_path, source_path=source_path):
+            print(f"STATUS: Encode {kind} theo tham số của phần...", flush=True)
+            with governor.acquire('transcode', cpu=encode_cpu_range(encoder), encoder=encoder) as grant:
+                encode_bumper(ffmpeg_path, source_path, output_path, fps, encoder,
+                              video_encoder_args(encoder, grant.threads), output_format)
+
+        encoded[kind], hit = derived_cache.build(
+            'bumper', bumper_params(source_path, encoder, fps, output_format), {'source': source_path}, '.mp4', produce
+        )
+        record_cache('derived', hit)
+        if hit:
+            print(f"STATUS: Dùng {kind} đã encode từ cache.", flush=True)
+    return encoded
 
-        if part_duration <= 0: 
-            actual_num_parts = num_parts
-            part_duration = audio_duration / num_parts 
+def job_fps(job):
+    """fps đầu ra của job (job cũ / job từ coordinator cũ không có trường fps)"""
+    return job.get('fps') or OUTPUT_FPS
+
+def part_rate(job, part_index):
+    """Tham số rate control đã chọn cho 1 phần (None khi dùng chất lượng cố định)"""
+    rate_plan = job.get('rate_plan')
+    return rate_plan[part_index] if rate_plan else None
+
+def build_part_command(job, part_index, output_path, threads=None, window=None, frames=None, raw=False):
+    """Dựng lệnh ffmpeg render 1 phần của job. Trả về (cmd, thời lượng phần).
+    window=(start, duration) + frames: chỉ render video của 1 chunk trong phần, đúng số frame đã cho.
+    raw=True: xuất video thô rgb24 (frames frame) ra output_path (thường là '-') cho stage hiệu ứng"""
+    part_num = part_index + 1
+    start_time, segment_duration = window or job['segments'][part_index]
+    video_only = window is not None or raw
+    encoder = job['encoder']
+    
+    # Không dùng hwaccel cuda vì filter phức tạp (setpts, scale, overlay) không hỗ trợ CUDA format
+    # Decode trên CPU, encode trên GPU (nếu dùng GPU encoder)
+    # -stats: vẫn in dòng tiến độ (time=...) dù loglevel=error, dùng cho progress và watchdog
+    cmd = [job['ffmpeg_path'], '-y', '-hide_banner', '-loglevel', 'error', '-stats']
+    fps = job_fps(job)
+    
+    # Chỉ nạp nguồn layout thực sự dùng (job không tải video nền / thumbnail khi chúng bị che hết)
+    input_map = {}
+    video_timing = {}
+    for stream in job.get('video_streams', ()):
+        # Mỗi stream 1 input, seek sẵn tới đầu cửa sổ (không decode từ đầu file); layer cùng stream split trong graph
+        seek = round(start_time + stream['lead'], 6)
+        for item_id, lead in stream['layers'].items():
+            input_map[item_id] = cmd.count('-i')
+            video_timing[item_id] = (lead, stream['fps'])
+        cmd += (['-ss', str(seek)] if seek > 0 else []) + ['-i', job['video_paths'][stream['id']]]
+    if job.get('thumbnail_path'):
+        input_map['thumbnail-placeholder'] = cmd.count('-i')
+        cmd += ['-i', job['thumbnail_path']]
+    for item_id, image_path in job['image_paths'].items():
+        input_map[item_id] = cmd.count('-i')
+        cmd += ['-i', image_path]
+    
+    # Thêm audio input
+    # Tính audio_input_index bằng cách đếm số lượng -i đã có trong cmd
+    audio_input_index = cmd.count('-i')
+    if not video_only:
+        cmd += ['-i', job['audio_path']]
+    
+    filter_complex, final_video_stream = build_ffmpeg_filter(
+        job['layout'], input_map, start_time, segment_duration, part_num, job['resources_path'], job['audio_filter'],
+        include_audio=not video_only, fps=fps, video_timing=video_timing
+    )
+    
+    cmd += ['-filter_complex', filter_complex, '-map', f'[{final_video_stream}]']
+    output_format = job.get('output_format', 'mp4')
+    if video_only:
+        cmd += ['-an', '-r', str(fps), '-frames:v', str(frames)]
+        if raw:
+            cmd += ['-f', 'rawvideo', '-pix_fmt', 'rgb24']
         else:
-            total_parts_by_duration = math.ceil(audio_duration / part_duration)
-            actual_num_parts = min(num_parts, total_parts_by_duration)
-        
-        actual_num_parts = int(actual_num_parts)
+            cmd += video_encoder_args(encoder, threads, part_rate(job, part_index), still=fps < OUTPUT_FPS)
+            cmd += bumper_video_args(job) + keyframe_args(output_format)
+        cmd.append(output_path)
+        return cmd, segment_duration
+    
+    # Cập nhật filter để lấy audio từ input đúng (audio_input_index)
+    cmd[cmd.index(filter_complex)] = filter_complex.replace('[0:a]', f'[{audio_input_index}:a]')
+    cmd += ['-map', '[final_a]']
+    cmd += video_encoder_args(encoder, threads, part_rate(job, part_index), still=fps < OUTPUT_FPS)
+    cmd += bumper_video_args(job) + keyframe_args(output_format)
+    cmd += audio_encoder_args(job) + ['-r', str(fps), '-shortest']
+    cmd += muxer_args(output_format, output_path)
+    return cmd, segment_duration
+
+def part_output_path(job, part_index, output_dir):
+    """File kết quả của 1 phần (playlist index.m3u8 trong thư mục riêng khi xuất HLS)"""
+    return publisher.part_output_path(output_dir, job['title'], part_index + 1, job.get('output_format', 'mp4'))
+
+def fragment_publisher(job, part_index, output_path):
+    """Theo dõi output đang ghi và công bố từng fragment qua các hook đã cấu hình"""
+    return FragmentPublisher(job['output_format'], output_path, part_index + 1,
+                             build_hooks(job.get('publish_dir'), job.get('publish_url')))
+
+def resolve_chunk_count(job, part_index, chunks):
+    """Số chunk cho 1 phần: chunks=0 là tự động theo số core và độ dài phần"""
+    _, segment_duration = job['segments'][part_index]
+    if job_fps(job) < OUTPUT_FPS:
+        # Ảnh tĩnh ở fps thấp: encode 1 lượt đã rất nhanh, chia chunk chỉ thêm chi phí khởi động ffmpeg
+        return 1
+    if chunks == 0:
+        # Theo số core đang trống (đã trừ job khác và tiến trình bên ngoài), không phải tổng số core
+        chunks = min(governor.cpu_available(), int(segment_duration // CHUNK_MIN_SECONDS))
+    if not any(hw in job['encoder'] for hw in ('nvenc', 'amf', 'qsv')):
+        return max(1, chunks)
+    # Encoder phần cứng giới hạn số phiên encode đồng thời
+    return max(1, min(chunks, HW_ENCODER_MAX_CHUNKS))
+
+def render_part_chunked(job, part_index, output_path, chunk_count, threads=None):
+    """Render video của 1 phần thành nhiều chunk song song, ghép bằng concat -c copy rồi mux audio của cả phần"""
+    from concurrent.futures import ThreadPoolExecutor
+    start_time, segment_duration = job['segments'][part_index]
+    chunk_dir = os.path.join(job['temp_dir'], f"chunks_part{part_index + 1}")
+    os.makedirs(chunk_dir, exist_ok=True)
+    fps = job_fps(job)
+    chunks = plan_chunks(segment_duration, chunk_count, fps=fps)
+    if threads is None:
+        threads = max(1, governor.cpu_available() // len(chunks))
+    chunk_paths = [os.path.join(chunk_dir, f"chunk{i:03d}.mp4") for i in range(len(chunks))]
+    done = []
+    done_lock = threading.Lock()
+
+    def render_chunk(i):
+        offset, frames = chunks[i]
+        window = (round(start_time + offset, 6), frames / fps)
+        cmd, _ = build_part_command(job, part_index, chunk_paths[i], threads=threads, window=window, frames=frames)
+        # Mọi chunk cùng số thread; phiên encoder phần cứng do governor giới hạn
+        with governor.acquire('render', cpu=encode_cpu_range(job['encoder'], threads), encoder=job['encoder']):
+            run_command_with_live_output(cmd)
+        with done_lock:
+            done.append(i)
+            print(f"PROGRESS:RENDER:{'%.2f' % (len(done) * 100 / len(chunks))}", flush=True)
+
+    print(f"STATUS: Render Part {part_index + 1} thành {len(chunks)} chunk song song...", flush=True)
+    try:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            for future in [executor.submit(render_chunk, i) for i in range(len(chunks))]:
+                future.result()
+
+        # Ghép video không encode lại, audio của cả phần được cắt + chuẩn hoá 1 lần như khi render thường
+        list_path = write_concat_list(chunk_paths, os.path.join(chunk_dir, "chunks.txt"))
+        cmd = [
+            job['ffmpeg_path'], '-y', '-hide_banner', '-loglevel', 'error', '-stats',
+            '-f', 'concat', '-safe', '0', '-i', list_path, '-i', job['audio_path'],
+            '-filter_complex', f"[1:a]{build_audio_chain(start_time, segment_duration, job['audio_filter'])}[final_a]",
+            '-map', '0:v', '-map', '[final_a]', '-c:v', 'copy'
+        ] + audio_encoder_args(job) + ['-shortest'] + muxer_args(job.get('output_format', 'mp4'), output_path)
+        with governor.acquire('copy'):
+            run_command_with_live_output(cmd, total_duration=segment_duration)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    return output_path
+
+def render_part_with_effects(job, part_index, output_path, threads=None):
+    """Render 1 phần qua stage hiệu ứng NumPy: ffmpeg dựng layout ra frame thô -> hiệu ứng -> ffmpeg encode + audio"""
+    from frame_effects import run_effect_pipeline, effects_need_envelope
+    from audio_analysis import analyze_audio, envelope_cache_path, ENVELOPE_WINDOW
+    start_time, segment_duration = job['segments'][part_index]
+    fps = job_fps(job)
+    frames = max(1, int(round(segment_duration * fps)))
+    decode_cmd, _ = build_part_command(job, part_index, '-', frames=frames, raw=True)
+    encode_cmd = [
+        job['ffmpeg_path'], '-y', '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{OUTPUT_WIDTH}x{OUTPUT_HEIGHT}", '-r', str(fps), '-i', '-',
+        '-i', job['audio_path'],
+        '-filter_complex', f"[1:a]{build_audio_chain(start_time, segment_duration, job['audio_filter'])}[final_a]",
+        '-map', '0:v', '-map', '[final_a]'
+    ]
+    encode_cmd += video_encoder_args(job['encoder'], threads, part_rate(job, part_index)) + bumper_video_args(job)
+    encode_cmd += keyframe_args(job.get('output_format', 'mp4'))
+    encode_cmd += ['-pix_fmt', 'yuv420p'] + audio_encoder_args(job) + ['-shortest']
+    encode_cmd += muxer_args(job.get('output_format', 'mp4'), output_path)
+
+    envelope_path = None
+    if effects_need_envelope(job['effects']):
+        # Envelope đã được cache từ bước phân tích audio (nếu có), các worker đọc qua mmap
+        analyze_audio(job['audio_path'], job['ffmpeg_path'], job['analysis_dir'], job['audio_id'],
+                      want_envelope=True, want_loudness=False)
+        envelope_path = envelope_cache_path(job['analysis_dir'], job['audio_id'])
+    base_ctx = {
+        'fps': fps, 'start': start_time, 'duration': segment_duration, 'part_num': part_index + 1,
+        'envelope_path': envelope_path, 'envelope_window': ENVELOPE_WINDOW,
+    }
+    print(f"STATUS: Render Part {part_index + 1} qua hiệu ứng: {', '.join(job['effects'])}...", flush=True)
+    run_effect_pipeline(
+        decode_cmd, encode_cmd, OUTPUT_WIDTH, OUTPUT_HEIGHT, job['effects'], base_ctx,
+        workers=job.get('effect_workers', 0), total_frames=frames, control=control
+    )
+    return output_path
+
+def render_part(job, part_index, output_dir, threads=None, chunks=1):
+    """Render 1 phần của job ra output_dir, trả về đường dẫn file kết quả (chunks > 1 / 0: render theo chunk song song).
+    Job có bumper: chỉ đoạn giữa được encode (ra file tạm), rồi ghép với intro/outro bằng concat -c copy"""
+    from bumpers import join_bumpers
+    from rate_control import update_calibration
+    output_path = part_output_path(job, part_index, output_dir)
+    output_format = job.get('output_format', 'mp4')
+    body_job, body_path = job, output_path
+    if has_bumpers(job):
+        # HLS không ghép được qua concat demuxer: đoạn giữa ra fMP4 (vẫn ép keyframe), playlist được tạo lúc ghép
+        body_job = dict(job, output_format='fmp4' if is_fragmented(output_format) else 'mp4')
+        body_path = os.path.join(job['temp_dir'], f"body_part{part_index + 1}.mp4")
+    chunk_count = 1 if job.get('effects') else resolve_chunk_count(job, part_index, chunks)
+    mode = 'effects' if job.get('effects') else 'chunked' if chunk_count > 1 else 'single'
+    live_output = contextlib.nullcontext()
+    if is_fragmented(output_format):
+        # Fragment được công bố ngay khi ffmpeg ghi xong, không chờ cả phần
+        publisher.prepare_output(output_format, output_path)
+        live_output = fragment_publisher(job, part_index, output_path)
+    started = time.monotonic()
+    try:
+        with live_output:
+            if mode == 'effects':
+                # Thêm 1 core cho ffmpeg dựng frame thô và 1 core cho mỗi worker NumPy
+                extra = 1 + int(job.get('effect_workers', 0))
+                cpu = encode_cpu_range(job['encoder'], threads)
+                low, high = cpu if isinstance(cpu, tuple) else (cpu, cpu)
+                with governor.acquire('effects', cpu=(low + extra, high + extra), encoder=job['encoder']) as grant:
+                    render_part_with_effects(body_job, part_index, body_path, threads=max(1, grant.threads - extra))
+            elif mode == 'chunked':
+                render_part_chunked(body_job, part_index, body_path, chunk_count, threads=threads)
+            else:
+                with governor.acquire('render', cpu=encode_cpu_range(job['encoder'], threads), encoder=job['encoder']) as grant:
+                    cmd, segment_duration = build_part_command(body_job, part_index, body_path, threads=grant.threads)
+                    print(f"STATUS: Khởi tạo FFMPEG cho Part {part_index + 1} (có thể mất vài phút)...", flush=True)
+                    run_command_with_live_output(cmd, total_duration=segment_duration)
+            if body_path != output_path:
+                intro_path, outro_path = job_bumpers(job)
+                with governor.acquire('copy'):
+                    join_bumpers(job['ffmpeg_path'], body_path, intro_path, outro_path, output_path, output_format,
+                                 os.path.join(job['temp_dir'], f"bumpers_part{part_index + 1}.txt"))
+    except Exception as e:
+        record_failure(classify_error(e), 'render')
+        if body_path != output_path and os.path.exists(body_path):
+            os.remove(body_path)
+        raise
+    record_part(job['encoder'], mode, time.monotonic() - started, job['segments'][part_index][1], fps=job_fps(job))
+    rate = part_rate(job, part_index)
+    if rate and body_job.get('output_format', 'mp4') != 'hls' and job.get('analysis_dir'):
+        # Bitrate video thực tế (chỉ đoạn giữa, không tính bumper) dùng để hiệu chỉnh dự đoán cho các phần/job sau
+        actual_kbps = get_video_bitrate(body_path, job['ffmpeg_path'])
+        try:
+            if actual_kbps:
+                update_calibration(job['analysis_dir'], job['encoder'], rate, actual_kbps)
+        except OSError as e:
+            print(f"WARNING: Không lưu được hiệu chỉnh rate control: {e}", flush=True)
+    if body_path != output_path:
+        os.remove(body_path)
+    return output_path
+
+def process_video(audio_url, video_url, video_speed,
+                  num_parts, save_path, part_duration, layout_file, encoder, 
+                  resources_path, user_data_path, silence_tolerance=0.0,
+                  loudness_target=None, true_peak=-1.0, download_backend='auto', chunks=1, distribute=None,
+                  effects=(), effect_workers=0, output_format='mp4', publish_dir=None, publish_url=None,
+                  rate_control='fixed', target_kbps=0, intro_file=None, outro_file=None):
+    """Xử lý: tải audio+thumb từ link 1, video từ link 2, áp dụng tốc độ phát, ghép lại, duplicate nếu cần, rồi cắt.
+    distribute: dict(listen, local_workers, token) để giao các phần cho worker qua mạng thay vì render tại chỗ"""
+    with open(layout_file, 'r', encoding='utf-8') as f: 
+        layout = json.load(f)
+
+    output_dir = save_path or os.path.join(user_data_path, "output")
+    temp_dir = os.path.join(user_data_path, "temp_files")
+    
+    os.makedirs(output_dir, exist_ok=True)
+    # Thời gian từng bước được ghi vào kho job để mô hình chi phí (--plan, ETA) học theo máy này
+    from job_store import JobStore
+    store = JobStore(default_db_path(user_data_path))
+    tracker = None
+    pins = PinSet()
+
+    try:
+        try:
+            plan = plan_job(
+                audio_url, video_url, video_speed, num_parts, part_duration, encoder, resources_path, user_data_path,
+                silence_tolerance=silence_tolerance, loudness_target=loudness_target, model=CostModel(store),
+                layout=layout
+            )
+            tracker = EtaTracker(plan)
+            print(f"STATUS: Dự kiến hoàn tất sau khoảng {format_duration(plan['total']['wall_seconds'])}", flush=True)
+            tracker.emit()
+            tracker.start_ticker()
+        except ProcessCancelled:
+            raise
+        except Exception as e:
+            print(f"WARNING: Không ước lượng được thời gian: {e}", flush=True)
+        timer = StageTimer(store, encoder, tracker=tracker)
+        job = prepare_job(
+            audio_url, video_url, video_speed, num_parts, part_duration, layout, encoder,
+            resources_path, user_data_path, temp_dir, silence_tolerance=silence_tolerance,
+            loudness_target=loudness_target, true_peak=true_peak, download_backend=download_backend,
+            effects=effects, effect_workers=effect_workers, timer=timer,
+            output_format=output_format, publish_dir=publish_dir, publish_url=publish_url,
+            rate_control=rate_control, target_kbps=target_kbps, intro_file=intro_file, outro_file=outro_file,
+            pins=pins
+        )
         
         # Cắt thành các phần như app cũ
-        for i in range(actual_num_parts):
-            part_num = i + 1
-            start_time = i * part_duration
-            
-            output_path = os.path.join(output_dir, f"{sanitized_title}_Part_{part_num}.mp4")
-            print(f"STATUS: Render Part {part_num}/{actual_num_parts}...", flush=True)
-            
-            # Không dùng hwaccel cuda vì filter phức tạp (setpts, scale, overlay) không hỗ trợ CUDA format
-            # Decode trên CPU, encode trên GPU (nếu dùng GPU encoder)
-            cmd = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error']
-            cmd += ['-i', video_path, '-i', thumbnail_path]
-            
-            input_map = {'video-placeholder': 0, 'thumbnail-placeholder': 1}
-            image_index = 3
-            for item in layout:
-                if item['type'] == 'image' and item['source'] and item['source'].startswith('data:image'):
-                    try:
-                        header, encoded = item['source'].split(',', 1)
-                        image_format = header.split(';')[0].split('/')[1]
-                        image_data = base64.b64decode(encoded)
-                        temp_image_path = os.path.join(temp_dir, f"temp_img_{item['id']}.{image_format}")
-                        with open(temp_image_path, 'wb') as img_f: 
-                            img_f.write(image_data)
-                        cmd += ['-i', temp_image_path]
-                        input_map[item['id']] = image_index
-                        image_index += 1
-                    except Exception as e: 
-                        print(f"Warning: Could not process image {item['id']}: {e}")
-            
-            # Thêm audio input
-            # Tính audio_input_index bằng cách đếm số lượng -i đã có trong cmd
-            audio_input_index = cmd.count('-i')
-            cmd += ['-i', audio_path]
-            
-            filter_complex, final_video_stream = build_ffmpeg_filter(layout, input_map, start_time, part_duration, part_num, resources_path)
-            
-            # Cập nhật filter để lấy audio từ input đúng (audio_input_index)
-            filter_complex = filter_complex.replace('[0:a]', f'[{audio_input_index}:a]')
-            
-            cmd += ['-filter_complex', filter_complex, '-map', f'[{final_video_stream}]', '-map', '[final_a]']
-            # Ưu tiên GPU: giảm CPU threads xuống 1 khi dùng GPU encoder để GPU làm nhiều việc hơn
-            if 'nvenc' in encoder: 
-                cmd += ['-c:v', encoder, '-preset', 'p5', '-cq', '23', '-b:v', '0', '-threads', '1']
-            elif 'amf' in encoder: 
-                cmd += ['-c:v', encoder, '-quality', 'balanced', '-qp', '23', '-threads', '1']
-            elif 'qsv' in encoder: 
-                cmd += ['-c:v', encoder, '-preset', 'medium', '-global_quality', '23', '-threads', '1']
-            else: 
-                # CPU encoder: dùng nhiều threads hơn
-                cpu_count = os.cpu_count() or 4
-                threads = min(cpu_count - 1, 6)  # Giữ lại 1 core cho hệ thống, tối đa 6 threads
-                cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-threads', str(threads)]
-            cmd += ['-c:a', 'aac', '-b:a', '192k', '-r', '30', '-shortest', output_path]
-            print(f"STATUS: Khởi tạo FFMPEG cho Part {part_num} (có thể mất vài phút)...", flush=True)
-            
-            run_command_with_live_output(cmd, total_duration=part_duration)
-            print(f"RESULT:{output_path}", flush=True)
+        total_parts = len(job['segments'])
+        if distribute:
+            # Coordinator in RESULT cho từng phần khi worker đẩy kết quả về
+            render_distributed(job, output_dir, resources_path, user_data_path, tracker=tracker, **distribute)
+        else:
+            for i in range(total_parts):
+                print(f"STATUS: Render Part {i + 1}/{total_parts}...", flush=True)
+                with timer.stage('render_part', units=job['segments'][i][1], node=f"part{i + 1}"):
+                    output_path = render_part(job, i, output_dir, chunks=chunks)
+                print(f"RESULT:{output_path}", flush=True)
         print("STATUS: Hoàn tất tất cả các phần!", flush=True)
         print("LINK_SUCCESS", flush=True)
+        record_job('success')
     except Exception as e:
+        record_job('cancelled' if isinstance(e, ProcessCancelled) else 'failed')
         error_msg = str(e)
         print(f"PYTHON_ERROR: {error_msg}", file=sys.stderr, flush=True)
         print(f"LINK_ERROR: {error_msg}", flush=True)
     finally:
+        if tracker:
+            tracker.stop()
+        pins.release()
+        store.close()
         print("STATUS: Dọn dẹp file tạm...", flush=True)
         if os.path.exists(temp_dir): 
             try:
@@ -273,33 +1149,569 @@ def process_video(audio_url, video_url, video_speed,
             except Exception as e:
                 print(f"WARNING: Không thể xóa thư mục tạm: {e}", flush=True)
 
+def render_distributed(job, output_dir, resources_path, user_data_path, listen='127.0.0.1:8765', local_workers=0, token=None,
+                       metrics_file=None, tracker=None):
+    """Chạy coordinator cho job đã chuẩn bị: worker (local_workers tiến trình trên máy này + worker ở máy khác
+    chạy editor.py --worker URL) kéo từng phần về render rồi đẩy kết quả lên.
+    tracker (EtaTracker): cập nhật ETA theo từng phần và báo worker chậm hơn hẳn các worker khác"""
+    # http.server / urllib chỉ được nạp ở chế độ phân tán
+    from distributed import Coordinator, DEFAULT_PORT
+    host, _, port = listen.rpartition(':')
+    publish_job = job
+    if is_fragmented(job.get('output_format', 'mp4')):
+        # Worker trả về 1 file: HLS được render thành fMP4; fragment được công bố tại coordinator khi nhận file
+        if job['output_format'] == 'hls':
+            print("WARNING: Chế độ phân tán chưa hỗ trợ HLS, xuất fMP4 thay thế", flush=True)
+        job = dict(job, output_format='fmp4', publish_dir=None, publish_url=None)
+        publish_job = dict(job, publish_dir=publish_job.get('publish_dir'), publish_url=publish_job.get('publish_url'))
+
+    def on_result(index, worker_id, seconds):
+        if tracker:
+            tracker.finish(f"part{index + 1}", seconds, host=worker_id)
+        if is_fragmented(publish_job['output_format']):
+            with fragment_publisher(publish_job, index, part_output_path(job, index, output_dir)):
+                pass
+
+    coordinator = Coordinator(
+        job, output_dir, lambda i: os.path.basename(part_output_path(job, i, output_dir)), token=token,
+        on_claim=(lambda index, worker_id: tracker.start(f"part{index + 1}")) if tracker else None,
+        on_result=on_result
+    )
+    url = coordinator.serve(host or '127.0.0.1', int(port or DEFAULT_PORT))
+    print(f"STATUS: Coordinator đang chờ worker tại {url} ({len(coordinator.tasks)} phần)", flush=True)
+
+    # Worker trên cùng máy luôn gọi qua loopback, log ghi vào thư mục tạm của job
+    local_url = f"http://127.0.0.1:{url.rsplit(':', 1)[1]}"
+    processes = []
+    for i in range(local_workers):
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', local_url, '--worker-id', f"local{i + 1}",
+               '--resources-path', resources_path, '--user-data-path', user_data_path]
+        if token:
+            cmd += ['--token', token]
+        if metrics_file:
+            # Worker cộng dồn metrics vào cùng file (có khóa), thời gian render từng phần được tính ở worker
+            cmd += ['--metrics-file', metrics_file]
+        log_file = open(os.path.join(job['temp_dir'], f"worker{i + 1}.log"), 'w', encoding='utf-8')
+        creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        processes.append((subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT,
+                                           creationflags=creationflags), log_file))
+
+    def should_stop():
+        if control.cancelled.is_set():
+            raise ProcessCancelled("Đã hủy theo yêu cầu")
+
+    try:
+        return coordinator.wait(should_stop)
+    finally:
+        for process, log_file in processes:
+            try:
+                # Worker tự thoát khi nhận 410 từ coordinator; quá hạn thì dừng hẳn
+                process.wait(timeout=WORKER_EXIT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log_file.close()
+        coordinator.shutdown()
+
+def run_render_worker(coordinator_url, resources_path, user_data_path, worker_id=None, token=None, chunks=1):
+    """Chế độ worker: kéo task từ coordinator, input được cache theo sha256 trong user_data/cache/blobs"""
+    import socket
+    from distributed import WorkerClient, run_worker
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    client = WorkerClient(coordinator_url, worker_id, token=token)
+    work_dir = os.path.join(user_data_path, "temp_files", f"worker_{sanitize_filename(worker_id)}")
+    ffmpeg_path = get_executable_path("ffmpeg", resources_path)
+
+    def localize_job(spec, inputs, images, task_dir):
+        job = {key: value for key, value in spec.items() if key not in ('inputs', 'images', 'videos')}
+        job.update(inputs)
+        job.update(image_paths=images, ffmpeg_path=ffmpeg_path, resources_path=resources_path, temp_dir=task_dir)
+        return job
+
+    print(f"STATUS: Worker {worker_id} kết nối tới {coordinator_url}", flush=True)
+    try:
+        completed = run_worker(
+            client, get_cache_dir(user_data_path, "blobs"), work_dir, localize_job,
+            lambda job, index, output_dir: render_part(job, index, output_dir, chunks=chunks)
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"STATUS: Worker {worker_id} kết thúc, đã render {completed} phần", flush=True)
+
+def run_queue(queue_file, workers, defaults, resources_path, user_data_path, db_path=None):
+    """Chạy job từ kho SQLite qua JobScheduler: job priority cao chen vào giữa các phần của job dài đang chạy.
+    queue_file (nếu có) được thêm vào kho trước; job còn dở từ lần chạy trước được chạy tiếp, phần đã xong được bỏ qua.
+    Job mới có thể được nộp thêm qua stdin: SUBMIT {"audio_url": ..., "video_url": ..., "priority": 10}"""
+    import socket
+    from scheduler import JobScheduler, RenderJob, DEFAULT_PRIORITY
+    from job_store import JobStore
+    store = JobStore(db_path or default_db_path(user_data_path))
+
+    def add_entry(entry):
+        options = dict(defaults)
+        options.update(entry)
+        return store.add_job(
+            options, priority=int(options.get('priority', DEFAULT_PRIORITY)),
+            source=options.get('source') or options.get('audio_url'), external_id=entry.get('id')
+        )
+
+    if queue_file:
+        with open(queue_file, 'r', encoding='utf-8') as f:
+            for entry in json.load(f):
+                add_entry(entry)
+
+    scheduler = JobScheduler(max_workers=workers)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    results = {'success': 0, 'error': 0}
+    # Id các job đã claim và chưa ghi kết quả vào kho
+    active = set()
+    active_lock = threading.Lock()
+
+    def make_job(record):
+        db_id = record['id']
+        options = record['options']
+        job_id = record['external_id'] or f"job{db_id}"
+        with open(options['layout_file'], 'r', encoding='utf-8') as f:
+            layout = json.load(f)
+        output_dir = options.get('save_path') or os.path.join(user_data_path, "output")
+        temp_dir = os.path.join(user_data_path, "temp_files", sanitize_filename(job_id))
+        os.makedirs(output_dir, exist_ok=True)
+        state = {}
+        # File cache job này dùng: job khác chạy song song không được xóa khi dọn cache
+        pins = PinSet()
+
+        def prepare():
+            print(f"STATUS: [{job_id}] Chuẩn bị job (lần {record['attempts']})...", flush=True)
+            store.start_stage(db_id, 'prepare')
+            # Nhiều job chạy chung process nên không đo CPU theo từng bước
+            timer = StageTimer(store, options['encoder'], job_id=db_id, measure_cpu=False)
+            try:
+                state['job'] = prepare_job(
+                    options['audio_url'], options['video_url'], float(options.get('video_speed', 1.0)),
+                    int(options['parts']), options['part_duration'], layout, options['encoder'],
+                    resources_path, user_data_path, temp_dir,
+                    silence_tolerance=options['silence_tolerance'], loudness_target=options['loudness_target'],
+                    true_peak=options['true_peak'], download_backend=options['download_backend'],
+                    effects=options.get('effects', ()), effect_workers=int(options.get('effect_workers', 0)),
+                    timer=timer, output_format=options.get('output_format', 'mp4'),
+                    publish_dir=options.get('publish_dir') or None, publish_url=options.get('publish_url') or None,
+                    rate_control=options.get('rate_control', 'fixed'), target_kbps=float(options.get('target_kbps') or 0),
+                    intro_file=options.get('intro_file') or None, outro_file=options.get('outro_file') or None,
+                    pins=pins
+                )
+            except Exception as e:
+                store.finish_stage(db_id, 'prepare', error=e)
+                raise
+            store.finish_stage(db_id, 'prepare', units=state['job']['audio_duration'], encoder=options['encoder'])
+            store.set_parts(db_id, state['job']['segments'])
+            return len(state['job']['segments'])
+
+        def render(index):
+            output_path = store.finished_part_output(db_id, index)
+            if output_path:
+                print(f"STATUS: [{job_id}] Part {index + 1} đã xong từ lần chạy trước", flush=True)
+            else:
+                print(f"STATUS: [{job_id}] Render Part {index + 1}/{len(state['job']['segments'])}...", flush=True)
+                store.start_part(db_id, index)
+                try:
+                    # Số thread mỗi phần do governor chia theo số phần đang chạy/chờ và tải thực tế
+                    output_path = render_part(state['job'], index, output_dir,
+                                              chunks=int(options.get('chunks', 1)))
+                except Exception as e:
+                    store.finish_part(db_id, index, error=e)
+                    raise
+                store.finish_part(db_id, index, output_path=output_path, encoder=options['encoder'],
+                                  resolution=state['job'].get('resolution'))
+            print(f"RESULT:{output_path}", flush=True)
+            return output_path
+
+        def cleanup():
+            pins.release()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            with active_lock:
+                active.discard(db_id)
+
+        def on_done(job):
+            store.complete_job(db_id)
+            record_job('success')
+            results['success'] += 1
+            print(f"JOB_SUCCESS:{job_id}", flush=True)
+            cleanup()
+
+        def on_error(job, error):
+            if isinstance(error, ProcessCancelled):
+                store.release_job(db_id)
+                record_job('cancelled')
+            elif store.fail_job(db_id, error):
+                record_job('retried')
+                print(f"WARNING: [{job_id}] Lỗi: {error} - sẽ thử lại", flush=True)
+            else:
+                record_job('failed')
+                results['error'] += 1
+                print(f"PYTHON_ERROR: [{job_id}] {error}", file=sys.stderr, flush=True)
+                print(f"JOB_ERROR:{job_id}:{error}", flush=True)
+            cleanup()
+
+        return RenderJob(
+            job_id, prepare, render, priority=record['priority'],
+            source=record['source'] or job_id, on_done=on_done, on_error=on_error
+        )
+
+    def feed():
+        """Claim job từ kho khi scheduler còn chỗ, gia hạn lease cho job đang chạy; hết việc thì close()"""
+        # Giữ sẵn vài job trong scheduler để job priority cao vẫn chen được giữa các phần
+        max_in_flight = scheduler.max_workers * 2
+        last_renew = time.time()
+        try:
+            while not control.cancelled.is_set():
+                if time.time() - last_renew >= QUEUE_LEASE_RENEW_INTERVAL:
+                    with active_lock:
+                        store.renew_lease(list(active), worker_id)
+                    last_renew = time.time()
+                claimed = None
+                with active_lock:
+                    if len(active) < max_in_flight:
+                        claimed = store.claim_job(worker_id)
+                        if claimed:
+                            active.add(claimed['id'])
+                    idle = not active and not claimed
+                if claimed:
+                    try:
+                        scheduler.submit(make_job(claimed))
+                    except Exception as e:
+                        store.fail_job(claimed['id'], e)
+                        with active_lock:
+                            active.discard(claimed['id'])
+                    continue
+                if idle:
+                    break
+                with active_lock:
+                    set_queue_depth(len(active), 'active')
+                set_queue_depth(store.count_by_status().get('pending', 0), 'pending')
+                control.cancelled.wait(QUEUE_FEED_INTERVAL)
+        finally:
+            scheduler.close()
+
+    control.submit_handler = add_entry
+    feeder = threading.Thread(target=feed, name="queue-feeder", daemon=True)
+    feeder.start()
+    scheduler.run()
+    feeder.join()
+    counts = store.count_by_status()
+    store.close()
+    print(f"STATUS: Hàng chờ xong: {results['success']} thành công, {results['error']} lỗi "
+          f"(còn {counts.get('pending', 0)} job chờ trong kho)", flush=True)
+    return results['error'] == 0
+
+def ingest_playlist(defaults, playlist_url, user_data_path, db_path=None, limit=None,
+                    prefetch_workers=METADATA_PREFETCH_WORKERS):
+    """Thêm mỗi video của playlist/kênh (audio) thành 1 job dùng chung video nền + layout trong defaults.
+    Danh sách lấy bằng 1 lần extract flat; metadata đầy đủ được lấy dần ở nền (có giới hạn luồng, có cache)
+    nên job đầu tiên render được ngay. Trả về MetadataPrefetcher đang chạy (đóng sau khi chạy hàng chờ)"""
+    from downloader import fetch_playlist_entries, fetch_video_metadata
+    from scheduler import DEFAULT_PRIORITY
+    user_cookie_path = os.path.join(user_data_path, 'cookies.txt')
+    cookies_path_to_use = user_cookie_path if os.path.exists(user_cookie_path) else ""
+    print(f"STATUS: Lấy danh sách video từ {playlist_url}...", flush=True)
+    playlist, entries = fetch_playlist_entries(playlist_url, cookies_path_to_use, limit=limit)
+    print(f"STATUS: Playlist '{playlist['title']}': {len(entries)} video", flush=True)
+
+    from job_store import JobStore
+    store = JobStore(db_path or default_db_path(user_data_path))
+    try:
+        for entry in entries:
+            options = dict(defaults)
+            options['audio_url'] = entry['url']
+            # Job của cùng 1 playlist là 1 nguồn: scheduler chia lượt công bằng giữa playlist và job lẻ
+            store.add_job(
+                options, priority=int(options.get('priority', DEFAULT_PRIORITY)), source=playlist['webpage_url'],
+                external_id=f"{playlist['id'] or sanitize_filename(playlist_url)}:{entry['id'] or entry['url']}"
+            )
+        counts = store.count_by_status()
+    finally:
+        store.close()
+    print(f"STATUS: Đã thêm {len(entries)} job (kho có {counts.get('pending', 0)} job chờ)", flush=True)
+
+    prefetcher = MetadataPrefetcher(
+        MetadataCache(get_cache_dir(user_data_path, "metadata")),
+        lambda url: fetch_video_metadata(url, cookies_path_to_use), workers=prefetch_workers
+    )
+    # Video nền dùng chung trước, rồi tới audio theo thứ tự playlist (cũng là thứ tự job được claim)
+    prefetcher.submit([defaults['video_url']] + [entry['url'] for entry in entries])
+    return prefetcher
+
+def prefetch_links(audio_url, video_url, resources_path, user_data_path, rate_limit=PREFETCH_RATE_LIMIT,
+                   download_backend='auto'):
+    """Tải trước input của 1 item hàng chờ vào cache (metadata, audio, thumbnail, video) để khi tới lượt
+    prepare_job trúng cache. Chạy với ưu tiên thấp, giới hạn băng thông và nhường ngay khi có job đang chạy:
+    lượt tải dừng lại, chờ job xong rồi tải tiếp từ phần đã có. Trả về True nếu mọi input đã nằm trong cache"""
+    from downloader import fetch_video_metadata, download_audio_only, download_thumbnail, DownloadYielded
+    if is_local_input(audio_url) and is_local_input(video_url):
+        return True
+    lower_process_priority()
+    ffmpeg_path = get_executable_path("ffmpeg", resources_path)
+    user_cookie_path = os.path.join(user_data_path, 'cookies.txt')
+    cookies_path_to_use = user_cookie_path if os.path.exists(user_cookie_path) else ""
+    metadata_cache = MetadataCache(get_cache_dir(user_data_path, "metadata"))
+    media_dir = get_cache_dir(user_data_path, "media")
+    # Thư mục tạm cố định (không theo job) để file .part còn đó cho lần tải tiếp sau khi nhường
+    temp_dir = get_cache_dir(user_data_path, "prefetch")
+
+    def fetch(url):
+        return fetch_video_metadata(url, cookies_path_to_use)
+
+    should_yield = governor.foreground_active
+    # Input local (file / cache:<id>) không cần tải trước
+    targets = []
+    if not is_local_input(audio_url):
+        audio_info, _ = metadata_cache.get_or_fetch(audio_url, fetch)
+        print(f"STATUS: Tải trước: đã có metadata '{audio_info['title']}'", flush=True)
+        targets += [
+            (os.path.join(media_dir, f"{audio_info['id']}_audio.mp3"), lambda temp_path: download_audio_only(
+                audio_url, ffmpeg_path, temp_path, cookies_path_to_use, rate_limit=rate_limit, should_yield=should_yield)),
+            (os.path.join(media_dir, f"{audio_info['id']}_thumb.jpg"), lambda temp_path: download_thumbnail(
+                audio_info['thumbnail'], temp_path, cache_dir=get_cache_dir(user_data_path, "http"))),
+        ]
+    if not is_local_input(video_url):
+        video_info, _ = metadata_cache.get_or_fetch(video_url, fetch)
+        targets.append((os.path.join(media_dir, f"{video_info['id']}_video.mp4"), lambda temp_path: download_video_no_audio(
+            video_url, video_info['id'], temp_path, temp_dir, ffmpeg_path, cookies_path_to_use, user_data_path,
+            download_backend=download_backend, rate_limit=rate_limit, should_yield=should_yield)))
+    for path, download in targets:
+        while True:
+            if governor.foreground_active():
+                print("STATUS: Tải trước: nhường cho job đang chạy...", flush=True)
+                while governor.foreground_active():
+                    time.sleep(PREFETCH_POLL_INTERVAL)
+            # Job vừa chạy có thể đã tải xong chính file này
+            if os.path.exists(path):
+                touch(path)
+                break
+            temp_path = os.path.join(temp_dir, os.path.basename(path))
+            try:
+                download(temp_path)
+            except DownloadYielded:
+                continue
+            if not os.path.exists(temp_path):
+                raise Exception(f"Tải trước không thành công: {os.path.basename(path)}")
+            store_file(temp_path, path)
+            break
+    enforce_size_limit(media_dir, MEDIA_CACHE_MAX_BYTES, keep=tuple(path for path, _ in targets))
+    print(f"STATUS: Tải trước xong: {audio_url} | {video_url}", flush=True)
+    return True
+
+def list_jobs(db_path, status=None, limit=100, offset=0):
+    """In danh sách job trong kho cho app (1 dòng JOBS:<json>)"""
+    from job_store import JobStore
+    store = JobStore(db_path)
+    try:
+        data = {
+            'counts': store.count_by_status(),
+            'jobs': [
+                dict(job, parts=store.list_parts(job['id']))
+                for job in store.list_jobs(status=status, limit=limit, offset=offset)
+            ],
+        }
+    finally:
+        store.close()
+    print(f"JOBS:{json.dumps(data, ensure_ascii=False)}", flush=True)
+
 if __name__ == "__main__":
+    # Các module chỉ cần cho CLI (danh sách lựa chọn, phiên yt-dlp); phần còn lại được import trong từng chế độ
+    from downloader import DOWNLOAD_BACKENDS, configure_sessions
+    from rate_control import RATE_CONTROL_MODES
+
     parser = argparse.ArgumentParser(description="Video Processing Script")
     parser.add_argument('--resources-path', required=True)
     parser.add_argument('--user-data-path', required=True)
-    parser.add_argument('--audio-url', type=str, required=True)
-    parser.add_argument('--video-url', type=str, required=True)
+    parser.add_argument('--audio-url', type=str, default="",
+                        help="Link audio + thumbnail, hoặc file local / file:// / cache:<id> (không tải)")
+    parser.add_argument('--video-url', type=str, default="", help="Link video nền, hoặc file local / file:// / cache:<id>")
     parser.add_argument('--video-speed', type=float, default=1.0)
-    parser.add_argument('--layout-file', type=str, required=True)
+    parser.add_argument('--layout-file', type=str, default="")
     parser.add_argument('--parts', type=int, default=1)
     parser.add_argument('--save-path', type=str, default="")
     parser.add_argument('--part-duration', type=str, default="0")
     parser.add_argument('--encoder', type=str, default='libx264')
+    parser.add_argument('--silence-tolerance', type=float, default=0.0,
+                        help="Dời mốc cắt về khoảng lặng gần nhất trong ±N giây (0 = tắt)")
+    parser.add_argument('--loudness-target', type=float, default=None,
+                        help="Chuẩn hoá loudness về N LUFS, ví dụ -14 (mặc định tắt)")
+    parser.add_argument('--true-peak', type=float, default=-1.0,
+                        help="Trần true peak (dBTP) khi chuẩn hoá loudness (limiter chừa thêm khoảng an toàn cho peak giữa các mẫu)")
+    parser.add_argument('--download-backend', type=str, default='auto', choices=DOWNLOAD_BACKENDS)
+    parser.add_argument('--queue-file', type=str, default="",
+                        help="File JSON danh sách job (audio_url, video_url, priority, source, ...) để chạy qua scheduler")
+    parser.add_argument('--ingest', type=str, default="", metavar="URL",
+                        help="Playlist/kênh làm audio: mỗi video thành 1 job dùng chung --video-url và --layout-file, rồi chạy hàng chờ")
+    parser.add_argument('--ingest-limit', type=int, default=0, help="Chỉ lấy N video đầu của playlist/kênh (0 = tất cả)")
+    parser.add_argument('--prefetch', action='store_true',
+                        help="Chỉ tải trước input của --audio-url/--video-url vào cache (ưu tiên thấp, nhường job đang chạy) rồi thoát")
+    parser.add_argument('--prefetch-rate', type=float, default=PREFETCH_RATE_LIMIT / 1024 ** 2,
+                        help="Băng thông tối đa khi tải trước, MB/s (0 = không giới hạn)")
+    parser.add_argument('--resume-queue', action='store_true',
+                        help="Chạy tiếp các job còn chờ/dở trong kho job (không cần --queue-file)")
+    parser.add_argument('--job-db', type=str, default="", help="File SQLite của kho job (mặc định user_data/jobs.sqlite3)")
+    parser.add_argument('--list-jobs', type=str, nargs='?', const='all', default="", choices=('all',) + JOB_STATUSES,
+                        help="In danh sách job trong kho (JOBS:<json>) rồi thoát")
+    parser.add_argument('--workers', type=int, default=1, help="Số phần/job render song song ở chế độ hàng chờ")
+    parser.add_argument('--coordinator', type=str, default="", metavar="HOST:PORT",
+                        help="Giao các phần cho worker qua HTTP tại HOST:PORT (vd 0.0.0.0:8765 để máy khác trong LAN kết nối)")
+    parser.add_argument('--local-workers', type=int, default=0, help="Số worker chạy trên máy này khi dùng --coordinator")
+    parser.add_argument('--worker', type=str, default="", metavar="URL", help="Chạy như worker, kéo task từ coordinator URL")
+    parser.add_argument('--worker-id', type=str, default="")
+    parser.add_argument('--token', type=str, default="", help="Token dùng chung giữa coordinator và worker")
+    parser.add_argument('--effects', type=str, default="",
+                        help="Hiệu ứng NumPy theo frame, cách nhau bởi dấu phẩy (progress_bar, audio_meter hoặc module:function)")
+    parser.add_argument('--effect-workers', type=int, default=0, help="Số tiến trình chạy hiệu ứng song song (0 = trong tiến trình chính)")
+    parser.add_argument('--benchmark-effects', action='store_true', help="Đo số frame/giây của stage hiệu ứng rồi thoát")
+    parser.add_argument('--chunks', type=int, default=1,
+                        help="Chia mỗi phần thành N chunk encode song song rồi ghép lại (1 = tắt, 0 = tự động cho phần dài)")
+    parser.add_argument('--plan', action='store_true',
+                        help="Chỉ lập kế hoạch (DAG các bước, dung lượng tải, CPU, thời gian dự kiến) rồi thoát, không tải media")
+    parser.add_argument('--metrics-file', type=str, default="",
+                        help="Ghi metrics dạng text Prometheus vào file (cộng dồn giữa các lần chạy, dùng cho node_exporter textfile)")
+    parser.add_argument('--metrics-port', type=int, default=0, help="Phục vụ metrics tại http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='mp4',
+                        help="mp4: file thường; fmp4: MP4 phân mảnh dùng được ngay khi đang ghi; hls: segment CMAF + playlist")
+    parser.add_argument('--publish-dir', type=str, default="",
+                        help="(fmp4/hls) Chép từng fragment đã xong vào thư mục này trong lúc phần vẫn đang render")
+    parser.add_argument('--publish-url', type=str, default="",
+                        help="(fmp4/hls) PUT từng fragment đã xong tới URL/<tên phần>/<file>")
+    parser.add_argument('--rate-control', choices=RATE_CONTROL_MODES, default='fixed',
+                        help="fixed: chất lượng 23 cố định; quality: trần bitrate theo độ phức tạp nền; "
+                             "size: chọn chất lượng để vừa --target-kbps")
+    parser.add_argument('--target-kbps', type=float, default=0, help="Ngân sách bitrate video trung bình mỗi phần (--rate-control size)")
+    parser.add_argument('--intro-file', type=str, default="", help="Clip intro ghép vào đầu mỗi phần (encode 1 lần, ghép không encode lại)")
+    parser.add_argument('--outro-file', type=str, default="", help="Clip outro ghép vào cuối mỗi phần")
+    # Ngân sách tài nguyên chung cho mọi bước chạy đồng thời (0 = mặc định theo máy)
+    parser.add_argument('--max-cpu', type=int, default=0, help="Số core tối đa pipeline được dùng (mặc định: số core - 1)")
+    parser.add_argument('--max-ram-gb', type=float, default=0, help="RAM tối đa được giữ chỗ, GB (mặc định: 75%% RAM máy)")
+    parser.add_argument('--disk-mbps', type=int, default=0, help="Băng thông đĩa dành cho pipeline, MB/s")
+    parser.add_argument('--net-connections', type=int, default=0, help="Tổng số kết nối tải song song của mọi job")
+    parser.add_argument('--hw-sessions', type=int, default=0, help="Số phiên encode đồng thời tối đa của encoder phần cứng")
     args = parser.parse_args()
+    effects = [name.strip() for name in args.effects.split(',') if name.strip()]
+    if args.benchmark_effects:
+        from frame_effects import benchmark as benchmark_effects
+        fps = benchmark_effects(effects or ['progress_bar'], workers=args.effect_workers)
+        print(f"BENCHMARK: {fps:.1f} fps ({args.effect_workers} worker)", flush=True)
+        sys.exit(0)
+    # Phiên yt-dlp giữ cache player JS / chữ ký trong user data, dùng lại giữa các lần chạy
+    configure_sessions(get_cache_dir(args.user_data_path, "yt-dlp"))
+    if args.list_jobs:
+        list_jobs(args.job_db or default_db_path(args.user_data_path), status=None if args.list_jobs == 'all' else args.list_jobs)
+        sys.exit(0)
+    if args.plan:
+        if args.queue_file:
+            plan_queue(args.queue_file, args.workers, {
+                'video_speed': args.video_speed, 'parts': args.parts, 'part_duration': args.part_duration,
+                'encoder': args.encoder, 'silence_tolerance': args.silence_tolerance, 'loudness_target': args.loudness_target,
+                'layout_file': args.layout_file,
+            }, args.resources_path, args.user_data_path, db_path=args.job_db or None)
+            sys.exit(0)
+        if not (args.audio_url and args.video_url):
+            parser.error("--plan cần --audio-url và --video-url (hoặc --queue-file)")
+        from job_store import JobStore
+        store = JobStore(args.job_db or default_db_path(args.user_data_path))
+        try:
+            print_plan(plan_job(
+                args.audio_url, args.video_url, args.video_speed, args.parts, args.part_duration, args.encoder,
+                args.resources_path, args.user_data_path, silence_tolerance=args.silence_tolerance,
+                loudness_target=args.loudness_target, model=CostModel(store), layout=load_layout(args.layout_file)
+            ))
+        except Exception as e:
+            print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
+            sys.exit(1)
+        finally:
+            store.close()
+        sys.exit(0)
+    if args.prefetch and not (args.audio_url and args.video_url):
+        parser.error("--prefetch cần --audio-url và --video-url")
+    if args.rate_control == 'size' and args.target_kbps <= 0:
+        parser.error("--rate-control size cần --target-kbps")
+    if args.ingest and not (args.video_url and args.layout_file):
+        parser.error("--ingest cần --video-url và --layout-file dùng chung cho mọi job")
+    if not args.prefetch and not args.queue_file and not args.resume_queue and not args.worker and not args.ingest and not (args.audio_url and args.video_url and args.layout_file):
+        parser.error("cần --audio-url, --video-url và --layout-file (hoặc --queue-file / --resume-queue / --ingest / --worker)")
+    
+    # Nhận lệnh PAUSE/RESUME/CANCEL từ app qua stdin
+    start_control_listener()
+    # Phiên encoder phần cứng được giữ bằng file khóa trong user data: mọi process trên máy cùng tính chung
+    governor.configure(
+        max_cpu=args.max_cpu or None, ram_bytes=int(args.max_ram_gb * 1024 ** 3) or None,
+        disk_mbps=args.disk_mbps or None, net_connections=args.net_connections or None,
+        hw_sessions=args.hw_sessions or None, lock_dir=get_cache_dir(args.user_data_path, "governor")
+    )
+    if args.metrics_file or args.metrics_port:
+        start_exporter(metrics_file=args.metrics_file or None, port=args.metrics_port or None)
+    
+    if args.prefetch:
+        try:
+            prefetch_links(args.audio_url, args.video_url, args.resources_path, args.user_data_path,
+                           rate_limit=int(args.prefetch_rate * 1024 ** 2) or None, download_backend=args.download_backend)
+            sys.exit(0)
+        except Exception as e:
+            print(f"PYTHON_ERROR: Tải trước lỗi: {e}", file=sys.stderr, flush=True)
+            sys.exit(1)
+    # Tiến trình tải trước ở nền nhường băng thông/CPU cho tới khi process này thoát
+    governor.hold_foreground()
+    
+    # yt-dlp chỉ được cài/nạp khi có bước tải thực sự chạy (xem downloader.load_yt_dlp)
     
-    # Tự động cài đặt yt-dlp nếu chưa có
-    if not ensure_yt_dlp():
-        sys.exit(1)
+    if args.worker:
+        try:
+            run_render_worker(args.worker, args.resources_path, args.user_data_path,
+                              worker_id=args.worker_id or None, token=args.token or None, chunks=args.chunks)
+            sys.exit(0)
+        except Exception as e:
+            print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
+            sys.exit(1)
     
-    # Import yt_dlp (đã được cài đặt hoặc đã có sẵn)
-    import yt_dlp
+    if args.queue_file or args.resume_queue or args.ingest:
+        defaults = {
+            'video_speed': args.video_speed, 'layout_file': args.layout_file, 'parts': args.parts,
+            'save_path': args.save_path, 'part_duration': args.part_duration, 'encoder': args.encoder,
+            'silence_tolerance': args.silence_tolerance, 'loudness_target': args.loudness_target,
+            'true_peak': args.true_peak, 'download_backend': args.download_backend, 'chunks': args.chunks,
+            'effects': effects, 'effect_workers': args.effect_workers,
+            'output_format': args.output_format, 'publish_dir': args.publish_dir, 'publish_url': args.publish_url,
+            'rate_control': args.rate_control, 'target_kbps': args.target_kbps,
+            'intro_file': args.intro_file, 'outro_file': args.outro_file,
+        }
+        prefetcher = None
+        if args.ingest:
+            try:
+                prefetcher = ingest_playlist(dict(defaults, video_url=args.video_url), args.ingest,
+                                             args.user_data_path, db_path=args.job_db or None,
+                                             limit=args.ingest_limit or None)
+            except Exception as e:
+                print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
+                sys.exit(1)
+        try:
+            ok = run_queue(args.queue_file, args.workers, defaults, args.resources_path, args.user_data_path,
+                           db_path=args.job_db or None)
+        finally:
+            if prefetcher:
+                prefetcher.close()
+        sys.exit(0 if ok else 1)
     
     try:
         process_video(
             args.audio_url, args.video_url, args.video_speed,
             args.parts, args.save_path, 
             args.part_duration, args.layout_file, args.encoder, 
-            args.resources_path, args.user_data_path
+            args.resources_path, args.user_data_path,
+            silence_tolerance=args.silence_tolerance,
+            loudness_target=args.loudness_target, true_peak=args.true_peak,
+            download_backend=args.download_backend, chunks=args.chunks,
+            effects=effects, effect_workers=args.effect_workers,
+            output_format=args.output_format, publish_dir=args.publish_dir or None, publish_url=args.publish_url or None,
+            rate_control=args.rate_control, target_kbps=args.target_kbps,
+            intro_file=args.intro_file or None, outro_file=args.outro_file or None,
+            distribute={
+                'listen': args.coordinator, 'local_workers': args.local_workers, 'token': args.token or None,
+                'metrics_file': args.metrics_file or None
+            } if args.coordinator else None
         )
         sys.exit(0)  # Thành công
     except Exception as e:
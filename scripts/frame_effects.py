@@ -0,0 +1,310 @@
+"""
+Module hiệu ứng theo frame bằng NumPy - frame thô đi qua ring buffer trong shared memory,
+các worker sửa trực tiếp trên view của slot (không pickle/copy frame) rồi frame được đẩy thẳng vào encoder
+"""
+import sys
+import time
+import queue
+import importlib
+import subprocess
+import tempfile
+
+FRAME_CHANNELS = 3  # rgb24
+# Số slot mỗi worker được giữ cùng lúc; tổng bộ nhớ = số slot x kích thước 1 frame
+SLOTS_PER_WORKER = 3
+MIN_SLOTS = 4
+PROGRESS_EVERY_FRAMES = 30
+BENCHMARK_FRAMES = 900
+WORKER_POLL_INTERVAL = 1.0
+
+# --- HIỆU ỨNG CÓ SẴN ---
+def progress_bar(frame, ctx, np):
+    """Thanh tiến độ của phần ở mép dưới khung hình"""
+    height = max(4, frame.shape[0] // 160)
+    filled = int(frame.shape[1] * ctx['part_progress'])
+    frame[-height:, :filled] = (255, 255, 255)
+    frame[-height:, filled:] //= 3
+
+def audio_meter(frame, ctx, np):
+    """Cột âm lượng theo envelope của audio (cần phân tích audio trước)"""
+    envelope = ctx.get('envelope')
+    if envelope is None or len(envelope) == 0:
+        return
+    index = min(int(ctx['time'] / ctx['envelope_window']), len(envelope) - 1)
+    level_db = 20.0 * np.log10(max(float(envelope[index]), 1e-6))
+    level = min(1.0, max(0.0, (level_db + 60.0) / 60.0))
+    bar_w = max(6, frame.shape[1] // 40)
+    bar_h = int(frame.shape[0] * 0.3 * level)
+    if bar_h:
+        frame[-bar_h - bar_w:-bar_w, bar_w:2 * bar_w] = (255, 64, 64)
+
+audio_meter.needs_envelope = True
+
+BUILTIN_EFFECTS = {'progress_bar': progress_bar, 'audio_meter': audio_meter}
+
+def resolve_effect(spec):
+    """Tên hiệu ứng có sẵn hoặc 'module:function' (module import được từ sys.path)"""
+    if spec in BUILTIN_EFFECTS:
+        return BUILTIN_EFFECTS[spec]
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise ValueError(f"Hiệu ứng không hợp lệ: {spec} (cần tên có sẵn hoặc module:function)")
+    return getattr(importlib.import_module(module_name), function_name)
+
+def effects_need_envelope(specs):
+    return any(getattr(resolve_effect(spec), 'needs_envelope', False) for spec in specs)
+
+# --- WORKER ---
+def _frame_context(base, frame_index):
+    local_time = frame_index / base['fps']
+    return dict(
+        base, index=frame_index, time=base['start'] + local_time,
+        part_progress=min(1.0, local_time / base['duration']) if base['duration'] else 1.0,
+    )
+
+def _attach_worker_state(shm_name, shape, slots, specs, base_ctx):
+    import numpy as np
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((slots,) + tuple(shape), dtype=np.uint8, buffer=shm.buf)
+    effects = [resolve_effect(spec) for spec in specs]
+    base_ctx = dict(base_ctx)
+    if base_ctx.get('envelope_path'):
+        # mmap: các worker dùng chung trang bộ nhớ của file envelope, không copy
+        base_ctx['envelope'] = np.load(base_ctx['envelope_path'], mmap_mode='r')
+    return np, shm, frames, effects, base_ctx
+
+def _effect_worker(shm_name, shape, slots, specs, base_ctx, task_queue, done_queue):
+    """Tiến trình worker: nhận (slot, frame_index), áp hiệu ứng trực tiếp trên slot, trả lại (slot, frame_index, lỗi)"""
+    try:
+        np, shm, frames, effects, base_ctx = _attach_worker_state(shm_name, shape, slots, specs, base_ctx)
+    except Exception as e:
+        done_queue.put((None, None, f"{type(e).__name__}: {e}"))
+        return
+    # Báo sẵn sàng để tiến trình chính không tính thời gian khởi động vào pipeline
+    done_queue.put((None, None, None))
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            slot, frame_index = task
+            error = None
+            try:
+                ctx = _frame_context(base_ctx, frame_index)
+                for effect in effects:
+                    effect(frames[slot], ctx, np)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            done_queue.put((slot, frame_index, error))
+    finally:
+        del frames
+        shm.close()
+
+# --- RING BUFFER ---
+class FrameRing:
+    """Ring buffer các frame thô trong shared memory, xử lý bởi `workers` tiến trình (0 = ngay trong thread này)"""
+
+    def __init__(self, width, height, specs, base_ctx, workers=0):
+        # numpy / multiprocessing chỉ được nạp khi thực sự chạy hiệu ứng (editor import module này ở mọi lần chạy)
+        import numpy as np
+        import multiprocessing
+        from multiprocessing import shared_memory
+        self.np = np
+        self.shape = (height, width, FRAME_CHANNELS)
+        self.frame_bytes = width * height * FRAME_CHANNELS
+        self.workers = max(0, int(workers))
+        self.slots = max(MIN_SLOTS, SLOTS_PER_WORKER * max(1, self.workers))
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.frame_bytes)
+        self.frames = np.ndarray((self.slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.specs = list(specs)
+        self.base_ctx = dict(base_ctx)
+        self._processes = []
+        self._local = None
+        if self.workers:
+            context = multiprocessing.get_context('spawn')
+            self.task_queue = context.Queue()
+            self.done_queue = context.Queue()
+            for _ in range(self.workers):
+                process = context.Process(
+                    target=_effect_worker,
+                    args=(self.shm.name, self.shape, self.slots, self.specs, self.base_ctx, self.task_queue, self.done_queue),
+                    daemon=True
+                )
+                process.start()
+                self._processes.append(process)
+            for _ in range(self.workers):
+                try:
+                    _, _, error = self._next_done()
+                except Exception as e:
+                    error = str(e)
+                if error:
+                    self.close()
+                    raise Exception(f"Không khởi động được worker hiệu ứng: {error}")
+        else:
+            self.task_queue = None
+            self.done_queue = queue.Queue()
+
+    def _next_done(self):
+        """Lấy kết quả tiếp theo; worker chết giữa chừng thì báo lỗi thay vì chờ mãi"""
+        while True:
+            try:
+                return self.done_queue.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                dead = [p.exitcode for p in self._processes if not p.is_alive()]
+                if dead:
+                    raise Exception(f"Worker hiệu ứng đã dừng đột ngột (mã {dead[0]})")
+
+    def slot_view(self, slot):
+        """memoryview ghi được của 1 slot, dùng cho readinto/write trực tiếp với pipe"""
+        return self.shm.buf[slot * self.frame_bytes:(slot + 1) * self.frame_bytes]
+
+    def submit(self, slot, frame_index):
+        if self.workers:
+            self.task_queue.put((slot, frame_index))
+            return
+        if self._local is None:
+            effects = [resolve_effect(spec) for spec in self.specs]
+            base_ctx = dict(self.base_ctx)
+            if base_ctx.get('envelope_path'):
+                base_ctx['envelope'] = self.np.load(base_ctx['envelope_path'], mmap_mode='r')
+            self._local = (effects, base_ctx)
+        effects, base_ctx = self._local
+        error = None
+        try:
+            ctx = _frame_context(base_ctx, frame_index)
+            for effect in effects:
+                effect(self.frames[slot], ctx, self.np)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        self.done_queue.put((slot, frame_index, error))
+
+    def process(self, read_frame, write_frame, on_frame=None):
+        """Chạy pipeline: read_frame(view) -> bool (False = hết), write_frame(view) theo đúng thứ tự frame.
+        Trả về số frame đã xử lý"""
+        free_slots = list(range(self.slots))
+        pending = {}
+        next_read, next_write = 0, 0
+        eof = False
+        while not eof or next_write < next_read:
+            # Đọc vào mọi slot trống để giữ các worker bận
+            while not eof and free_slots:
+                slot = free_slots.pop()
+                if not read_frame(self.slot_view(slot)):
+                    free_slots.append(slot)
+                    eof = True
+                    break
+                self.submit(slot, next_read)
+                next_read += 1
+            if next_write >= next_read:
+                break
+            slot, frame_index, error = self._next_done()
+            if error:
+                raise Exception(f"Hiệu ứng lỗi ở frame {frame_index}: {error}")
+            pending[frame_index] = slot
+            # Ghi ra encoder theo thứ tự; slot chỉ được dùng lại sau khi đã ghi xong
+            while next_write in pending:
+                slot = pending.pop(next_write)
+                write_frame(self.slot_view(slot))
+                free_slots.append(slot)
+                next_write += 1
+                if on_frame:
+                    on_frame(next_write)
+        return next_write
+
+    def close(self):
+        for _ in self._processes:
+            self.task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+# --- CHẠY VỚI FFMPEG ---
+def _read_exact_into(stream, view):
+    """Đọc đủ 1 frame vào view; trả về False khi hết dữ liệu"""
+    filled = 0
+    total = len(view)
+    while filled < total:
+        count = stream.readinto(view[filled:])
+        if not count:
+            if filled:
+                raise Exception(f"Frame cuối bị thiếu dữ liệu ({filled}/{total} byte)")
+            return False
+        filled += count
+    return True
+
+def _stderr_tail(stderr_file, lines=20):
+    stderr_file.seek(0)
+    return stderr_file.read().decode('utf-8', errors='replace').strip().splitlines()[-lines:]
+
+def run_effect_pipeline(decode_cmd, encode_cmd, width, height, specs, base_ctx, workers=0,
+                        total_frames=None, control=None):
+    """decode_cmd xuất rawvideo rgb24 ra stdout, encode_cmd đọc rawvideo từ stdin.
+    Frame đi từ pipe vào shared memory, qua hiệu ứng rồi thẳng vào stdin của encoder"""
+    ring = FrameRing(width, height, specs, base_ctx, workers=workers)
+    creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+    with tempfile.TemporaryFile() as decode_err, tempfile.TemporaryFile() as encode_err:
+        decoder = subprocess.Popen(decode_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=decode_err,
+                                   creationflags=creationflags)
+        encoder = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=encode_err,
+                                   creationflags=creationflags)
+        started = time.time()
+
+        def read_frame(view):
+            if control:
+                control.wait_if_paused()
+            return _read_exact_into(decoder.stdout, view)
+
+        def on_frame(count):
+            if total_frames and count % PROGRESS_EVERY_FRAMES == 0:
+                print(f"PROGRESS:RENDER:{'%.2f' % min(100, count * 100 / total_frames)}", flush=True)
+
+        try:
+            frames = ring.process(read_frame, encoder.stdin.write, on_frame)
+            encoder.stdin.close()
+            decoder.wait()
+            encoder.wait()
+        except BaseException:
+            for process in (decoder, encoder):
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            raise
+        finally:
+            ring.close()
+        if decoder.returncode != 0:
+            raise subprocess.CalledProcessError(decoder.returncode, decode_cmd, stderr='\n'.join(_stderr_tail(decode_err)))
+        if encoder.returncode != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, encode_cmd, stderr='\n'.join(_stderr_tail(encode_err)))
+    elapsed = max(time.time() - started, 1e-6)
+    print(f"STATUS: Hiệu ứng: {frames} frame, {frames / elapsed:.1f} fps", flush=True)
+    return frames
+
+def benchmark(specs, workers=0, width=720, height=1280, frames=BENCHMARK_FRAMES, fps=30):
+    """Đo số frame/giây đi qua stage hiệu ứng (frame tổng hợp, không có ffmpeg). Trả về fps"""
+    import numpy as np
+    source = np.random.default_rng(0).integers(0, 255, (height, width, FRAME_CHANNELS), dtype=np.uint8).tobytes()
+    base_ctx = {'fps': fps, 'start': 0.0, 'duration': frames / fps, 'part_num': 1,
+                'envelope_path': None, 'envelope_window': 0.05}
+    ring = FrameRing(width, height, specs, base_ctx, workers=workers)
+    counter = {'read': 0}
+
+    def read_frame(view):
+        if counter['read'] >= frames:
+            return False
+        view[:] = source
+        counter['read'] += 1
+        return True
+
+    sink = bytearray(len(source))
+    try:
+        started = time.time()
+        processed = ring.process(read_frame, lambda view: sink.__setitem__(slice(None), view))
+        elapsed = max(time.time() - started, 1e-6)
+    finally:
+        ring.close()
+    return processed / elapsed
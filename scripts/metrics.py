@@ -0,0 +1,272 @@
+"""
+Module metrics tổng hợp của pipeline - counter/gauge/histogram theo label, xuất dạng text Prometheus
+ra file (cộng dồn giữa các lần chạy) hoặc qua HTTP localhost
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import subprocess
+
+METRIC_PREFIX = "trashvideo_"
+FLUSH_INTERVAL = 15
+LOCK_TIMEOUT = 10
+
+# Bucket cho từng loại đo (đơn vị theo tên metric)
+BYTES_BUCKETS = (1e6, 1e7, 5e7, 1e8, 5e8, 1e9, 5e9)
+THROUGHPUT_BUCKETS = (1e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7)
+SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 3600)
+FPS_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 200, 400)
+
+class MetricsRegistry:
+    """Giữ giá trị metric trong bộ nhớ; phần tăng thêm kể từ lần flush trước được cộng vào file state dùng chung"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        # (name, labels tuple) -> giá trị; histogram: {'buckets': [...], 'sum': x, 'count': n}
+        self._values = {}
+        self._delta = {}
+        self._gauges = {}
+
+    def _declare(self, name, kind, help_text, buckets=None):
+        self._meta.setdefault(name, {'kind': kind, 'help': help_text, 'buckets': list(buckets or ())})
+
+    def inc(self, name, value=1.0, help_text="", **labels):
+        self._declare(name, 'counter', help_text)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            for store in (self._values, self._delta):
+                store[key] = store.get(key, 0.0) + value
+
+    def set(self, name, value, help_text="", **labels):
+        self._declare(name, 'gauge', help_text)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = float(value)
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, help_text="", **labels):
+        self._declare(name, 'histogram', help_text, buckets)
+        bounds = self._meta[name]['buckets']
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            for store in (self._values, self._delta):
+                entry = store.setdefault(key, {'buckets': [0] * len(bounds), 'sum': 0.0, 'count': 0})
+                for i, bound in enumerate(bounds):
+                    if value <= bound:
+                        entry['buckets'][i] += 1
+                entry['sum'] += value
+                entry['count'] += 1
+
+    # --- XUẤT ---
+    def render(self, values=None, gauges=None, meta=None):
+        """Text Prometheus (exposition format 0.0.4)"""
+        with self._lock:
+            values = dict(self._values if values is None else values)
+            gauges = dict(self._gauges if gauges is None else gauges)
+            meta_by_name = dict(self._meta if meta is None else meta)
+        lines = []
+        for name in sorted(meta_by_name):
+            meta = meta_by_name[name]
+
+            full_name = METRIC_PREFIX + name
+            if meta['help']:
+                lines.append(f"# HELP {full_name} {meta['help']}")
+            lines.append(f"# TYPE {full_name} {meta['kind']}")
+            source = gauges if meta['kind'] == 'gauge' else values
+            for (metric, labels), value in sorted(source.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                if meta['kind'] != 'histogram':
+                    lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                for bound, count in zip(meta['buckets'], value['buckets']):
+                    lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {count}")
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def flush_to_file(self, prom_path):
+        """Cộng phần tăng thêm vào file state (khóa bằng file .lock vì nhiều tiến trình cùng ghi) rồi ghi file .prom"""
+        state_path = prom_path + ".state.json"
+        with self._lock:
+            delta, self._delta = self._delta, {}
+            gauges = dict(self._gauges)
+            meta = dict(self._meta)
+        with _FileLock(prom_path + ".lock"):
+            state = _load_state(state_path)
+            for key, value in delta.items():
+                if isinstance(value, dict):
+                    entry = state['values'].setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0})
+                    if len(entry['buckets']) != len(value['buckets']):
+                        entry['buckets'] = [0] * len(value['buckets'])
+                    entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+                    entry['sum'] += value['sum']
+                    entry['count'] += value['count']
+                else:
+                    state['values'][key] = state['values'].get(key, 0.0) + value
+            state['gauges'].update(gauges)
+            state['meta'].update(meta)
+            _save_state(state_path, state)
+            text = self.render(state['values'], state['gauges'], state['meta'])
+            temp_path = prom_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temp_path, prom_path)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not float(value).is_integer() else str(int(value))
+
+def _load_state(state_path):
+    state = {'values': {}, 'gauges': {}, 'meta': {}}
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        return state
+    state['meta'] = raw.get('meta', {})
+    for section in ('values', 'gauges'):
+        for item in raw.get(section, []):
+            state[section][(item['name'], tuple(tuple(pair) for pair in item['labels']))] = item['value']
+    return state
+
+def _save_state(state_path, state):
+    data = {
+        section: [{'name': name, 'labels': list(labels), 'value': value} for (name, labels), value in state[section].items()]
+        for section in ('values', 'gauges')
+    }
+    data['meta'] = state['meta']
+    temp_path = state_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, state_path)
+
+class _FileLock:
+    """Khóa liên tiến trình đơn giản bằng file tạo độc quyền; khóa bỏ quên quá LOCK_TIMEOUT giây thì bị chiếm lại"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > LOCK_TIMEOUT or time.time() > deadline:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        return False
+
+registry = MetricsRegistry()
+
+# --- HÀM GHI METRIC DÙNG TRONG PIPELINE ---
+def record_download(source, kind, num_bytes, seconds):
+    registry.inc('download_bytes_total', num_bytes, "Số byte đã tải theo nguồn", source=source, kind=kind)
+    registry.observe('download_size_bytes', num_bytes, BYTES_BUCKETS, "Kích thước mỗi lần tải", kind=kind)
+    if seconds > 0 and num_bytes > 0:
+        registry.observe('download_throughput_bytes_per_second', num_bytes / seconds, THROUGHPUT_BUCKETS,
+                         "Throughput mỗi lần tải", source=source, kind=kind)
+
+def record_cache(cache, hit):
+    registry.inc('cache_requests_total', 1, "Lượt tra cache theo loại và kết quả", cache=cache,
+                 result='hit' if hit else 'miss')
+
+def record_part(encoder, mode, seconds, media_seconds, fps=None):
+    registry.observe('part_render_seconds', seconds, SECONDS_BUCKETS, "Thời gian render mỗi phần", encoder=encoder, mode=mode)
+    registry.inc('rendered_media_seconds_total', media_seconds, "Tổng số giây video đã render", encoder=encoder)
+    if fps and seconds > 0:
+        registry.observe('encode_fps', media_seconds * fps / seconds, FPS_BUCKETS, "Số frame encode mỗi giây", encoder=encoder)
+
+def record_failure(reason, stage):
+    registry.inc('failures_total', 1, "Số lỗi theo nguyên nhân và bước xảy ra", reason=reason, stage=stage)
+
+def record_job(status):
+    registry.inc('jobs_total', 1, "Số job đã kết thúc theo trạng thái", status=status)
+
+def record_admission(stage, seconds):
+    registry.observe('admission_wait_seconds', seconds, SECONDS_BUCKETS,
+                     "Thời gian 1 bước chờ governor cấp tài nguyên", stage=stage)
+
+def set_queue_depth(depth, state):
+    registry.set('queue_depth', depth, "Số job trong kho theo trạng thái", state=state)
+
+def classify_error(error):
+    """Nguyên nhân lỗi của 1 bước chạy tiến trình con: ffmpeg lỗi, treo (watchdog), bị hủy hay lỗi Python"""
+    if isinstance(error, subprocess.TimeoutExpired):
+        return 'stall'
+    if isinstance(error, subprocess.CalledProcessError):
+        return 'ffmpeg'
+    if type(error).__name__ == 'ProcessCancelled':
+        return 'cancelled'
+    return 'python'
+
+# --- EXPORTER ---
+def start_exporter(metrics_file=None, port=None):
+    """Bật xuất metrics: file .prom được cập nhật định kỳ (và khi gọi flush()), HTTP chỉ nghe trên 127.0.0.1"""
+    if port:
+        # http.server chỉ được nạp khi bật exporter HTTP
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class _MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(('127.0.0.1', int(port)), _MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"STATUS: Metrics tại http://127.0.0.1:{server.server_address[1]}/metrics", flush=True)
+    if metrics_file:
+        os.makedirs(os.path.dirname(os.path.abspath(metrics_file)), exist_ok=True)
+        _exporter['file'] = os.path.abspath(metrics_file)
+
+        def loop():
+            while True:
+                time.sleep(FLUSH_INTERVAL)
+                flush()
+
+        threading.Thread(target=loop, name="metrics-flush", daemon=True).start()
+        atexit.register(flush)
+
+_exporter = {'file': None}
+
+def flush():
+    if _exporter['file']:
+        try:
+            registry.flush_to_file(_exporter['file'])
+        except OSError as e:
+            print(f"WARNING: Không ghi được metrics: {e}", flush=True)
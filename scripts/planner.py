@@ -0,0 +1,297 @@
+"""
+Module ước lượng chi phí job - mô hình thời gian fit từ lịch sử timings, kế hoạch chạy (DAG) cho --plan và ETA khi chạy
+"""
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# Số mẫu tối thiểu để fit đường thẳng (giây = cố định + hệ số * units); ít hơn thì dùng tỉ lệ trung bình
+MIN_FIT_SAMPLES = 3
+HISTORY_LIMIT = 200
+# Chi phí mặc định khi chưa có lịch sử: (giây cố định, giây trên mỗi đơn vị)
+# units: byte cho bước tải, giây media cho bước xử lý, 1 cho metadata
+DEFAULT_COSTS = {
+    'metadata': (3.0, 0.0),
+    'download_audio': (2.0, 1 / (4 * 1024 ** 2)),
+    'download_thumbnail': (0.5, 1 / (2 * 1024 ** 2)),
+    'download_video': (3.0, 1 / (4 * 1024 ** 2)),
+    'speed': (1.0, 0.4),
+    'loop': (1.0, 0.3),
+    'analysis': (0.5, 0.02),
+    'render_part': (2.0, 0.6),
+}
+# Các bước có chi phí phụ thuộc encoder và độ phân giải nguồn
+ENCODER_STAGES = ('speed', 'loop', 'render_part')
+# Encoder phần cứng mặc định nhanh hơn libx264 chừng này lần khi chưa có lịch sử
+HW_ENCODER_SPEEDUP = 3.0
+# CPU-giây trên mỗi giây chạy khi chưa đo được (bước tải chủ yếu chờ mạng)
+DEFAULT_CPU_FACTORS = {'metadata': 0.3, 'download_audio': 0.3, 'download_thumbnail': 0.1, 'download_video': 0.3, 'analysis': 1.0}
+# Dung lượng ước lượng khi metadata không có filesize
+DEFAULT_AUDIO_BYTES_PER_SECOND = 16 * 1024
+DEFAULT_VIDEO_BYTES_PER_SECOND = 512 * 1024
+DEFAULT_THUMBNAIL_BYTES = 100 * 1024
+
+ETA_INTERVAL = 10
+# Hệ số điều chỉnh theo tốc độ thực tế của job đang chạy được giới hạn trong khoảng này
+DRIFT_LIMITS = (0.25, 4.0)
+# Worker có tỉ lệ thực tế/dự đoán cao hơn trung vị chừng này lần thì bị báo là chậm
+SLOW_NODE_RATIO = 1.5
+
+def resolution_label(height):
+    return f"{int(height)}p" if height else None
+
+def _is_hw_encoder(encoder):
+    return any(hw in (encoder or '') for hw in ('nvenc', 'amf', 'qsv'))
+
+def _process_cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class CostModel:
+    """Dự đoán thời gian/CPU của từng bước từ các mẫu timings gần nhất trong kho job.
+    Thử theo thứ tự (encoder, độ phân giải) -> encoder -> mọi mẫu của bước -> giá trị mặc định"""
+
+    def __init__(self, store=None):
+        self.store = store
+        self._fits = {}
+
+    def _samples(self, stage, encoder, resolution):
+        if not self.store:
+            return []
+        return self.store.timing_samples(stage, encoder=encoder, resolution=resolution, limit=HISTORY_LIMIT)
+
+    def _fit(self, stage, encoder, resolution):
+        key = (stage, encoder, resolution)
+        if key in self._fits:
+            return self._fits[key]
+        candidates = [(encoder, resolution), (encoder, None), (None, None)] if stage in ENCODER_STAGES else [(None, None)]
+        fit = None
+        for candidate_encoder, candidate_resolution in candidates:
+            if candidate_encoder is None and candidate_resolution is None and stage in ENCODER_STAGES and encoder:
+                # Không trộn mẫu của encoder khác vào dự đoán cho encoder này
+                break
+            samples = self._samples(stage, candidate_encoder, candidate_resolution)
+            if samples:
+                fit = _fit_samples(samples)
+                fit['source'] = f"history:{len(samples)}"
+                break
+        if fit is None:
+            fixed, per_unit = DEFAULT_COSTS.get(stage, (1.0, 0.0))
+            if stage in ENCODER_STAGES and _is_hw_encoder(encoder):
+                per_unit /= HW_ENCODER_SPEEDUP
+            fit = {'fixed': fixed, 'per_unit': per_unit, 'cpu_factor': None, 'source': 'default'}
+        if fit['cpu_factor'] is None:
+            fit['cpu_factor'] = self._default_cpu_factor(stage, encoder)
+        self._fits[key] = fit
+        return fit
+
+    @staticmethod
+    def _default_cpu_factor(stage, encoder):
+        if stage in DEFAULT_CPU_FACTORS:
+            return DEFAULT_CPU_FACTORS[stage]
+        if _is_hw_encoder(encoder):
+            return 1.0
+        # libx264 dùng tối đa 6 thread, chừa 1 core cho hệ thống
+        return float(max(1, min((os.cpu_count() or 4) - 1, 6)))
+
+    def predict(self, stage, units, encoder=None, resolution=None):
+        fit = self._fit(stage, encoder, resolution)
+        wall = fit['fixed'] + fit['per_unit'] * (units or 0)
+        return {'wall_seconds': wall, 'cpu_seconds': wall * fit['cpu_factor'], 'model': fit['source']}
+
+def _fit_samples(samples):
+    """Bình phương tối thiểu seconds = fixed + per_unit * units; hệ số âm thì quay về tỉ lệ trung bình"""
+    units = [u for u, _, _ in samples]
+    seconds = [s for _, s, _ in samples]
+    fixed, per_unit = 0.0, sum(seconds) / sum(units) if sum(units) > 0 else 0.0
+    if len(samples) >= MIN_FIT_SAMPLES:
+        mean_u, mean_s = sum(units) / len(units), sum(seconds) / len(seconds)
+        variance = sum((u - mean_u) ** 2 for u in units)
+        if variance > 0:
+            slope = sum((u - mean_u) * (s - mean_s) for u, s in zip(units, seconds)) / variance
+            intercept = mean_s - slope * mean_u
+            if slope >= 0 and intercept >= 0:
+                fixed, per_unit = intercept, slope
+    measured = [(cpu, s) for _, s, cpu in samples if cpu is not None and s > 0]
+    cpu_factor = sum(cpu for cpu, _ in measured) / sum(s for _, s in measured) if measured else None
+    return {'fixed': fixed, 'per_unit': per_unit, 'cpu_factor': cpu_factor}
+
+class PlanBuilder:
+    """Dựng DAG các bước của 1 job kèm dự đoán; bước đã có trong cache có chi phí 0"""
+
+    def __init__(self, model, encoder, resolution=None):
+        self.model = model
+        self.encoder = encoder
+        self.resolution = resolution
+        self.nodes = []
+
+    def add(self, node_id, stage, units=None, deps=(), cached=False, bytes=0, label=""):
+        if cached:
+            prediction = {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'model': 'cache'}
+        else:
+            prediction = self.model.predict(stage, units, encoder=self.encoder, resolution=self.resolution)
+        self.nodes.append(dict(
+            id=node_id, stage=stage, label=label or node_id, deps=[dep for dep in deps if dep], units=units,
+            cached=cached, bytes=0 if cached else int(bytes or 0), **prediction
+        ))
+        return node_id
+
+    def build(self):
+        """Kế hoạch: các bước theo thứ tự chạy, tổng thời gian khi chạy tuần tự và đường găng khi chạy song song"""
+        finish = {}
+        offset = 0.0
+        for node in self.nodes:
+            node['start_offset'] = offset
+            offset += node['wall_seconds']
+            finish[node['id']] = max((finish.get(dep, 0.0) for dep in node['deps']), default=0.0) + node['wall_seconds']
+        return {
+            'encoder': self.encoder,
+            'resolution': self.resolution,
+            'nodes': self.nodes,
+            'total': {
+                'wall_seconds': offset,
+                'critical_path_seconds': max(finish.values(), default=0.0),
+                'cpu_seconds': sum(n['cpu_seconds'] for n in self.nodes),
+                'download_bytes': sum(n['bytes'] for n in self.nodes),
+            },
+        }
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class EtaTracker:
+    """ETA trong lúc chạy: phần còn lại của kế hoạch, nhân với tỉ lệ thực tế/dự đoán của các bước đã xong"""
+
+    def __init__(self, plan, interval=ETA_INTERVAL):
+        self.nodes = {node['id']: node for node in plan['nodes']}
+        self.interval = interval
+        self.done = {}
+        self.running = {}
+        self.host_ratios = {}
+        self.slow_hosts = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self, node_id):
+        with self._lock:
+            if node_id in self.nodes:
+                self.running[node_id] = time.monotonic()
+
+    def finish(self, node_id, seconds=None, host=None, counted=True):
+        """Đánh dấu bước đã xong; counted=False (vd trúng cache) thì không tính vào hệ số điều chỉnh"""
+        with self._lock:
+            node = self.nodes.get(node_id)
+            if not node:
+                return
+            started = self.running.pop(node_id, None)
+            if seconds is None:
+                seconds = time.monotonic() - started if started else 0.0
+            self.done[node_id] = seconds if counted else None
+            if host and node['wall_seconds'] > 0:
+                self.host_ratios.setdefault(host, []).append(seconds / node['wall_seconds'])
+                self._check_slow_hosts()
+        if counted:
+            self.emit()
+
+    def abort(self, node_id):
+        with self._lock:
+            self.running.pop(node_id, None)
+
+    def _check_slow_hosts(self):
+        if len(self.host_ratios) < 2:
+            return
+        means = {host: sum(ratios) / len(ratios) for host, ratios in self.host_ratios.items()}
+        ordered = sorted(means.values())
+        median = ordered[len(ordered) // 2]
+        for host, mean in means.items():
+            if host not in self.slow_hosts and median > 0 and mean > median * SLOW_NODE_RATIO:
+                self.slow_hosts.add(host)
+                print(f"WARNING: Worker {host} chậm hơn dự đoán {mean:.1f}x (trung vị {median:.1f}x)", flush=True)
+
+    def drift(self):
+        measured = [(actual, self.nodes[node_id]['wall_seconds']) for node_id, actual in self.done.items()
+                    if actual is not None and self.nodes[node_id]['wall_seconds'] > 0]
+        predicted = sum(p for _, p in measured)
+        if not predicted:
+            return 1.0
+        return max(DRIFT_LIMITS[0], min(DRIFT_LIMITS[1], sum(a for a, _ in measured) / predicted))
+
+    def remaining(self):
+        with self._lock:
+            drift = self.drift()
+            now = time.monotonic()
+            total = 0.0
+            for node_id, node in self.nodes.items():
+                if node_id in self.done:
+                    continue
+                expected = node['wall_seconds'] * drift
+                if node_id in self.running:
+                    expected = max(0.0, expected - (now - self.running[node_id]))
+                total += expected
+            return total
+
+    def emit(self):
+        remaining = self.remaining()
+        print(f"ETA:{remaining:.0f}:{time.time() + remaining:.0f}", flush=True)
+
+    def start_ticker(self):
+        def tick():
+            while not self._stop.wait(self.interval):
+                self.emit()
+
+        threading.Thread(target=tick, name="eta-ticker", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+class StageTimer:
+    """Đo từng bước của job: ghi vào bảng timings (nếu có kho) và báo cho EtaTracker (nếu có).
+    measure_cpu=False khi nhiều job chạy chung process (CPU của tiến trình con không tách được theo job)"""
+
+    def __init__(self, store=None, encoder=None, resolution=None, job_id=None, tracker=None, measure_cpu=True):
+        self.store = store
+        self.encoder = encoder
+        self.resolution = resolution
+        self.job_id = job_id
+        self.tracker = tracker
+        self.measure_cpu = measure_cpu and sys.platform != 'win32'
+
+    @contextmanager
+    def stage(self, stage, units=None, node=None):
+        """with timer.stage('download_video', node='download_video') as record: ...; record['units'] = số byte"""
+        node = node or stage
+        record = {'units': units}
+        if self.tracker:
+            self.tracker.start(node)
+        started = time.monotonic()
+        cpu_started = _process_cpu_seconds() if self.measure_cpu else None
+        try:
+            yield record
+        except BaseException:
+            if self.tracker:
+                self.tracker.abort(node)
+            raise
+        seconds = time.monotonic() - started
+        cpu_seconds = _process_cpu_seconds() - cpu_started if self.measure_cpu else None
+        if self.store and record['units'] is not None:
+            try:
+                self.store.record_timing(
+                    stage, seconds, units=record['units'], encoder=self.encoder, resolution=self.resolution,
+                    cpu_seconds=cpu_seconds, job_id=self.job_id
+                )
+            except Exception as e:
+                print(f"WARNING: Không ghi được thời gian bước {stage}: {e}", flush=True)
+        if self.tracker:
+            self.tracker.finish(node, seconds)
+
+    def skip(self, node):
+        """Bước có trong kế hoạch nhưng không phải chạy (trúng cache)"""
+        if self.tracker:
+            self.tracker.finish(node, 0.0, counted=False)
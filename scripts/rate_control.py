@@ -0,0 +1,195 @@
+"""
+Module rate control theo nội dung - đo độ phức tạp video nền bằng 1 lần encode nhanh ở độ phân giải thấp
+(cache theo nguồn), rồi chọn mức chất lượng / trần bitrate cho từng phần để đạt chất lượng hoặc
+dung lượng mục tiêu ngay trong 1 lần encode
+"""
+import os
+import json
+import math
+import threading
+from process_runner import run_process
+
+RATE_CONTROL_MODES = ('fixed', 'quality', 'size')
+# Phân tích: encode libx264 ultrafast ở CRF chuẩn, khung hình nhỏ, lấy mẫu thưa
+ANALYSIS_WIDTH = 256
+ANALYSIS_FPS = 5
+ANALYSIS_CRF = 23
+# Mỗi điểm của timeline độ phức tạp ứng với chừng này giây nguồn
+TIMELINE_STEP = 1.0
+ANALYSIS_VERSION = 1
+# Mức chất lượng cố định hiện tại (crf/cq/qp) và khoảng được phép điều chỉnh
+BASE_QUALITY = 23
+QUALITY_RANGE = (18, 32)
+# x264: giảm chừng này CRF thì bitrate tăng gấp đôi
+CRF_PER_DOUBLING = 6.0
+# Quy đổi bitrate từ khung phân tích lên khung đầu ra: theo số pixel (tăng chậm hơn tuyến tính) và tốc độ phát
+PIXEL_EXPONENT = 0.75
+SPEED_EXPONENT = 0.5
+# Encode phân tích (ultrafast, 5 fps) tốn bit hơn nhiều so với encode đầu ra (veryfast, 30 fps, dự đoán liên khung tốt);
+# hệ số ban đầu, được hiệu chỉnh dần theo bitrate thực tế của các phần đã render
+OUTPUT_SCALE = 0.3
+# Encoder phần cứng cần nhiều bit hơn libx264 chừng này lần để đạt cùng chất lượng
+HW_BITRATE_FACTOR = 1.25
+# Trần bitrate (VBV) so với bitrate trung bình dự kiến / ngân sách, và bộ đệm VBV
+MAXRATE_HEADROOM = 2.0
+SIZE_MAXRATE_HEADROOM = 1.5
+BUFSIZE_FACTOR = 2.0
+MIN_BITRATE_KBPS = 150
+# Hiệu chỉnh dự đoán theo kết quả thực tế (EWMA của log tỉ lệ thực tế / dự đoán), giới hạn để 1 phần lạ không làm lệch
+CALIBRATION_WEIGHT = 0.3
+CALIBRATION_LIMITS = (0.25, 4.0)
+CALIBRATION_RANGE = (0.1, 10.0)
+
+def analysis_params(video_id):
+    """Khóa cache của kết quả phân tích (đổi tham số phân tích thì phân tích lại)"""
+    return {
+        'source': video_id, 'width': ANALYSIS_WIDTH, 'fps': ANALYSIS_FPS, 'crf': ANALYSIS_CRF,
+        'step': TIMELINE_STEP, 'version': ANALYSIS_VERSION,
+    }
+
+def analysis_command(ffmpeg_path, video_path):
+    """Encode nhanh ra framecrc: mỗi dòng là 1 packet kèm kích thước, không ghi file video nào"""
+    return [
+        ffmpeg_path, '-hide_banner', '-nostdin', '-loglevel', 'error', '-stats', '-i', video_path, '-an',
+        '-vf', f"fps={ANALYSIS_FPS},scale={ANALYSIS_WIDTH}:-2",
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', str(ANALYSIS_CRF), '-threads', '1',
+        '-f', 'framecrc', '-'
+    ]
+
+def analyze_complexity(ffmpeg_path, video_path, output_path):
+    """Phân tích video nguồn, ghi timeline độ phức tạp ra output_path (JSON)"""
+    returncode, _, stderr_tail, lines = run_process(
+        analysis_command(ffmpeg_path, video_path), echo_stdout=False, capture_stdout=True
+    )
+    if returncode != 0:
+        raise Exception(f"Phân tích độ phức tạp lỗi: {' '.join(stderr_tail[-3:])}")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(parse_framecrc(lines), f)
+
+def parse_framecrc(lines):
+    """Timeline độ phức tạp: kbps (ở khung phân tích) theo từng TIMELINE_STEP giây nguồn"""
+    time_base = 1.0 / ANALYSIS_FPS
+    buckets = {}
+    width = height = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#tb 0:'):
+            num, den = line.split(':', 1)[1].strip().split('/')
+            time_base = float(num) / float(den)
+        elif line.startswith('#dimensions 0:'):
+            width, height = (int(v) for v in line.split(':', 1)[1].strip().split('x'))
+        elif line and not line.startswith('#'):
+            fields = [f.strip() for f in line.split(',')]
+            if len(fields) < 5 or fields[0] != '0':
+                continue
+            index = int(float(fields[2]) * time_base / TIMELINE_STEP)
+            buckets[index] = buckets.get(index, 0) + int(fields[4])
+    if not buckets:
+        raise Exception("Không đọc được kết quả phân tích độ phức tạp")
+    timeline = [round(buckets.get(i, 0) * 8 / 1000 / TIMELINE_STEP, 3) for i in range(max(buckets) + 1)]
+    return {'step': TIMELINE_STEP, 'width': width, 'height': height, 'kbps': timeline}
+
+def _source_window_kbps(analysis, start, duration, speed, source_duration):
+    """Bitrate trung bình (khung phân tích) của đoạn nền [start, start + duration) tính theo thời gian đầu ra.
+    Nền được đổi tốc độ rồi lặp: thời điểm t của đầu ra ứng với (t * speed) mod độ dài nguồn"""
+    timeline = analysis['kbps']
+    step = analysis['step']
+    span = max(step, source_duration or len(timeline) * step)
+    samples = []
+    t = start
+    while t < start + duration:
+        source_t = (t * speed) % span
+        samples.append(timeline[min(len(timeline) - 1, int(source_t / step))])
+        t += step / max(speed, 1e-6)
+    if not samples:
+        samples = [timeline[min(len(timeline) - 1, int((start * speed) % span / step))]]
+    return sum(samples) / len(samples)
+
+def predict_bitrate(analysis, start, duration, speed, source_duration, video_area, calibration=1.0):
+    """Bitrate (kbps) libx264 CRF chuẩn dự kiến cho đoạn nền ở khung đầu ra"""
+    analysis_area = (analysis['width'] or ANALYSIS_WIDTH) * (analysis['height'] or ANALYSIS_WIDTH)
+    kbps = _source_window_kbps(analysis, start, duration, speed, source_duration)
+    kbps *= (max(video_area, 1) / analysis_area) ** PIXEL_EXPONENT
+    kbps *= OUTPUT_SCALE * max(speed, 1e-6) ** SPEED_EXPONENT
+    return kbps * calibration
+
+def plan_rate(predicted_kbps, mode, encoder, target_kbps=None):
+    """Tham số rate control của 1 phần: quality (crf/cq/qp), bitrate trung bình (encoder phần cứng) và trần VBV.
+    quality: giữ mức chất lượng chuẩn, trần bitrate theo độ phức tạp (cảnh động không vọt, encoder phần cứng
+    không phí bit cho cảnh tĩnh). size: nâng CRF tới khi bitrate dự kiến vừa ngân sách, trần VBV theo ngân sách"""
+    hw = any(family in encoder for family in ('nvenc', 'amf', 'qsv'))
+    predicted = max(1.0, predicted_kbps)
+    quality = BASE_QUALITY
+    if mode == 'size' and target_kbps:
+        # Nền tĩnh đã nằm dưới ngân sách thì giữ nguyên chất lượng, không đẩy bitrate lên cho đủ
+        quality = BASE_QUALITY + CRF_PER_DOUBLING * math.log2(predicted / target_kbps)
+        quality = min(QUALITY_RANGE[1], max(BASE_QUALITY, quality))
+        average = min(predicted * 2 ** ((BASE_QUALITY - quality) / CRF_PER_DOUBLING), target_kbps)
+        maxrate = target_kbps * SIZE_MAXRATE_HEADROOM
+    else:
+        average = predicted
+        maxrate = predicted * MAXRATE_HEADROOM
+    if hw:
+        average *= HW_BITRATE_FACTOR
+        maxrate *= HW_BITRATE_FACTOR
+    return {
+        'quality': int(round(min(QUALITY_RANGE[1], max(QUALITY_RANGE[0], quality)))),
+        'bitrate': int(max(MIN_BITRATE_KBPS, average)) if hw else None,
+        'maxrate': int(max(MIN_BITRATE_KBPS, maxrate)),
+        'bufsize': int(max(MIN_BITRATE_KBPS, maxrate) * BUFSIZE_FACTOR),
+        'predicted_kbps': round(predicted_kbps, 1),
+    }
+
+def rate_args(encoder, rate):
+    """Tham số rate control cho encoder; rate=None giữ mức cố định như trước"""
+    if not rate:
+        if 'nvenc' in encoder:
+            return ['-cq', str(BASE_QUALITY), '-b:v', '0']
+        if 'amf' in encoder:
+            return ['-qp', str(BASE_QUALITY)]
+        if 'qsv' in encoder:
+            return ['-global_quality', str(BASE_QUALITY)]
+        return ['-crf', str(BASE_QUALITY)]
+    vbv = ['-maxrate', f"{rate['maxrate']}k", '-bufsize', f"{rate['bufsize']}k"]
+    if 'nvenc' in encoder:
+        return ['-rc', 'vbr', '-cq', str(rate['quality']), '-b:v', f"{rate['bitrate']}k"] + vbv
+    if 'amf' in encoder:
+        return ['-rc', 'vbr_peak', '-b:v', f"{rate['bitrate']}k"] + vbv
+    if 'qsv' in encoder:
+        return ['-b:v', f"{rate['bitrate']}k"] + vbv
+    return ['-crf', str(rate['quality'])] + vbv
+
+# --- HIỆU CHỈNH THEO KẾT QUẢ THỰC TẾ ---
+_calibration_lock = threading.Lock()
+
+def _calibration_path(cache_dir):
+    return os.path.join(cache_dir, "rate_calibration.json")
+
+def load_calibration(cache_dir, encoder):
+    try:
+        with open(_calibration_path(cache_dir), 'r', encoding='utf-8') as f:
+            return float(json.load(f).get(encoder, 1.0))
+    except (OSError, ValueError, TypeError):
+        return 1.0
+
+def update_calibration(cache_dir, encoder, rate, actual_kbps):
+    """Cập nhật hệ số thực tế / dự đoán của libx264 sau mỗi phần. Bỏ qua encoder phần cứng (VBR bám theo bitrate
+    đã đặt) và phần chạm trần VBV, vì khi đó bitrate thực tế không phản ánh độ phức tạp"""
+    if rate.get('bitrate') or actual_kbps <= 0 or rate['predicted_kbps'] <= 0 or actual_kbps >= 0.95 * rate['maxrate']:
+        return
+    # Quy về CRF chuẩn để so với dự đoán
+    actual_kbps *= 2 ** ((rate['quality'] - BASE_QUALITY) / CRF_PER_DOUBLING)
+    predicted_kbps = rate['predicted_kbps']
+    with _calibration_lock:
+        path = _calibration_path(cache_dir)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        current = float(data.get(encoder, 1.0))
+        ratio = min(CALIBRATION_LIMITS[1], max(CALIBRATION_LIMITS[0], actual_kbps / predicted_kbps))
+        data[encoder] = min(CALIBRATION_RANGE[1], max(CALIBRATION_RANGE[0], current * ratio ** CALIBRATION_WEIGHT))
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
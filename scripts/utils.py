@@ -24,6 +24,7 @@ if sys.platform == 'win32':
 
 # --- PATCH subprocess.Popen để luôn dùng UTF-8 encoding ---
 # Fix quan trọng: yt-dlp gọi subprocess internally mà không set encoding
+# Chỉ patch khi thực sự nạp yt-dlp (xem downloader.load_yt_dlp) để không làm chậm lúc khởi động
 _original_popen = subprocess.Popen
 class UTF8Popen(_original_popen):
     def __init__(self, *args, **kwargs):
@@ -32,7 +33,10 @@ class UTF8Popen(_original_popen):
             kwargs['encoding'] = 'utf-8'
             kwargs['errors'] = 'replace'  # Ignore các ký tự không decode được
         super().__init__(*args, **kwargs)
-subprocess.Popen = UTF8Popen
+
+def patch_popen_utf8():
+    """Thay subprocess.Popen bằng bản luôn dùng UTF-8 (gọi nhiều lần không sao)"""
+    subprocess.Popen = UTF8Popen
 
 # --- CÁC HÀM TIỆN ÍCH ---
 def get_executable_path(name, resources_path):
@@ -61,3 +65,9 @@ def ffmpeg_safe_path(path):
         return path.replace(":", "\\:")
     return path
 
+
+def get_cache_dir(user_data_path, name):
+    """Lấy (và tạo nếu chưa có) thư mục cache lâu dài, không bị xóa sau mỗi job"""
+    cache_dir = os.path.join(user_data_path, "cache", name)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
@@ -0,0 +1,9 @@
+"""
+Cấu hình pytest - các module Python của app nằm trong scripts/ và được import trực tiếp theo tên
+"""
+import os
+import sys
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
@@ -0,0 +1,57 @@
+"""
+Test giới hạn dung lượng cache (LRU): không xóa file đang được job giữ hoặc vừa được dùng
+"""
+import os
+import time
+
+import cache
+from cache import PinSet, enforce_size_limit
+
+def _make(cache_dir, name, size, age):
+    path = cache_dir / name
+    path.write_bytes(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+def test_evicts_oldest_first(tmp_path):
+    oldest = _make(tmp_path, 'a', 100, 3000)
+    older = _make(tmp_path, 'b', 100, 2000)
+    newer = _make(tmp_path, 'c', 100, 1000)
+    assert enforce_size_limit(str(tmp_path), 200) == 200
+    assert not os.path.exists(oldest)
+    assert os.path.exists(older) and os.path.exists(newer)
+
+def test_skips_pinned_files_until_released(tmp_path):
+    pinned = _make(tmp_path, 'a', 100, 3000)
+    other = _make(tmp_path, 'b', 100, 2000)
+    pins = PinSet()
+    pins.add(pinned)
+    # Pin làm mới mtime: đưa về cũ lại để chỉ còn pin bảo vệ file
+    os.utime(pinned, (time.time() - 3000,) * 2)
+    try:
+        assert enforce_size_limit(str(tmp_path), 100) == 100
+        assert os.path.exists(pinned)
+        assert not os.path.exists(other)
+    finally:
+        pins.release()
+    assert not cache.pins.is_pinned(pinned)
+    assert enforce_size_limit(str(tmp_path), 0) == 0
+
+def test_pins_are_counted_across_jobs(tmp_path):
+    shared = _make(tmp_path, 'a', 100, 3000)
+    first, second = PinSet(), PinSet()
+    first.add(shared)
+    second.add(shared)
+    first.release()
+    assert cache.pins.is_pinned(shared)
+    second.release()
+    assert not cache.pins.is_pinned(shared)
+
+def test_skips_recently_used_files(tmp_path):
+    # File của process khác (không thấy pin) nhưng vừa được dùng: không xóa dù vượt giới hạn
+    old = _make(tmp_path, 'a', 100, 3000)
+    recent = _make(tmp_path, 'b', 100, 60)
+    assert enforce_size_limit(str(tmp_path), 0, grace=600) == 100
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
@@ -0,0 +1,130 @@
+"""
+Test render phân tán chạy hoàn toàn trên localhost: 1 coordinator, 2 worker (thread) với hàm render giả lập
+"""
+import os
+import threading
+
+import pytest
+
+import distributed
+from distributed import Coordinator, WorkerClient, RemoteError, run_worker
+
+NUM_PARTS = 4
+
+@pytest.fixture(autouse=True)
+def fast_timing(monkeypatch):
+    monkeypatch.setattr(distributed, 'POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(distributed, 'LEASE_SECONDS', 0.5)
+
+def _job(tmp_path):
+    audio = tmp_path / "audio.mp3"
+    audio.write_bytes(b'audio-data')
+    return {
+        'audio_path': str(audio),
+        'image_paths': {},
+        'segments': [(i * 10.0, 10.0) for i in range(NUM_PARTS)],
+        'temp_dir': str(tmp_path),
+    }
+
+def _localize(spec, inputs, images, task_dir):
+    job = {key: value for key, value in spec.items() if key not in ('inputs', 'images', 'videos')}
+    job.update(inputs)
+    job.update(image_paths=images, temp_dir=task_dir)
+    return job
+
+def _render(job, part_index, output_dir):
+    """Render giả: nội dung phần = input audio (đã tải qua blob) + chỉ số phần"""
+    output_path = os.path.join(output_dir, f"part{part_index + 1}.mp4")
+    with open(job['audio_path'], 'rb') as src, open(output_path, 'wb') as dst:
+        dst.write(src.read() + f":{part_index}".encode('ascii'))
+    return output_path
+
+class CorruptingClient(WorkerClient):
+    """Worker gửi sai checksum ở lần upload đầu tiên (như file bị hỏng trên đường truyền)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.corrupted = []
+
+    def upload_result(self, task_id, path):
+        if self.corrupted:
+            return super().upload_result(task_id, path)
+        self.corrupted.append(task_id)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(os.path.getsize(path)),
+            'X-Content-SHA256': '0' * 64,
+        }
+        status, data = self._call('PUT', f"result/{task_id}", data=lambda: open(path, 'rb'), headers=headers)
+        if status != 200:
+            raise RemoteError(f"Upload kết quả {task_id} bị từ chối: HTTP {status} {data}")
+
+def _start_workers(url, tmp_path, clients):
+    threads = []
+    for client in clients:
+        thread = threading.Thread(
+            target=run_worker,
+            args=(client, str(tmp_path / "blobs"), str(tmp_path / f"work_{client.worker_id}"), _localize, _render),
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def test_workers_render_all_parts_with_lease_expiry_and_checksum_rejection(tmp_path):
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    coordinator = Coordinator(_job(tmp_path), str(output_dir), lambda i: f"T_Part_{i + 1}.mp4")
+    url = coordinator.serve('127.0.0.1', 0)
+    try:
+        # Worker "ma" nhận part1 rồi chết: không heartbeat, hết lease thì part1 được giao lại
+        ghost = coordinator.claim('ghost')
+        assert ghost['task_id'] == 'part1'
+
+        corrupting = CorruptingClient(url, 'w2')
+        threads = _start_workers(url, tmp_path, [WorkerClient(url, 'w1'), corrupting])
+        results = coordinator.wait()
+        for thread in threads:
+            thread.join(timeout=10)
+            assert not thread.is_alive()
+    finally:
+        coordinator.shutdown()
+
+    assert [os.path.basename(path) for path in results] == [f"T_Part_{i + 1}.mp4" for i in range(NUM_PARTS)]
+    for i, path in enumerate(results):
+        with open(path, 'rb') as f:
+            assert f.read() == f"audio-data:{i}".encode('ascii')
+
+    tasks = coordinator.tasks
+    # part1: lần đầu của worker ma + lần giao lại sau khi hết lease
+    assert tasks['part1']['attempts'] >= 2
+    assert tasks['part1']['worker'] != 'ghost'
+    # Upload sai checksum bị từ chối, task được giao lại và hoàn thành
+    rejected = corrupting.corrupted[0]
+    assert tasks[rejected]['attempts'] >= 2
+    assert all(task['state'] == 'done' for task in tasks.values())
+    # Không còn file upload tạm trong thư mục kết quả
+    assert sorted(os.listdir(output_dir)) == [f"T_Part_{i + 1}.mp4" for i in range(NUM_PARTS)]
+
+def test_task_fails_after_max_attempts(tmp_path):
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    coordinator = Coordinator(_job(tmp_path), str(output_dir), lambda i: f"T_Part_{i + 1}.mp4")
+    url = coordinator.serve('127.0.0.1', 0)
+
+    def broken_render(job, part_index, output_dir):
+        raise RuntimeError("ffmpeg lỗi")
+
+    try:
+        thread = threading.Thread(
+            target=run_worker,
+            args=(WorkerClient(url, 'w1'), str(tmp_path / "blobs"), str(tmp_path / "work"), _localize, broken_render),
+            daemon=True
+        )
+        thread.start()
+        with pytest.raises(RemoteError):
+            coordinator.wait()
+        thread.join(timeout=10)
+    finally:
+        coordinator.shutdown()
+    assert coordinator.tasks['part1']['attempts'] == distributed.MAX_ATTEMPTS
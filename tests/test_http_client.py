@@ -0,0 +1,126 @@
+"""
+Test HttpSession với server HTTP giả lập trên 127.0.0.1: keep-alive, retry khi 5xx, cache ETag/304 và proxy
+"""
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import http_client
+from http_client import HttpSession, HttpError
+
+BODY = b'thumbnail-bytes' * 100
+ETAG = '"v1"'
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.client_address[1], dict(self.headers)))
+            hits = server.hits[self.path] = server.hits.get(self.path, 0) + 1
+        if self.path.endswith('/flaky') and hits <= 2:
+            self._send(503)
+        elif self.path.endswith('/broken'):
+            self._send(500)
+        elif self.path.endswith('/missing'):
+            self._send(404)
+        elif self.path.endswith('/etag') and self.headers.get('If-None-Match') == ETAG:
+            self._send(304, headers=[('ETag', ETAG)])
+        else:
+            self._send(200, BODY, headers=[('ETag', ETAG)])
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.hits = {}
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield httpd
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(http_client, 'BACKOFF_BASE', 0.01)
+
+def _url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+def _session(**kwargs):
+    session = HttpSession(timeout=5, **kwargs)
+    session._proxies = {}
+    return session
+
+def test_keep_alive_reuses_connection(server, tmp_path):
+    session = _session()
+    for i in range(3):
+        dest = tmp_path / f"out{i}.jpg"
+        session.download(_url(server, f"/thumb{i}"), str(dest))
+        assert dest.read_bytes() == BODY
+    session.close()
+    # Cả 3 request đi trên cùng 1 kết nối TCP (cùng cổng phía client)
+    assert len({port for _, port, _ in server.requests}) == 1
+
+def test_retries_on_5xx_then_succeeds(server, tmp_path):
+    session = _session(retries=3)
+    dest = tmp_path / "flaky.jpg"
+    session.download(_url(server, "/flaky"), str(dest))
+    assert dest.read_bytes() == BODY
+    assert server.hits['/flaky'] == 3
+
+def test_gives_up_after_retries(server, tmp_path):
+    session = _session(retries=2)
+    with pytest.raises(HttpError) as error:
+        session.download(_url(server, "/broken"), str(tmp_path / "broken.jpg"))
+    assert error.value.status == 500
+    assert server.hits['/broken'] == 3
+    assert not (tmp_path / "broken.jpg.part").exists()
+
+def test_client_error_is_not_retried(server, tmp_path):
+    session = _session(retries=3)
+    with pytest.raises(HttpError):
+        session.download(_url(server, "/missing"), str(tmp_path / "missing.jpg"))
+    assert server.hits['/missing'] == 1
+
+def test_etag_revalidation_serves_cached_body(server, tmp_path):
+    cache_dir = tmp_path / "cache"
+    url = _url(server, "/etag")
+    first = tmp_path / "first.jpg"
+    _session(cache_dir=str(cache_dir)).download(url, str(first))
+    assert first.read_bytes() == BODY
+
+    # Session mới (như 1 job khác): gửi If-None-Match, server trả 304, body lấy từ cache
+    second = tmp_path / "second.jpg"
+    _session(cache_dir=str(cache_dir)).download(url, str(second))
+    assert second.read_bytes() == BODY
+    assert server.requests[-1][2].get('If-None-Match') == ETAG
+
+def test_plain_http_proxy_uses_absolute_uri(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(http_client.urllib.request, 'proxy_bypass', lambda host: False)
+    session = _session()
+    # Server giả lập đóng vai proxy: request tới host khác phải đi qua nó với request-target dạng absolute-URI
+    session._proxies = {'http': f"http://127.0.0.1:{server.server_address[1]}"}
+    dest = tmp_path / "proxied.jpg"
+    session.download("http://cdn.example.invalid/img.jpg", str(dest))
+    assert dest.read_bytes() == BODY
+    path, _, headers = server.requests[-1]
+    assert path == "http://cdn.example.invalid/img.jpg"
+    assert headers.get('Host') == "cdn.example.invalid"
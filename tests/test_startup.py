@@ -0,0 +1,43 @@
+"""
+Test thời gian khởi động của editor.py - import editor không được nạp các module nặng / subsystem chỉ dùng ở
+một số chế độ (tải, hàng chờ, phân tán, hiệu ứng, metrics HTTP). Chạy trong tiến trình con để sys.modules sạch
+"""
+import json
+import os
+import subprocess
+import sys
+
+from conftest import SCRIPTS_DIR
+
+# Thư viện nặng: yt-dlp, SQLite, HTTP server/client (kéo theo ssl), multiprocessing, numpy, asyncio
+HEAVY_MODULES = (
+    'yt_dlp', 'sqlite3', 'http.server', 'http.client', 'ssl', 'urllib.request', 'multiprocessing', 'numpy',
+    'asyncio', 'concurrent.futures', 'socket',
+)
+# Module của app chỉ được import trong chế độ / bước dùng tới chúng
+DEFERRED_MODULES = (
+    'downloader', 'http_client', 'distributed', 'scheduler', 'frame_effects', 'audio_analysis', 'rate_control',
+    'bumpers',
+)
+
+def _modules_after_import(module):
+    code = (
+        "import sys, json\n"
+        f"import {module}\n"
+        "print(json.dumps(sorted(sys.modules)))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code], cwd=SCRIPTS_DIR, capture_output=True, text=True, timeout=60,
+        env=dict(os.environ, PYTHONIOENCODING='utf-8'),
+    )
+    assert result.returncode == 0, result.stderr
+    return set(json.loads(result.stdout.strip().splitlines()[-1]))
+
+def test_editor_import_skips_heavy_modules():
+    loaded = _modules_after_import('editor')
+    assert 'editor' in loaded
+    assert sorted(loaded.intersection(HEAVY_MODULES)) == []
+
+def test_editor_import_defers_subsystems():
+    loaded = _modules_after_import('editor')
+    assert sorted(loaded.intersection(DEFERRED_MODULES)) == []